@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.INSTRUMENTS.
+#
+# SENAITE.CORE is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright 2018-2019 by it's authors.
+# Some rights reserved, see README and LICENSE.
+
+"""Imports a drop folder of results files, one transaction per file
+
+The files are imported in the order of their names, each one is parsed and
+its results applied and committed before the next one is read. Files
+uploaded before are answered from the parse cache. From a
+``bin/instance run`` script::
+
+    from senaite.instruments.instruments.perkinelmer.avio.avio import importer
+
+    batch = BatchImport(portal, importer(portal).get_automatic_parser,
+                        instrument_uid=api.get_uid(instrument))
+    for report in batch.run("/srv/instruments/avio"):
+        print report["filename"], report["errors"]
+
+The files are not parsed concurrently. Parsers look up Samples in the
+catalogs while they parse, so parsing cannot move to a process pool without
+a ZODB connection per process, and parsing is CPU bound: with the GIL a pool
+of parsing threads was not faster than parsing the files one by one,
+measured on the benchmark files.
+"""
+
+import os
+import traceback
+from cStringIO import StringIO
+from time import time
+
+import transaction
+from senaite.core.exportimport.instruments.resultsimport import \
+    AnalysisResultsImporter
+from senaite.instruments import logger
+from senaite.instruments.instrument import FileStub
+from senaite.instruments.instrument import file_checksum
+from senaite.instruments.parsecache import cache_key
+from senaite.instruments.parsecache import keep_fresh
+from senaite.instruments.parsecache import use_parse_cache
+from zope.publisher.browser import FileUpload
+
+# Sample states the results are applied to, per "artoapply" import option
+SAMPLE_STATES = {
+    "received": ["sample_received"],
+    "received_tobeverified": [
+        "sample_received", "attachment_due", "to_be_verified"],
+}
+
+# Importer override flags, per "results_override" import option
+OVERRIDE = {
+    "nooverride": [False, False],
+    "override": [True, False],
+    "overrideempty": [True, True],
+}
+
+
+def read_file(path):
+    """Returns the file at path as an upload of the import form
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    return FileUpload(FileStub(file=StringIO(data),
+                               name=os.path.basename(path)))
+
+
+def list_files(folder):
+    """Returns the paths of the files in the folder, sorted by name
+
+    Hidden files are skipped, they are usually still being copied.
+    """
+    paths = []
+    for name in sorted(os.listdir(folder)):
+        path = os.path.join(folder, name)
+        if name.startswith(".") or not os.path.isfile(path):
+            continue
+        paths.append(path)
+    return paths
+
+
+class BatchImport(object):
+    """Parses the files of a folder and imports them one by one
+
+    The parsed parser is handed to an AnalysisResultsImporter, which does not
+    parse the file again. Whatever the parser writes while parsing is
+    committed together with the results of the file.
+    """
+
+    def __init__(self, context, parser_factory, instrument_uid=None,
+                 artoapply="received_tobeverified", override="nooverride"):
+        self.context = context
+        self.parser_factory = parser_factory
+        self.instrument_uid = instrument_uid
+        self.artoapply = artoapply
+        self.results_override = override
+        self.sample_states = SAMPLE_STATES[artoapply]
+        self.override = OVERRIDE[override]
+
+    def parse(self, path):
+        """Parses the file and returns its report, with the parser
+        """
+        report = dict(filename=os.path.basename(path), parser=None,
+                      cache_key=None, errors=[], warns=[], log=[],
+                      parse_seconds=0.0, import_seconds=0.0)
+        start = time()
+        try:
+            infile = read_file(path)
+            parser = self.parser_factory(infile)
+            key = report["cache_key"] = cache_key(
+                file_checksum(infile), parser, self.artoapply,
+                self.results_override)
+            use_parse_cache(parser, key)
+            parsed = parser.parse()
+            # the importer calls parse() again, give it the result instead
+            parser.parse = lambda: parsed
+            report["parser"] = parser
+        except Exception as error:
+            report["errors"].extend([repr(error), traceback.format_exc()])
+        report["parse_seconds"] = time() - start
+        return report
+
+    def apply(self, report):
+        """Imports the results of the parsed file and commits them
+        """
+        parser = report.pop("parser")
+        key = report.pop("cache_key")
+        if parser is None:
+            # drop what the parser wrote before it failed
+            transaction.abort()
+            logger.warn("Could not parse %s" % report["filename"])
+            return report
+        importer = AnalysisResultsImporter(
+            parser=parser,
+            context=self.context,
+            allowed_sample_states=self.sample_states,
+            allowed_analysis_states=None,
+            override=self.override,
+            instrument_uid=self.instrument_uid,
+        )
+        keep_fresh(importer, key)
+        start = time()
+        try:
+            importer.process()
+            report["errors"].extend(importer.errors)
+            report["warns"].extend(importer.warns)
+            report["log"].extend(importer.logs)
+            transaction.commit()
+        except Exception as error:
+            transaction.abort()
+            report["errors"].extend([repr(error), traceback.format_exc()])
+        report["import_seconds"] = time() - start
+        logger.info("Imported %s: %s errors, %s warnings" % (
+            report["filename"], len(report["errors"]), len(report["warns"])))
+        return report
+
+    def run(self, folder):
+        """Imports the files of the folder and yields a report for each one
+        """
+        for path in list_files(folder):
+            yield self.apply(self.parse(path))
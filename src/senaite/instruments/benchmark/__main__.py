@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.INSTRUMENTS.
+#
+# SENAITE.CORE is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright 2018-2019 by it's authors.
+# Some rights reserved, see README and LICENSE.
+
+import argparse
+import json
+import sys
+
+from senaite.instruments.benchmark.files import INSTRUMENTS
+from senaite.instruments.benchmark.runner import SIZES
+from senaite.instruments.benchmark.runner import format_header
+from senaite.instruments.benchmark.runner import format_row
+from senaite.instruments.benchmark.runner import run
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark the results file parsers")
+    parser.add_argument(
+        "--instruments", default=",".join(INSTRUMENTS),
+        help="comma separated instruments, default: all of them")
+    parser.add_argument(
+        "--sizes", default=",".join(map(str, SIZES)),
+        help="comma separated numbers of samples, default: %(default)s")
+    parser.add_argument(
+        "--json", action="store_true",
+        help="print one JSON object per run instead of a table")
+    args = parser.parse_args(argv)
+
+    instruments = args.instruments.split(",")
+    unknown = set(instruments).difference(INSTRUMENTS)
+    if unknown:
+        parser.error("unknown instruments: %s" % ", ".join(sorted(unknown)))
+    sizes = [int(size) for size in args.sizes.split(",")]
+
+    if not args.json:
+        print(format_header())
+    for instrument in instruments:
+        for size in sizes:
+            stats = run(instrument, size)
+            if args.json:
+                print(json.dumps(stats, sort_keys=True))
+            else:
+                print(format_row(stats))
+            sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    main()
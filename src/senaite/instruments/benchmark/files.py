@@ -0,0 +1,320 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.INSTRUMENTS.
+#
+# SENAITE.CORE is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright 2018-2019 by it's authors.
+# Some rights reserved, see README and LICENSE.
+
+"""Synthetic results files in the layout of each instrument
+
+Every generator takes the Sample IDs to write results for and returns a Case
+with the files, the analyses each Sample needs in the catalog and a factory
+for the parser of the files. The layouts follow the fixtures in tests/files.
+"""
+
+import csv
+import random
+from collections import OrderedDict
+from cStringIO import StringIO
+from io import BytesIO
+
+from openpyxl import Workbook
+from senaite.instruments.instruments.bika.software.software import \
+    SoftwareParser
+from senaite.instruments.instruments.bruker.s8tiger.s8tiger import \
+    S8TigerParser
+from senaite.instruments.instruments.fulcrum.fulcrumapp.fulcrumapp import \
+    FulcrumAppParser
+from senaite.instruments.instruments.hach.dr3900.dr3900 import DR3900Parser
+from senaite.instruments.instruments.perkinelmer.avio.avio import AvioParser
+from senaite.instruments.instruments.perkinelmer.lactoscope.\
+    lactoscopeh23061316 import LactoscopeH23061316COMPParser
+from senaite.instruments.instruments.perkinelmer.syngistix.syngistix import \
+    SyngistixParser
+from senaite.instruments.instruments.pg.dv5000icp.dv5000 import \
+    DV5000ICPParser
+from senaite.instruments.instruments.xcalibur.instrument import \
+    XCaliburCSVParser
+from senaite.instruments.instruments.xrf.xrf.xrf import XRFTXTParser2
+
+# Bika Software workbooks hold two columns per Sample
+SOFTWARE_SAMPLES_PER_FILE = 1000
+
+
+class Case(object):
+    """The results files of an instrument for a set of Samples
+    """
+
+    def __init__(self, files, analyses, parser):
+        # list of (filename, data)
+        self.files = files
+        # list of (keyword, title, interims) every Sample has
+        self.analyses = analyses
+        # callable that returns the parser of an uploaded file
+        self.parser = parser
+
+
+def sample_ids(count, prefix="BM"):
+    return ["%s-%05d" % (prefix, num) for num in range(1, count + 1)]
+
+
+def readings(count, seed=0):
+    rand = random.Random(seed)
+    return [round(rand.uniform(0.01, 100), 3) for num in range(count)]
+
+
+def to_xlsx(*sheets):
+    """Returns the xlsx data of the (title, rows) sheets
+    """
+    wb = Workbook(write_only=True)
+    for title, rows in sheets:
+        sheet = wb.create_sheet(title)
+        for row in rows:
+            sheet.append(row)
+    out = BytesIO()
+    wb.save(out)
+    return out.getvalue()
+
+
+def to_csv(rows, delimiter=","):
+    out = StringIO()
+    writer = csv.writer(out, delimiter=delimiter, lineterminator="\r\n")
+    for row in rows:
+        writer.writerow(row)
+    return out.getvalue()
+
+
+def syngistix(ids):
+    analytes = [("Li", "610.362"), ("Mn", "403.075"), ("K", "766.490"),
+                ("Ca", "317.933"), ("Fe", "238.863"), ("Mg", "279.077")]
+    header = [" ", "Sample Id", "R", "Acquisition Time", "A/S Loc",
+              "QC Status", "Dataset File", "Method File"]
+    header += ["%s %s\n(mg/L)" % analyte for analyte in analytes]
+    rows = [header]
+    for num, sample_id in enumerate(ids, 1):
+        rows.append([num, sample_id, None, "31/03/2025 1:31:44 AM",
+                     str(num), None, "Benchmark", "Benchmark Method"] +
+                    readings(len(analytes), num))
+    data = to_xlsx(("Conc. in Sample Units", rows))
+    return Case(
+        [("syngistix.xlsx", data)],
+        [(kw, kw, ["Reading"]) for kw, wavelength in analytes],
+        lambda infile: SyngistixParser(
+            infile, worksheet="Conc. in Sample Units"))
+
+
+def avio(ids):
+    analytes = ["U 424.167", "Fe 238.863", "Ca 315.887", "Mg 279.077"]
+    header = [" ", "Sample Id", "R", "Acquisition Time", "QC Status",
+              "Dataset File", "Method File"]
+    header += ["%s\n(mg/L)" % analyte for analyte in analytes]
+    rows = [header]
+    for num, sample_id in enumerate(ids, 1):
+        rows.append([num, sample_id, "", "2026/07/23 01:34:00", "", "",
+                     "MULTI ELEMENT"] + readings(len(analytes), num))
+    data = to_xlsx(("Corrected Intensities", [header]),
+                   ("Conc. in Sample Units", rows))
+    keywords = [analyte.replace(" ", "").replace(".", "")
+                for analyte in analytes]
+    return Case(
+        [("avio.xlsx", data)],
+        [(kw, kw, []) for kw in keywords],
+        AvioParser)
+
+
+def dv5000(ids):
+    analytes = ["Ca396.847-A", "Fe259.940-A", "K769.896-A", "Mg280.271-A",
+                "Na330.237-A", "Si251.612-A"]
+    rows = [[None] + analytes, [None] + ["ppm"] * len(analytes)]
+    for num, sample_id in enumerate(ids, 1):
+        rows.append(["%s 5/22/2026 8:01:33" % sample_id])
+        values = readings(len(analytes), num)
+        for replicate in ["1", "2", "3"]:
+            rows.append([replicate] + ["%.3f" % value for value in values])
+        rows.append([u"χ"] + ["%.3f" % value for value in values])
+        rows.append([u"σ"] + ["0.001"] * len(analytes))
+        rows.append(["RSD%"] + ["0.1"] * len(analytes))
+    data = to_xlsx(("Result", rows), ("OriginalData", []))
+    keywords = [analyte.replace(".", "") for analyte in analytes]
+    return Case(
+        [("dv5000.xlsx", data)],
+        [(kw, kw, []) for kw in keywords],
+        DV5000ICPParser)
+
+
+def dr3900(ids):
+    parameters = ["FNU", "COD", "TSS"]
+    lines = [
+        u"DR3900 ,S/N 2150436",
+        u"Instrument Version:,1.28",
+        u"Parameter:,Date:,Operator ID:,Sample ID:,Sample Number,"
+        u"Sampling Date:,Sampling Operator:,Program,Dilution,Lot #:,"
+        u"Date of Expiry:,Result,Unit,Name,Error,AQA,Lot #:,Date of Expiry:,"
+        u"Multiple Determination,Comment:,Wavelength1,Value1,Unit1",
+    ]
+    for num, sample_id in enumerate(ids, 1):
+        values = readings(len(parameters), num)
+        for parameter, value in zip(parameters, values):
+            lines.append(
+                u"%s,2022/06/21 21:46:09,,%s,,2022/06/20 00:00:00,,P656,"
+                u"1.0000,,,%s,mg/L,SiO₂,,,,,,,452, 0.298,Abs," % (
+                    parameter, sample_id, value))
+    text = u"".join([u'"%s"\r\n' % line for line in lines])
+    return Case(
+        [("dr3900.csv", text.encode("utf-16"))],
+        [(kw, kw, ["Reading", "Factor"]) for kw in parameters],
+        DR3900Parser)
+
+
+def xrf(ids):
+    analytes = ["SiO2", "Al2O3", "Fe2O3", "CaO", "MgO", "SO3", "Na2O", "K2O"]
+    first = ["  ", "", "", "", "", "", "", ""]
+    second = ["Nr", "Ident", "Seq", "Time", "Pos", "Ini wgt", "Fin wgt",
+              "L.O.I."]
+    for analyte in analytes:
+        first.extend([analyte, "    "])
+        second.extend(["C", "Unit"])
+    lines = ["\t".join(first) + "\t", "\t".join(second) + "\t"]
+    for num, sample_id in enumerate(ids, 1):
+        row = [str(num), sample_id, "1 of 1", "17-Apr-2024 09:28:27", "3",
+               "0.600", "6.600", "0.000"]
+        for value in readings(len(analytes), num):
+            row.extend([str(value), "%"])
+        lines.append("\t".join(row) + "\t")
+    return Case(
+        [("xrf.txt", "\n".join(lines) + "\n")],
+        [(kw, kw, []) for kw in analytes],
+        XRFTXTParser2)
+
+
+def xcalibur(ids):
+    keywords = ["Ca", "Fe", "Mg", "Na", "K"]
+    lines = [",".join(["Sample"] + keywords + ["end"])]
+    for num, sample_id in enumerate(ids, 1):
+        values = [str(value) for value in readings(len(keywords), num)]
+        lines.append(",".join([sample_id] + values + [""]))
+    lines.append("end")
+    return Case(
+        [("xcalibur.csv", "\r\n".join(lines) + "\r\n")],
+        [(kw, kw, []) for kw in keywords],
+        XCaliburCSVParser)
+
+
+def s8tiger(ids):
+    formulas = ["SiO2", "Al2O3", "Fe2O3", "CaO", "MgO", "SO3", "TiO2"]
+    header = ["Formula", "Concentration", "Z", "Status", "Line 1",
+              "Net int.", "LLD", "Stat. error", "Analyzed layer", "Bound %"]
+    files = []
+    for num, sample_id in enumerate(ids, 1):
+        rows = [header]
+        for formula, value in zip(formulas, readings(len(formulas), num)):
+            rows.append([formula, "%s %%" % value, "14", "XRF 1",
+                         "Si KA1-HR-Tr", "60.63", "211.9 PPM", "0.73%",
+                         "2.52 um", ""])
+        files.append(("%s.csv" % sample_id, to_csv(rows)))
+    return Case(
+        files,
+        [(kw, kw, []) for kw in formulas],
+        S8TigerParser)
+
+
+def lactoscope(ids):
+    predicted = [("Fat", "% m/m"), ("Protein", "% m/m"),
+                 ("Lactose", "% m/m"), ("Solids", "% m/m"),
+                 ("pH", "-"), ("MUN", "mg/100g"), ("Conductivity", "mS")]
+    header = ["Product Name", "Date/Time of Analysis", "Sample ID",
+              "Instrument Serial Number"]
+    header += ["Predicted %s %s" % item for item in predicted]
+    header += ["Lab", "Warning"]
+    rows = [header]
+    for num, sample_id in enumerate(ids, 1):
+        rows.append(["Milk", "2023/06/13 15:07:56", sample_id, "878929"] +
+                    readings(len(predicted), num) + ["No", ""])
+    data = to_xlsx(("Report", rows))
+    return Case(
+        [("lactoscope.xlsx", data)],
+        [("Predicted%s" % name, name, []) for name, unit in predicted],
+        LactoscopeH23061316COMPParser)
+
+
+def fulcrum(ids):
+    keywords = ["controller_conductivity", "field_conductivity_",
+                "calibration_percent", "controller_ph", "field_ph_",
+                "controller_orp", "free_available_halogen",
+                "total_available_halogen", "controller_tracer_type",
+                "controller_tracer_type_other", "controller_tracer_value",
+                "controller_ptsa_value", "controller_trasar_value",
+                "controller_tag_value"]
+    rows = [["fulcrum_id", "barcode_ct"] + keywords]
+    for num, sample_id in enumerate(ids, 1):
+        rows.append([str(num), sample_id] + readings(len(keywords), num))
+    return Case(
+        [("fulcrum.csv", to_csv(rows))],
+        [(kw, kw, []) for kw in keywords],
+        FulcrumAppParser)
+
+
+def software(ids):
+    analytes = ["Bromide", "Chloride", "Silica", "Sulfate", "Calcium",
+                "Magnesium"]
+    address = ["Phoenix Environmental Laboratories, Inc.",
+               "587 East Middle Turnpike", "P.O. Box 370",
+               "Manchester, CT 06040", "(860) 645-1102"]
+    files = []
+    for start in range(0, len(ids), SOFTWARE_SAMPLES_PER_FILE):
+        chunk = ids[start:start + SOFTWARE_SAMPLES_PER_FILE]
+        labels = [[address[0]], [address[1]],
+                  [address[2], "Lab Sample Id", ""],
+                  [address[3], "Collection Date", ""],
+                  [address[4], "Client Id", ""],
+                  ["", "Matrix", ""],
+                  ["Project Id : Benchmark"],
+                  ["", "CAS", "Units"]]
+        for sample_id in chunk:
+            labels[2].extend([sample_id, ""])
+            labels[3].extend(["2022/03/30", ""])
+            labels[4].extend([sample_id, ""])
+            labels[5].extend(["Water", ""])
+            labels[7].extend(["Result", "RL"])
+        rows = labels + [["Miscellaneous/Inorganics"]]
+        for num, analyte in enumerate(analytes):
+            row = [analyte, "7440-70-2", "mg/L"]
+            for value in readings(len(chunk), num):
+                row.extend([str(value), "0.5"])
+            rows.append(row)
+        comments = [[line] for line in address] + [
+            [""], ["Lab Sample Id", "Sample Comments"]]
+        comments += [[sample_id, "No Comments"] for sample_id in chunk]
+        data = to_xlsx(("Results", rows), ("Comments", comments))
+        files.append(("software-%s.xlsx" % len(files), data))
+    return Case(
+        files,
+        [(analyte, analyte, []) for analyte in analytes],
+        lambda infile: SoftwareParser(infile, None))
+
+
+INSTRUMENTS = OrderedDict([
+    ("syngistix", syngistix),
+    ("avio", avio),
+    ("dv5000", dv5000),
+    ("dr3900", dr3900),
+    ("xrf", xrf),
+    ("xcalibur", xcalibur),
+    ("s8tiger", s8tiger),
+    ("lactoscope", lactoscope),
+    ("fulcrum", fulcrum),
+    ("software", software),
+])
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.INSTRUMENTS.
+#
+# SENAITE.CORE is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright 2018-2019 by it's authors.
+# Some rights reserved, see README and LICENSE.
+
+import gc
+import json
+import os
+import sys
+from cStringIO import StringIO
+from time import time
+
+from senaite.instruments.benchmark.files import INSTRUMENTS
+from senaite.instruments.benchmark.files import sample_ids
+from senaite.instruments.instrument import FileStub
+from senaite.instruments.profiling import QueryCounter
+from senaite.instruments.stubcatalog import StubCatalog
+from zope.publisher.browser import FileUpload
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+SIZES = (10, 100, 1000, 10000)
+
+# (key, title, width, decimals) of the report columns
+COLUMNS = [
+    ("instrument", "instrument", 11, None),
+    ("samples", "samples", 8, None),
+    ("files", "files", 6, None),
+    ("kbytes", "kB", 8, None),
+    ("seconds", "seconds", 8, 3),
+    ("samples_per_second", "samples/s", 10, 0),
+    ("results", "results", 8, None),
+    ("peak_mb", "peak MB", 8, 1),
+    ("queries", "queries", 8, None),
+    ("duplicates", "dup.", 6, None),
+    ("wakeups", "wake-ups", 9, None),
+    ("warns", "warns", 6, None),
+]
+
+
+def get_rss_kb():
+    """Returns the resident memory of the process in kB
+    """
+    with open("/proc/self/statm") as statm:
+        pages = int(statm.read().split()[1])
+    return pages * resource.getpagesize() / 1024
+
+
+def get_peak_rss_kb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        # reported in bytes instead of kB
+        peak /= 1024
+    return peak
+
+
+def make_case(instrument, count):
+    """Returns the generated case and a stub catalog with its Samples
+    """
+    ids = sample_ids(count)
+    case = INSTRUMENTS[instrument](ids)
+    catalog = StubCatalog()
+    for sample_id in ids:
+        catalog.add_sample(sample_id, case.analyses)
+    return case, catalog
+
+
+def parse(case, catalog):
+    """Runs the parser over every file of the case and returns the numbers
+    """
+    uploads = [FileUpload(FileStub(file=StringIO(data), name=filename))
+               for filename, data in case.files]
+    stats = dict(files=len(uploads), results=0, warns=0, errors=0,
+                 kbytes=sum([len(data) for name, data in case.files]) / 1024)
+    with catalog:
+        with QueryCounter() as counter:
+            start = time()
+            for upload in uploads:
+                parser = case.parser(upload)
+                parser.parse()
+                stats["results"] += parser.getResultsTotalCount()
+                stats["warns"] += len(parser.warns)
+                stats["errors"] += len(parser.errors)
+            stats["seconds"] = time() - start
+    stats["queries"] = len(counter)
+    stats["duplicates"] = sum(counter.duplicates.values())
+    stats["wakeups"] = counter.wakeups
+    return stats
+
+
+def run(instrument, count):
+    """Benchmarks the parser of the instrument with a file of count Samples
+
+    The files are generated first, the parser then runs in a forked process
+    so its peak memory is measured on its own.
+    """
+    case, catalog = make_case(instrument, count)
+    gc.collect()
+    stats = None
+    if resource is not None and hasattr(os, "fork") and \
+            os.path.exists("/proc/self/statm"):
+        read_end, write_end = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            # the child never returns, a failure is parsed again inline below
+            try:
+                os.close(read_end)
+                start_rss = get_rss_kb()
+                stats = parse(case, catalog)
+                stats["peak_mb"] = (get_peak_rss_kb() - start_rss) / 1024.0
+                with os.fdopen(write_end, "w") as out:
+                    out.write(json.dumps(stats))
+            finally:
+                os._exit(0)
+        os.close(write_end)
+        with os.fdopen(read_end) as result:
+            output = result.read()
+        os.waitpid(pid, 0)
+        if output:
+            stats = json.loads(output)
+    if stats is None:
+        stats = parse(case, catalog)
+        stats["peak_mb"] = None
+
+    stats["instrument"] = instrument
+    stats["samples"] = count
+    stats["samples_per_second"] = count / max(stats["seconds"], 1e-6)
+    return stats
+
+
+def format_cells(texts):
+    cells = []
+    for text, (key, title, width, decimals) in zip(texts, COLUMNS):
+        if key == "instrument":
+            cells.append(text.ljust(width))
+        else:
+            cells.append(text.rjust(width))
+    return " ".join(cells)
+
+
+def format_header():
+    return format_cells([title for key, title, width, decimals in COLUMNS])
+
+
+def format_row(stats):
+    texts = []
+    for key, title, width, decimals in COLUMNS:
+        value = stats.get(key)
+        if value is None:
+            texts.append("-")
+        elif decimals is None:
+            texts.append("%s" % value)
+        else:
+            texts.append("%.*f" % (decimals, value))
+    return format_cells(texts)
@@ -1,11 +1,21 @@
+import codecs
+import csv
+import hashlib
 import types
+from contextlib import contextmanager
+from itertools import chain
 
 from openpyxl import load_workbook
+from openpyxl.cell.read_only import EMPTY_CELL
+from senaite.instruments.profiling import FILE_DECODE
+from senaite.instruments.profiling import ROW_PARSING
+from senaite.instruments.profiling import SPREADSHEET_LOAD
+from senaite.instruments.profiling import timed
+from senaite.instruments.rawresults import CompactResultsMixin
 from senaite.core.exportimport.instruments.resultsimport import \
     InstrumentResultsFileParser
 from cStringIO import StringIO
 from xlrd import open_workbook
-from zope.publisher.browser import FileUpload
 
 
 def xls_to_csv(infile, worksheet=0, delimiter=","):
@@ -15,14 +25,10 @@ def xls_to_csv(infile, worksheet=0, delimiter=","):
     convenience of the CSV library
 
     """
-
-    def find_sheet(wb, worksheet):
-        for sheet in wb.sheets():
-            if sheet.name == worksheet:
-                return sheet
-
-    wb = open_workbook(file_contents=infile.read())
-    sheet = wb.sheets()[worksheet]
+    wb = load_xls_workbook(infile)
+    sheet = get_xls_sheet(wb, worksheet)
+    if sheet is None:
+        raise SheetNotFound(worksheet)
 
     buffer = StringIO()
 
@@ -47,31 +53,363 @@ class SheetNotFound(Exception):
     """
 
 
-def xlsx_to_csv(infile, worksheet=0, delimiter=",", data_only=True):
-    wb = load_workbook(filename=infile, data_only=data_only)
+# workbooks kept open by workbook_cache, by id of the upload
+_workbooks = {}
+
 
-    if isinstance(worksheet, int):
-        if worksheet >= len(wb.sheetnames):
-            return
-        worksheet = wb.sheetnames[worksheet]
-    if worksheet not in wb.sheetnames:
+@contextmanager
+def workbook_cache(infile):
+    """
+    Keeps the workbooks loaded from infile open until the block is left
+
+    Parsers reading several sheets of an upload, or reading a sheet again,
+    parse the file once instead of once per sheet
+    """
+    key = id(infile)
+    if key in _workbooks:
+        # nested block for the same upload
+        yield
         return
+    _workbooks[key] = {}
+    try:
+        yield
+    finally:
+        for wb in _workbooks.pop(key).values():
+            close_workbook(wb)
+
+
+def _load_workbook(infile, key, load):
+    cache = _workbooks.get(id(infile))
+    if cache is None:
+        with timed(SPREADSHEET_LOAD):
+            return load()
+    if key not in cache:
+        infile.seek(0)
+        with timed(SPREADSHEET_LOAD):
+            cache[key] = load()
+    return cache[key]
+
+
+def load_xlsx_workbook(infile, data_only=True):
+    """
+    Returns the read-only openpyxl workbook of infile
+    """
+    return _load_workbook(
+        infile, ("xlsx", data_only),
+        lambda: load_workbook(
+            filename=infile, read_only=True, data_only=data_only))
+
+
+def load_xls_workbook(infile):
+    """
+    Returns the xlrd workbook of infile
+    """
+    return _load_workbook(
+        infile, ("xls", ),
+        lambda: open_workbook(file_contents=infile.read()))
+
+
+def close_workbook(wb):
+    """
+    Closes an openpyxl workbook, or releases the resources of a xlrd one
+    """
+    if hasattr(wb, "release_resources"):
+        wb.release_resources()
+    else:
+        wb.close()
+
+
+def release_workbook(infile, wb):
+    """
+    Closes wb unless it is kept open by workbook_cache
+    """
+    cache = _workbooks.get(id(infile))
+    if cache is None or wb not in cache.values():
+        close_workbook(wb)
+
+
+def get_xlsx_sheet(wb, worksheet=0):
+    """
+    Returns the worksheet of an openpyxl workbook by name or index, or None
+    """
+    if worksheet in wb.sheetnames:
+        return wb[worksheet]
+    try:
+        return wb.worksheets[int(worksheet)]
+    except (ValueError, TypeError, IndexError):
+        return None
+
+
+def get_xls_sheet(wb, worksheet=0):
+    """
+    Returns the worksheet of a xlrd workbook by name or index, or None
+    """
+    if worksheet in wb.sheet_names():
+        return wb.sheet_by_name(worksheet)
+    try:
+        return wb.sheet_by_index(int(worksheet))
+    except (ValueError, TypeError, IndexError):
+        return None
+
+
+def iter_xlsx_rows(infile, worksheet=0, data_only=True):
+    """
+    Yields the rows of a xlsx worksheet as tuples of cells
+
+    The workbook is opened in read-only mode, so rows are parsed from the file
+    while they are consumed instead of loading all cells and styles at once.
+    Raises SheetNotFound when the worksheet is not in the workbook.
+    """
+    wb = load_xlsx_workbook(infile, data_only=data_only)
+    try:
+        sheet = get_xlsx_sheet(wb, worksheet)
+        if sheet is None:
+            raise SheetNotFound(worksheet)
+        # Pad the rows to the declared number of columns. iter_rows returns
+        # a new generator, so a sheet of a cached workbook can be read again
+        width = sheet.max_column or 0
+        for row in sheet.iter_rows():
+            if len(row) < width:
+                row = tuple(row) + (EMPTY_CELL, ) * (width - len(row))
+            yield row
+    finally:
+        release_workbook(infile, wb)
 
-    sheet = wb[worksheet]
 
+def xlsx_to_csv(infile, worksheet=0, delimiter=",", data_only=True):
     buffer = StringIO()
-    for row in sheet.rows:
+    try:
+        for row in iter_xlsx_rows(infile, worksheet, data_only=data_only):
+            line = []
+            for cell in row:
+                value = "" if cell.value is None else str(cell.value).encode("utf8")  # noqa
+                if "\n" in value:  # fixme multi-line cell gives only 1st line
+                    value = value.split("\n")[0]
+                line.append(value.strip())
+            if not any(line):
+                continue
+            buffer.write(delimiter.join(line) + "\n")
+    except SheetNotFound:
+        return
+    buffer.seek(0)
+    return buffer
+
+
+def cell_text(cell):
+    """
+    Returns the value of a xlsx cell as an utf8 encoded, stripped string
+    """
+    value = cell.value
+    if value is None:
+        return ""
+    if isinstance(value, unicode):
+        return value.encode("utf8").strip()
+    return str(value).strip()
+
+
+def percent_cell_text(cell):
+    """
+    Returns the value of a xlsx cell as text, with the cells formatted as
+    "0.00%" written as percentages
+    """
+    if cell.number_format == "0.00%" and cell.value is not None:
+        return "{}%".format(cell.value * 100)
+    return cell_text(cell)
+
+
+def iter_xlsx_text_rows(infile, worksheet=0, cell_text=cell_text,
+                        data_only=False):
+    """
+    Yields the non-empty rows of a xlsx worksheet as lists of strings
+
+    With data_only, formula cells give the value last computed by the
+    spreadsheet application instead of the formula.
+    """
+    for row in iter_xlsx_rows(infile, worksheet, data_only=data_only):
+        line = [cell_text(cell) for cell in row]
+        if any(line):
+            yield line
+
+
+def iter_xls_text_rows(infile, worksheet=0):
+    """
+    Yields the rows of a xls worksheet as lists of strings
+    """
+    wb = load_xls_workbook(infile)
+    sheet = get_xls_sheet(wb, worksheet)
+    if sheet is None:
+        raise SheetNotFound(worksheet)
+    for row in sheet.get_rows():
         line = []
         for cell in row:
-            value = "" if cell.value is None else str(cell.value).encode("utf8")  # noqa
-            if "\n" in value:  # fixme multi-line cell gives only first line
-                value = value.split("\n")[0]
-            line.append(value.strip())
-        if not any(line):
+            value = cell.value
+            if isinstance(value, unicode):
+                value = value.encode("utf8")
+            line.append("" if value is None else str(value))
+        yield line
+
+
+# file formats told apart by detect_format
+XLSX = "xlsx"
+XLS = "xls"
+CSV = "csv"
+UTF16_CSV = "utf-16"
+
+ZIP_MAGIC = "PK\x03\x04"
+OLE2_MAGIC = "\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1"
+
+
+def detect_format(infile):
+    """
+    Returns the format of an upload from its first bytes
+
+    Zip archives are xlsx workbooks and OLE2 compound documents are xls
+    workbooks. Text starting with an utf-16 byte order mark is UTF16_CSV,
+    other text is CSV. Returns None for other binary data. The file is
+    rewound after reading.
+    """
+    infile.seek(0)
+    head = infile.read(512)
+    infile.seek(0)
+    if isinstance(head, unicode):
+        return CSV
+    if head.startswith(ZIP_MAGIC):
+        return XLSX
+    if head.startswith(OLE2_MAGIC):
+        return XLS
+    if head.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+        return UTF16_CSV
+    if "\x00" in head:
+        return None
+    return CSV
+
+
+def file_checksum(infile, chunk_size=65536):
+    """
+    Returns the SHA-256 hex digest of the content of an upload
+
+    The file is read in chunks and rewound afterwards.
+    """
+    checksum = hashlib.sha256()
+    infile.seek(0)
+    while True:
+        data = infile.read(chunk_size)
+        if not data:
+            break
+        if isinstance(data, unicode):
+            data = data.encode("utf-8")
+        checksum.update(data)
+    infile.seek(0)
+    return checksum.hexdigest()
+
+
+def iter_text_lines(infile, chunk_size=65536):
+    """
+    Yields the lines of a text file as unicode strings, without line endings
+
+    The encoding is taken from the byte order mark, utf-8 otherwise. The file
+    is decoded in a single pass, chunk by chunk, and bytes that can not be
+    decoded are left out
+    """
+    # the first chunk holds the byte order mark
+    chunk = infile.read(max(chunk_size, 4))
+    encoding = "utf-8"
+    if chunk.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+        encoding = "utf-16"
+    elif chunk.startswith(codecs.BOM_UTF8):
+        encoding = "utf-8-sig"
+    decoder = codecs.getincrementaldecoder(encoding)(errors="ignore")
+    pending = u""
+    while chunk:
+        with timed(FILE_DECODE):
+            lines = (pending + decoder.decode(chunk)).split(u"\n")
+        pending = lines.pop()
+        for line in lines:
+            yield line.rstrip(u"\r")
+        chunk = infile.read(chunk_size)
+    pending += decoder.decode("", final=True)
+    if pending:
+        yield pending.rstrip(u"\r")
+
+
+def ascii_cells(row):
+    """
+    Returns the cells of a row of iter_rows with quotes and non-ascii
+    characters left out, like iter_ascii_rows does for text files
+    """
+    return [cell.decode("utf8", "ignore").replace(u'"', u"").encode(
+        "ascii", "ignore") for cell in row]
+
+
+def iter_ascii_rows(infile, delimiter=","):
+    """
+    Yields the lines of a text file split at the delimiter, with quotes and
+    non-ascii characters left out
+    """
+    for line in iter_text_lines(infile):
+        line = line.replace(u'"', u"").encode("ascii", "ignore")
+        yield line.split(delimiter)
+
+
+def iter_rows(infile, worksheet=0, delimiter=",", cell_text=cell_text,
+              data_only=False, file_format=None):
+    """
+    Returns an iterator over the rows of a xlsx, xls, csv or prn results file
+
+    Rows are lists of strings, read directly from the workbook or the text
+    file without converting the spreadsheet to csv text first, so multi-line
+    cells keep all their lines. The reader is the one of file_format, or
+    picked by detect_format, not by the file extension. data_only is passed
+    to the xlsx reader. Raises SheetNotFound when the worksheet is not in
+    the workbook and ValueError when the file is not a workbook or text.
+    """
+    if file_format is None:
+        file_format = detect_format(infile)
+    if file_format == CSV:
+        return csv.reader(iter(infile.readline, ""), delimiter=delimiter)
+    if file_format == UTF16_CSV:
+        lines = (line.encode("utf8") for line in iter_text_lines(infile))
+        return csv.reader(lines, delimiter=delimiter)
+    if file_format == XLSX:
+        rows = iter_xlsx_text_rows(
+            infile, worksheet, cell_text=cell_text, data_only=data_only)
+    elif file_format == XLS:
+        rows = iter_xls_text_rows(infile, worksheet)
+    else:
+        raise ValueError("Can't parse input file as XLS, XLSX, or CSV.")
+    # read the first row now, so that a missing sheet raises here
+    try:
+        first = next(rows)
+    except StopIteration:
+        return iter([])
+    return chain([first], rows)
+
+
+def iter_dict_rows(rows):
+    """
+    Yields (line number, row dict) tuples keyed by the first row, the same
+    way csv.DictReader does
+
+    Rows of a csv reader are numbered by its line_num, like DictReader
+    numbers them, a quoted cell may span several lines. Workbook rows are
+    numbered in turn.
+    """
+    rows = iter(rows)
+    fieldnames = next(rows, None)
+    if fieldnames is None:
+        return
+    size = len(fieldnames)
+    for line_num, row in enumerate(rows, 2):
+        if row == []:
             continue
-        buffer.write(delimiter.join(line) + "\n")
-    buffer.seek(0)
-    return buffer
+        line_num = int(getattr(rows, "line_num", line_num))
+        item = dict(zip(fieldnames, row))
+        if size < len(row):
+            item[None] = row[size:]
+        elif size > len(row):
+            for key in fieldnames[len(row):]:
+                item[key] = None
+        yield line_num, item
 
 
 class FileStub:
@@ -82,58 +420,45 @@ class FileStub:
         self.filename = name
 
 
-class InstrumentXLSResultsFileParser(InstrumentResultsFileParser):
+class InstrumentXLSResultsFileParser(CompactResultsMixin,
+                                     InstrumentResultsFileParser):
     """ Parser
     """
 
-    def __init__(self, infile, worksheet=0, encoding='xlsx', delimiter=None, data_only=False): # noqa
+    def __init__(self, infile, worksheet=0, encoding=None, delimiter=None,
+                 data_only=False):
+        """encoding is the format of the workbook, 'xlsx' or 'xls', detected
+        from the first bytes of the file when not given. With data_only, xlsx
+        formula cells give their last computed value.
+        """
+        encoding = (encoding or detect_format(infile) or "").lower()
         InstrumentResultsFileParser.__init__(self, infile, encoding.upper())
-        # Convert xls to csv
+        # the delimiter joins the cells for parsers reading text lines
         self._delimiter = delimiter if delimiter else "|"
         self._worksheet = worksheet
-        if encoding == 'xlsx':
-            csv_data = xlsx_to_csv(
-                infile,
-                worksheet=worksheet,
-                delimiter=self._delimiter,
-                data_only=data_only)
-        elif encoding == 'xls':
-            csv_data = xls_to_csv(
-                infile, worksheet=worksheet, delimiter=self._delimiter)
-
-        if not csv_data:
-            self._infile = None
-            self._csvfile = None
-            self.err("Could not load worksheet {}".format(worksheet)) # noqa
-            return
-
-        # adapt csv_data into a FileUpload for parse method
         self._infile = infile
-        stub = FileStub(file=csv_data, name=str(infile.filename))
-        self._csvfile = FileUpload(stub)
-
         self._encoding = encoding
+        self._data_only = data_only
         self._end_header = False
 
+    @timed(ROW_PARSING)
     def parse(self):
-        if self._csvfile is None:
+        infile = self._infile
+        try:
+            rows = iter_rows(infile, worksheet=self._worksheet,
+                             data_only=self._data_only,
+                             file_format=self._encoding)
+        except (SheetNotFound, ValueError):
+            self.err("Could not load worksheet {}".format(self._worksheet))
             return True
 
-        infile = self._csvfile
         self.log("Parsing worksheet '${worksheet}' of file '${file_name}'",
                  mapping={
                     "worksheet": self._worksheet,
                     "file_name": infile.filename
                  })
         jump = 0
-        # We test in import functions if the file was uploaded
-        try:
-            name = getattr(infile, 'filename', getattr(infile, 'name'))
-            f = open(name, 'rU')
-        except AttributeError:
-            f = infile
-
-        for line in f.readlines():
+        for row in rows:
             self._numline += 1
             if jump == -1:
                 # Something went wrong. Finish
@@ -144,13 +469,10 @@ class InstrumentXLSResultsFileParser(InstrumentResultsFileParser):
                 jump -= 1
                 continue
 
-            if not line or not line.strip():
+            if not row:
                 continue
 
-            line = line.strip()
-            jump = 0
-            if line:
-                jump = self._parseline(line)
+            jump = self._parserow([cell.strip() for cell in row])
 
         self.log(
             "End of file reached successfully: ${total_objects} objects, "
@@ -160,3 +482,11 @@ class InstrumentXLSResultsFileParser(InstrumentResultsFileParser):
                      "total_results": self.getResultsTotalCount()}
         )
         return True
+
+    def _parserow(self, row):
+        """ Parses a row of the worksheet, a list of the stripped cell texts
+
+        Returns the number of rows to jump, -1 to stop. Parsers written for
+        the csv text of the worksheet get the row joined by the delimiter.
+        """
+        return self._parseline(self._delimiter.join(row))
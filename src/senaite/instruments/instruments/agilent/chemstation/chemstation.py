@@ -9,12 +9,20 @@ from senaite.core.exportimport.instruments import IInstrumentAutoImportInterface
 from senaite.core.exportimport.instruments import IInstrumentExportInterface
 from senaite.core.exportimport.instruments import IInstrumentImportInterface
 from senaite.core.exportimport.instruments.utils import format_keyword
-from senaite.core.exportimport.instruments.resultsimport import AnalysisResultsImporter
 from bika.lims.utils import t
 from cStringIO import StringIO
 from DateTime import DateTime
 from plone.i18n.normalizer.interfaces import IIDNormalizer
 from senaite.instruments.instrument import InstrumentXLSResultsFileParser
+from senaite.instruments.numeric import EMPTY
+from senaite.instruments.numeric import NOT_DETECTED
+from senaite.instruments.numeric import NO_VALUE
+from senaite.instruments.numeric import parse_number
+from senaite.instruments.profiling import PROCESS
+from senaite.instruments.profiling import profiled_import
+from senaite.instruments.profiling import timed
+from senaite.instruments.queuedimport import queued_import
+from senaite.instruments.resultsimport import make_importer
 from zope.component import getUtility
 from zope.interface import implements
 
@@ -101,19 +109,19 @@ class ChemStationParser(InstrumentXLSResultsFileParser):
         self._end_header = False
         self._ar_id = None
 
-    def _parseline(self, line):
+    def _parserow(self, row):
         if self._end_header:
-            return self.parse_resultsline(line)
-        return self.parse_headerline(line)
+            return self.parse_resultsline(row)
+        return self.parse_headerline(row)
 
-    def parse_headerline(self, line):
-        """ Parses header lines
+    def parse_headerline(self, row):
+        """ Parses header rows
         """
         if self._end_header:
             # Header already processed
             return 0
 
-        splitted = [token.strip() for token in line.split(self._delimiter)]
+        splitted = row
         if len(filter(lambda x: len(x), splitted)) == 0:
             self._end_header = True
 
@@ -122,10 +130,10 @@ class ChemStationParser(InstrumentXLSResultsFileParser):
 
         return 0
 
-    def parse_resultsline(self, line):
-        """ Parses result lines
+    def parse_resultsline(self, row):
+        """ Parses result rows
         """
-        splitted = [token.strip() for token in line.split(self._delimiter)]
+        splitted = row
         if len(filter(lambda x: len(x), splitted)) == 0:
             return 0
 
@@ -168,13 +176,12 @@ class ChemStationParser(InstrumentXLSResultsFileParser):
         return 0
 
     def get_result(self, column_name, result, line):
-        result = str(result)
-        if result.startswith('--') or result == '' or result == 'ND':
+        value, flag = parse_number(str(result))
+        if flag in (EMPTY, NO_VALUE, NOT_DETECTED):
             return 0.0
 
-        if api.is_floatable(result):
-            result = api.to_float(result)
-            return result > 0.0 and result or 0.0
+        if flag is None:
+            return value > 0.0 and value or 0.0
 
         self.err("No valid number ${result} in column (${column_name})",
                  mapping={"result": result,
@@ -192,6 +199,8 @@ class chemstationimport(object):
         self.context = context
         self.request = None
 
+    @queued_import
+    @profiled_import
     def Import(self, context, request):
         """ Import Form
         """
@@ -231,7 +240,8 @@ class chemstationimport(object):
             elif override == 'overrideempty':
                 over = [True, True]
 
-            importer = AnalysisResultsImporter(
+            importer = make_importer(
+                request,
                 parser=parser,
                 context=context,
                 allowed_sample_states=status,
@@ -240,7 +250,8 @@ class chemstationimport(object):
                 instrument_uid=instrument)
             tbex = ''
             try:
-                importer.process()
+                with timed(PROCESS):
+                    importer.process()
                 errors = importer.errors
                 logs = importer.logs
                 warns = importer.warns
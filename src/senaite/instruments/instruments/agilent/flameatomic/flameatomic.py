@@ -18,36 +18,39 @@
 # Copyright 2018-2019 by it's authors.
 # Some rights reserved, see README and LICENSE.
 
-import re
 import json
-import types
 import traceback
-from cStringIO import StringIO
 from DateTime import DateTime
 from mimetypes import guess_type
-from openpyxl import load_workbook
 from os.path import abspath
-from os.path import splitext
-from xlrd import open_workbook
 from bika.lims.browser import BrowserView
 
 from senaite.core.exportimport.instruments import (
     IInstrumentAutoImportInterface, IInstrumentImportInterface
 )
-from senaite.core.exportimport.instruments.resultsimport import (
-    AnalysisResultsImporter)
 from senaite.core.exportimport.instruments.resultsimport import (
     InstrumentResultsFileParser)
 from senaite.core.exportimport.instruments import IInstrumentExportInterface
 
 from bika.lims import api
 from bika.lims import bikaMessageFactory as _
-from bika.lims.catalog import CATALOG_ANALYSIS_REQUEST_LISTING
-from senaite.core.catalog import ANALYSIS_CATALOG, SENAITE_CATALOG
-from senaite.instruments.instrument import FileStub
 from senaite.instruments.instrument import SheetNotFound
+from senaite.instruments.instrument import XLS
+from senaite.instruments.instrument import XLSX
+from senaite.instruments.instrument import ascii_cells
+from senaite.instruments.instrument import detect_format
+from senaite.instruments.instrument import iter_ascii_rows
+from senaite.instruments.instrument import iter_rows
+from senaite.instruments.instrument import percent_cell_text
+from senaite.instruments.rawresults import CompactResultsMixin
+from senaite.instruments.resolver import ResolverMixin
+from senaite.instruments.profiling import PROCESS
+from senaite.instruments.profiling import ROW_PARSING
+from senaite.instruments.profiling import profiled_import
+from senaite.instruments.profiling import timed
+from senaite.instruments.queuedimport import queued_import
+from senaite.instruments.resultsimport import make_importer
 from zope.interface import implements
-from zope.publisher.browser import FileUpload
 from zope.component import getUtility
 from plone.i18n.normalizer.interfaces import IIDNormalizer
 
@@ -64,7 +67,8 @@ class AnalysisNotFound(Exception):
     pass
 
 
-class FlameAtomicParser(InstrumentResultsFileParser):
+class FlameAtomicParser(ResolverMixin, CompactResultsMixin,
+                        InstrumentResultsFileParser):
     ar = None
 
     def __init__(self, infile, worksheet=None, encoding=None, delimiter=None):
@@ -74,109 +78,32 @@ class FlameAtomicParser(InstrumentResultsFileParser):
         self.analyses = None
         self.worksheet = worksheet if worksheet else 0
         self.infile = infile
-        self.csv_data = None
         self.sample_id = None
         self.processed_samples_class = []
         mimetype, encoding = guess_type(self.infile.filename)
         InstrumentResultsFileParser.__init__(self, infile, mimetype)
 
-    def xls_to_csv(self, infile, worksheet=0, delimiter=","):
-        """
-        Convert xlsx to easier format first, since we want to use the
-        convenience of the CSV library
-        """
-
-        wb = open_workbook(file_contents=infile.read())
-        sheet = wb.sheets()[worksheet]
-
-        buffer = StringIO()
-
-        # extract all rows
-        for row in sheet.get_rows():
-            line = []
-            for cell in row:
-                value = cell.value
-                if type(value) in types.StringTypes:
-                    value = value.encode("utf8")
-                if value is None:
-                    value = ""
-                line.append(str(value))
-            print >> buffer, delimiter.join(line)
-        buffer.seek(0)
-        return buffer
-
-    def xlsx_to_csv(self, infile, worksheet=None, delimiter=","):
-        worksheet = worksheet if worksheet else 0
-        wb = load_workbook(filename=infile)
-        if worksheet in wb.sheetnames:
-            sheet = wb[worksheet]
-        else:
-            try:
-                index = int(worksheet)
-                sheet = wb.worksheets[index]
-            except (ValueError, TypeError, IndexError):
-                raise SheetNotFound
-
-        buffer = StringIO()
-
-        for row in sheet.rows:
-            line = []
-            for cell in row:
-                new_val = ''
-                if cell.number_format == "0.00%":
-                    new_val = '{}%'.format(cell.value * 100)
-                cellval = new_val if new_val else cell.value
-                if (isinstance(cellval, (int, long, float))):
-                    value = "" if cellval is None else str(cellval).encode(
-                                    "utf8")
-                else:
-                    value = "" if cellval is None else cellval.encode(
-                                    "utf8")
-                if "\n" in value:
-                    value = value.split("\n")[0]
-                line.append(value.strip())
-            if not any(line):
-                continue
-            buffer.write(delimiter.join(line) + "\n")
-        buffer.seek(0)
-        return buffer
-
+    @timed(ROW_PARSING)
     def parse(self):
-        order = []
-        ext = splitext(self.infile.filename.lower())[-1]
-        if ext == ".xlsx":
-            order = (self.xlsx_to_csv, self.xls_to_csv)
-        elif ext == ".xls":
-            order = (self.xls_to_csv, self.xlsx_to_csv)
-        elif ext == ".csv" or ".prn":
-            self.csv_data = self.infile
-        if order:
-            for importer in order:
-                try:
-                    self.csv_data = importer(
-                        infile=self.infile,
-                        worksheet=self.worksheet,
-                        delimiter=self.delimiter,
-                    )
-                    break
-                except SheetNotFound:
-                    self.err(
-                        "Sheet not found in workbook: %s" % self.worksheet)
-                    return -1
-                except Exception as e:
-                    pass
-            else:
-                self.warn("Can't parse input file as XLS, XLSX, or CSV.")
+        file_format = detect_format(self.infile)
+        if file_format in (XLSX, XLS):
+            try:
+                rows = iter_rows(self.infile, self.worksheet,
+                                 cell_text=percent_cell_text)
+            except SheetNotFound:
+                self.err(
+                    "Sheet not found in workbook: %s" % self.worksheet)
                 return -1
-
-        stub = FileStub(file=self.csv_data, name=str(self.infile.filename))
-        self.csv_data = FileUpload(stub)
-
-        data = self.csv_data.read()
-        lines = self.data_cleaning(data, ext)
+            lines = [ascii_cells(self.split_cells(row)) for row in rows]
+        elif file_format:
+            lines = list(iter_ascii_rows(self.infile))
+        else:
+            self.warn("Can't parse input file as XLS, XLSX, or CSV.")
+            return -1
 
         analysis_round = 0
         sample_service, lines = self.parse_headerlines(lines)
+        self.prefetch([row[0] for row in lines if row])
 
         for row_nr, row in enumerate(lines):
             if "Mthode:" in row[0] or "Method:" in row[0]:
@@ -188,6 +115,14 @@ class FlameAtomicParser(InstrumentResultsFileParser):
                     analysis_round, row_nr)
         return 1
 
+    def split_cells(self, row):
+        """Splits the cells of a workbook row like the csv export does: only
+        the first line of multi-line cells holds the value, and the methods
+        header lists its services in one cell, separated by the delimiter
+        """
+        line = [cell.split("\n")[0].strip() for cell in row]
+        return self.delimiter.join(line).split(self.delimiter)
+
     def parse_row(self, row, sample_service, analysis_round, row_nr):
         sample_id = row[0]
         reading = row[1]
@@ -278,67 +213,11 @@ class FlameAtomicParser(InstrumentResultsFileParser):
         parsed.update({"DefaultResult": "Reading"})
         self._addRawResult(sample_id, {keyword: parsed})
 
-    @staticmethod
-    def extract_relevant_data(lines):
-        new_lines = []
-        for row in lines:
-            split_row = row.encode("ascii", "ignore").split(",")
-            new_lines.append(split_row)
-        return new_lines
-
-    def data_cleaning(self, data, ext):
-        decoded_data = self.try_utf8(data)
-        if decoded_data:
-            if ext == ".xlsx":
-                lines_with_parentheses = decoded_data.split("\n")
-            else:
-                lines_with_parentheses = decoded_data.split("\r\n")
-        else:
-            decoded_data = self.try_utf16(data)
-            if decoded_data:
-                if "\r\n" in decoded_data:
-                    lines_with_parentheses = data.decode(
-                                                'utf-16').split("\r\n")
-                elif "\n" in decoded_data:
-                    lines_with_parentheses = data.decode(
-                                                'utf-16').split("\n")
-                else:
-                    lines_with_parentheses = re.sub(
-                            r'[^\x00-\x7f]',
-                            r'', data).split("\r\n")  # if bad conversion
-            else:
-                if "\r\n" in data:
-                    lines_with_parentheses = re.sub(
-                            r'[^\x00-\x7f]', r'', data).split("\r\n")
-                else:
-                    lines_with_parentheses = re.sub(
-                            r'[^\x00-\x7f]', r'', data).split("\n")
-        lines = [i.replace('"', '') for i in lines_with_parentheses]
-
-        ascii_lines = self.extract_relevant_data(lines)
-        return ascii_lines
-
-    @staticmethod
-    def get_interim_fields(sample_id):
-        bc = api.get_tool(CATALOG_ANALYSIS_REQUEST_LISTING)
-        ar = bc(portal_type='AnalysisRequest', id=sample_id)
-        if len(ar) == 0:
-            ar = bc(
-                portal_type='AnalysisRequest', getClientSampleID=sample_id)
-        if len(ar) == 1:
-            obj = ar[0].getObject()
-            analyses = obj.getAnalyses(full_objects=True)
-            keywords = {}
-            for analysis_service in analyses:
-                for field in analysis_service.getInterimFields():
-                    interim_kw = field.get("keyword")
-                    as_kw = analysis_service.Keyword
-                    if interim_kw in keywords.keys():
-                        keywords[interim_kw].append(as_kw)
-                    else:
-                        keywords[interim_kw] = [as_kw]
-            return keywords
-        return {}
+    def get_interim_fields(self, sample_id):
+        sample_id = self.resolver.get_sample_id(sample_id)
+        if not sample_id:
+            return {}
+        return self.resolver.get_interims_map(sample_id)
 
     @staticmethod
     def parse_headerlines(lines):
@@ -355,40 +234,9 @@ class FlameAtomicParser(InstrumentResultsFileParser):
                 if len(row) > 3 and row[3]:
                     sample_service.append(row[3])
 
-    @staticmethod
-    def try_utf8(data):
-        """Returns a Unicode object on success, or None on failure"""
-        try:
-            return data.decode('utf-8')
-        except UnicodeDecodeError:
-            return None
-
-    @staticmethod
-    def try_utf16(data):
-        """Returns a Unicode object on success, or None on failure"""
-        try:
-            return data.decode('utf-16')
-        except UnicodeDecodeError:
-            return None
-
-    @staticmethod
-    def is_sample(sample_id):
-        query = dict(portal_type="AnalysisRequest", getId=sample_id)
-        brains = api.search(query, CATALOG_ANALYSIS_REQUEST_LISTING)
-        return True if brains else False
-
-    @staticmethod
-    def get_ar(sample_id):
-        query = dict(portal_type="AnalysisRequest", getId=sample_id)
-        brains = api.search(query, CATALOG_ANALYSIS_REQUEST_LISTING)
-        try:
-            return api.get_object(brains[0])
-        except IndexError:
-            pass
-
     def get_analysis(self, ar, kw):
         analyses = self.get_analyses(ar)
-        analyses = [v for k, v in analyses.items() if k == kw]
+        analyses = [analyses[kw]] if kw in analyses else []
         if len(analyses) < 1:
             self.log(' No analysis found matching keyword {}'.format(kw))
             return None
@@ -397,31 +245,13 @@ class FlameAtomicParser(InstrumentResultsFileParser):
             return None
         return analyses[0]
 
-    @staticmethod
-    def get_analyses(ar):
-        analyses = ar.getAnalyses()
-        return dict((a.getKeyword, a) for a in analyses)
-
-    @staticmethod
-    def is_analysis_group_id(analysis_group_id):
-        portal_types = ["DuplicateAnalysis", "ReferenceAnalysis"]
-        query = dict(
-            portal_type=portal_types,
-            getReferenceAnalysesGroupID=analysis_group_id
-        )
-        brains = api.search(query, ANALYSIS_CATALOG)
-        return True if brains else False
+    def get_analyses(self, ar):
+        return self.get_analysis_index(ar.getId()).by_keyword
 
-    @staticmethod
-    def get_duplicate_or_qc(analysis_id, sample_service, ):
-        portal_types = ["DuplicateAnalysis", "ReferenceAnalysis"]
-        query = dict(
-            portal_type=portal_types, getReferenceAnalysesGroupID=analysis_id
-        )
-        brains = api.search(query, ANALYSIS_CATALOG)
-        analyses = dict((a.getKeyword, a) for a in brains)
-        brains = [
-                v for k, v in analyses.items() if k == sample_service]
+    def get_duplicate_or_qc(self, analysis_id, sample_service):
+        analyses = self.get_analysis_index(analysis_id)
+        brains = [analyses[sample_service]] \
+            if sample_service in analyses else []
         if len(brains) < 1:
             msg = (
                 " No analysis found matching Keyword {}".format(
@@ -434,12 +264,8 @@ class FlameAtomicParser(InstrumentResultsFileParser):
             raise MultipleAnalysesFound(msg)
         return brains[0]
 
-    @staticmethod
-    def get_reference_sample(reference_sample_id, kw):
-        query = dict(
-            portal_type="ReferenceSample", getId=reference_sample_id
-        )
-        brains = api.search(query, SENAITE_CATALOG)
+    def get_reference_sample(self, reference_sample_id, kw):
+        brains = self.resolver.get_reference_samples(reference_sample_id)
         if len(brains) < 1:
             msg = ("No reference sample found matching Keyword {}".format(kw))
             raise AnalysisNotFound(msg)
@@ -448,15 +274,14 @@ class FlameAtomicParser(InstrumentResultsFileParser):
             raise MultipleAnalysesFound(msg)
         return brains[0]
 
-    @staticmethod
-    def get_reference_sample_analyses(reference_sample):
-        brains = reference_sample.getObject().getReferenceAnalyses()
-        return dict((a.getKeyword(), a) for a in brains)
+    def get_reference_sample_analyses(self, reference_sample):
+        index = self.get_analysis_index(reference_sample.getId)
+        return index.by_keyword
 
     def get_reference_sample_analysis(self, reference_sample, kw):
         kw = kw
         brains = self.get_reference_sample_analyses(reference_sample)
-        brains = [v for k, v in brains.items() if k == kw]
+        brains = [brains[kw]] if kw in brains else []
         if len(brains) < 1:
             msg = " No analysis found matching Keyword {}".format(kw)
             raise AnalysisNotFound(msg)
@@ -476,6 +301,8 @@ class flameatomicimport(object):
         self.request = None
 
     @staticmethod
+    @queued_import
+    @profiled_import
     def Import(context, request):
         errors = []
         logs = []
@@ -507,7 +334,8 @@ class flameatomicimport(object):
             elif override == "overrideempty":
                 over = [True, True]
 
-            importer = AnalysisResultsImporter(
+            importer = make_importer(
+                request,
                 parser=parser,
                 context=context,
                 allowed_sample_states=status,
@@ -517,7 +345,8 @@ class flameatomicimport(object):
             )
 
             try:
-                importer.process()
+                with timed(PROCESS):
+                    importer.process()
                 errors = importer.errors
                 logs = importer.logs
                 warns = importer.warns
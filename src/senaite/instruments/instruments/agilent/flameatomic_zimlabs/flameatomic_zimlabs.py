@@ -31,22 +31,22 @@ from senaite.core.exportimport.instruments import (
     IInstrumentAutoImportInterface, IInstrumentImportInterface
 )
 from senaite.core.exportimport.instruments import IInstrumentExportInterface
-from senaite.core.exportimport.instruments.resultsimport import (
-    AnalysisResultsImporter)
 from senaite.core.exportimport.instruments.resultsimport import (
     InstrumentResultsFileParser)
-from senaite.instruments.instrument import xls_to_csv
-from senaite.instruments.instrument import xlsx_to_csv
 
-from bika.lims import api
 from bika.lims import bikaMessageFactory as _
-from bika.lims.catalog import CATALOG_ANALYSIS_REQUEST_LISTING
-from senaite.core.catalog import ANALYSIS_CATALOG, SENAITE_CATALOG
-from senaite.instruments.instrument import FileStub
 from senaite.instruments.instrument import SheetNotFound
+from senaite.instruments.instrument import iter_rows
+from senaite.instruments.rawresults import CompactResultsMixin
+from senaite.instruments.resolver import ResolverMixin
+from senaite.instruments.profiling import PROCESS
+from senaite.instruments.profiling import ROW_PARSING
+from senaite.instruments.profiling import profiled_import
+from senaite.instruments.profiling import timed
+from senaite.instruments.queuedimport import queued_import
+from senaite.instruments.resultsimport import make_importer
 from re import subn
 from zope.interface import implements
-from zope.publisher.browser import FileUpload
 
 
 class SampleNotFound(Exception):
@@ -61,7 +61,8 @@ class AnalysisNotFound(Exception):
     pass
 
 
-class FlameAtomicZimlabsParser(InstrumentResultsFileParser):
+class FlameAtomicZimlabsParser(ResolverMixin, CompactResultsMixin,
+                               InstrumentResultsFileParser):
     ar = None
 
     def __init__(self, infile, worksheet=None, encoding=None, delimiter=None):
@@ -77,39 +78,19 @@ class FlameAtomicZimlabsParser(InstrumentResultsFileParser):
         mimetype, encoding = guess_type(self.infile.filename)
         InstrumentResultsFileParser.__init__(self, infile, mimetype)
 
+    @timed(ROW_PARSING)
     def parse(self):
-        order = []
-        ext = splitext(self.infile.filename.lower())[-1]
-        if ext == ".xlsx":  # check in flameatomic also
-            order = (xlsx_to_csv, xls_to_csv)
-        elif ext == ".xls":
-            order = (xls_to_csv, xlsx_to_csv)
-        elif ext == ".csv" or ext == ".prn":
-            self.csv_data = self.infile
-        if order:
-            for importer in order:
-                try:
-                    self.csv_data = importer(
-                        infile=self.infile,
-                        worksheet=self.worksheet,
-                        delimiter=self.delimiter,
-                    )
-                    break
-                except SheetNotFound:
-                    self.err(
-                        "Sheet not found in workbook: %s" % self.worksheet)
-                    return -1
-                except Exception as e:
-                    pass
-            else:
-                self.warn("Can't parse input file as XLS, XLSX, or CSV.")
-                return -1
-
-        stub = FileStub(file=self.csv_data, name=str(self.infile.filename))
-        self.csv_data = FileUpload(stub)
-        lines = self.csv_data.readlines()
-        result_lines = lines[8:]  # Only interested in row 9+
-        reader = [i.encode("ascii", "ignore").split(",") for i in result_lines]
+        try:
+            rows = iter_rows(self.infile, self.worksheet)
+        except SheetNotFound:
+            self.err("Sheet not found in workbook: %s" % self.worksheet)
+            return -1
+        except ValueError:
+            self.warn("Can't parse input file as XLS, XLSX, or CSV.")
+            return -1
+        reader = list(rows)[8:]  # Only interested in row 9+
+        self.prefetch([subn(r'[^\w\d\-_]*', '', row[1])[0]
+                       for row in reader if len(row) > 2])
         row_num = 9
         for row in reader:
             if len(row) > 2:
@@ -238,53 +219,14 @@ class FlameAtomicZimlabsParser(InstrumentResultsFileParser):
             portal_type = "ReferenceSample"
         return portal_type
 
-    @staticmethod
-    def is_reference_sample(reference_sample_id):
-        query = dict(portal_type="ReferenceSample", getId=reference_sample_id)
-        brains = api.search(query, SENAITE_CATALOG)
-        return True if brains else False
-
-    @staticmethod
-    def get_interim_fields(sample_id, portal_types):
-        bc = api.get_tool(CATALOG_ANALYSIS_REQUEST_LISTING)
-        ar = bc(portal_type=portal_types, id=sample_id)
-        if len(ar) == 0:
-            ar = bc(
-                portal_type=portal_types, getClientSampleID=sample_id)
-        if len(ar) == 1:
-            obj = ar[0].getObject()
-            analyses = obj.getAnalyses(full_objects=True)
-            keywords = {}
-            for analysis_service in analyses:
-                for field in analysis_service.getInterimFields():
-                    interim_kw = field.get("keyword")
-                    as_kw = analysis_service.Keyword
-                    if interim_kw in keywords.keys():
-                        keywords[interim_kw].append(as_kw)
-                    else:
-                        keywords[interim_kw] = [as_kw]
-            return keywords
-        return {}
+    def get_interim_fields(self, sample_id, portal_types):
+        sample_id = self.resolver.get_sample_id(sample_id)
+        if not sample_id:
+            return {}
+        return self.resolver.get_interims_map(sample_id)
 
-    @staticmethod
-    def get_duplicate_or_ref_interim_fields(sample_id, portal_types):
-        query = dict(
-            portal_type=portal_types, getReferenceAnalysesGroupID=sample_id
-        )
-        brains = api.search(query, "senaite_catalog_analysis")
-        if len(brains) > 0:
-            analyses = [a.getObject() for a in brains]
-            keywords = {}
-            for analysis_service in analyses:
-                for field in analysis_service.getInterimFields():
-                    interim_kw = field.get("keyword")
-                    as_kw = analysis_service.Keyword
-                    if interim_kw in keywords.keys():
-                        keywords[interim_kw].append(as_kw)
-                    else:
-                        keywords[interim_kw] = [as_kw]
-            return keywords
-        return {}
+    def get_duplicate_or_ref_interim_fields(self, sample_id, portal_types):
+        return self.resolver.get_interims_map(sample_id, portal_types)
 
     def process_interims(self, interims, kw, sample_id, result):
         as_kw = interims.get(kw)
@@ -315,55 +257,22 @@ class FlameAtomicZimlabsParser(InstrumentResultsFileParser):
         parsed.update({"DefaultResult": keyword})
         self._addRawResult(sample_id, {keyword: parsed})
 
-    @staticmethod
-    def is_sample(sample_id):
-        query = dict(portal_type="AnalysisRequest", getId=sample_id)
-        brains = api.search(query, CATALOG_ANALYSIS_REQUEST_LISTING)
-        return True if brains else False
+    def is_analysis_group_id_duplicate(self, analysis_group_id):
+        return self.resolver.is_analysis_group_id(
+            analysis_group_id, "DuplicateAnalysis")
 
-    @staticmethod
-    def is_analysis_group_id_duplicate(analysis_group_id):
-        portal_types = "DuplicateAnalysis"
-        query = dict(
-            portal_type=portal_types,
-            getReferenceAnalysesGroupID=analysis_group_id
-        )
-        brains = api.search(query, "senaite_catalog_analysis")
-        return True if brains else False
+    def is_analysis_group_id_reference(self, analysis_group_id):
+        return self.resolver.is_analysis_group_id(
+            analysis_group_id, "ReferenceAnalysis")
 
-    @staticmethod
-    def is_analysis_group_id_reference(analysis_group_id):
-        portal_types = "ReferenceAnalysis"
-        query = dict(
-            portal_type=portal_types,
-            getReferenceAnalysesGroupID=analysis_group_id
-        )
-        brains = api.search(query, "senaite_catalog_analysis")
-        return True if brains else False
-
-    @staticmethod
-    def get_ar(sample_id):
-        query = dict(portal_type="AnalysisRequest", getId=sample_id)
-        brains = api.search(query, CATALOG_ANALYSIS_REQUEST_LISTING)
-        try:
-            return api.get_object(brains[0])
-        except IndexError:
-            pass
-
-    @staticmethod
-    def get_duplicate_analysis(analysis_id, sample_service,):
-        portal_types = "DuplicateAnalysis"
-        query = dict(
-            portal_type=portal_types, getReferenceAnalysesGroupID=analysis_id
-        )
-        brains = api.search(query, "senaite_catalog_analysis")
-        analyses = dict((a.getKeyword, a) for a in brains)
-        if len(brains) < 1:
+    def get_duplicate_analysis(self, analysis_id, sample_service,):
+        analyses = self.get_analysis_index(
+            analysis_id, "DuplicateAnalysis")
+        if len(analyses) < 1:
             msg = (" No sample found with ID {}".format(analysis_id))
             raise AnalysisNotFound(msg)
-        brains = [
-                v for k,
-                v in analyses.items() if k == sample_service]
+        brains = [analyses[sample_service]] \
+            if sample_service in analyses else []
         if len(brains) < 1:
             msg = (" No analysis found matching Keyword {}".format(
                                                         sample_service))
@@ -374,20 +283,14 @@ class FlameAtomicZimlabsParser(InstrumentResultsFileParser):
             raise MultipleAnalysesFound(msg)
         return brains[0]
 
-    @staticmethod
-    def get_reference_analysis(analysis_id, sample_service,):
-        portal_types = "ReferenceAnalysis"
-        query = dict(
-            portal_type=portal_types, getReferenceAnalysesGroupID=analysis_id
-        )
-        brains = api.search(query, "senaite_catalog_analysis")
-        analyses = dict((a.getKeyword, a) for a in brains)
-        if len(brains) < 1:
+    def get_reference_analysis(self, analysis_id, sample_service,):
+        analyses = self.get_analysis_index(
+            analysis_id, "ReferenceAnalysis")
+        if len(analyses) < 1:
             msg = (" No sample found with ID {}".format(analysis_id))
             raise AnalysisNotFound(msg)
-        brains = [
-                v for k,
-                v in analyses.items() if k == sample_service]
+        brains = [analyses[sample_service]] \
+            if sample_service in analyses else []
         if len(brains) < 1:
             msg = (" No analysis found matching Keyword {}".format(
                                                         sample_service))
@@ -403,7 +306,7 @@ class FlameAtomicZimlabsParser(InstrumentResultsFileParser):
         if len(analyses) < 1:
             msg = ' No sample found with ID {}'.format(ar)
             raise AnalysisNotFound(msg)
-        analyses = [v for k, v in analyses.items() if k == kw]
+        analyses = [analyses[kw]] if kw in analyses else []
         if len(analyses) < 1:
             msg = ' No analysis found matching keyword {}'.format(kw)
             raise AnalysisNotFound(msg)
@@ -412,10 +315,8 @@ class FlameAtomicZimlabsParser(InstrumentResultsFileParser):
             raise MultipleAnalysesFound(msg)
         return analyses[0]
 
-    @staticmethod
-    def get_analyses(ar):
-        analyses = ar.getAnalyses()
-        return dict((a.getKeyword, a) for a in analyses)
+    def get_analyses(self, ar):
+        return self.get_analysis_index(ar.getId()).by_keyword
 
 
 class flameatomiczimlabsimport(object):
@@ -428,6 +329,8 @@ class flameatomiczimlabsimport(object):
         self.request = None
 
     @staticmethod
+    @queued_import
+    @profiled_import
     def Import(context, request):
         errors = []
         logs = []
@@ -457,7 +360,8 @@ class flameatomiczimlabsimport(object):
             # ["unassigned","assigned","to_be_verified","rejected",
             # "retracted","verified","published","registered"] all of them
 
-            importer = AnalysisResultsImporter(
+            importer = make_importer(
+                request,
                 parser=parser,
                 context=context,
                 allowed_ar_states=status,
@@ -467,7 +371,8 @@ class flameatomiczimlabsimport(object):
             )
 
             try:
-                importer.process()
+                with timed(PROCESS):
+                    importer.process()
                 errors = importer.errors
                 logs = importer.logs
                 warns = importer.warns
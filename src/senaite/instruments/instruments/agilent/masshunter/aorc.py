@@ -7,10 +7,14 @@ from bika.lims import bikaMessageFactory as _
 from senaite.core.exportimport.instruments import IInstrumentAutoImportInterface
 from senaite.core.exportimport.instruments import IInstrumentImportInterface
 from senaite.core.exportimport.instruments.utils import format_keyword
-from senaite.core.exportimport.instruments.resultsimport import AnalysisResultsImporter
 from bika.lims.utils import t
 from DateTime import DateTime
 from senaite.instruments.instrument import InstrumentXLSResultsFileParser
+from senaite.instruments.profiling import PROCESS
+from senaite.instruments.profiling import profiled_import
+from senaite.instruments.profiling import timed
+from senaite.instruments.queuedimport import queued_import
+from senaite.instruments.resultsimport import make_importer
 from zope.interface import implements
 
 
@@ -21,29 +25,28 @@ class AORCParser(InstrumentXLSResultsFileParser):
         InstrumentXLSResultsFileParser.__init__(
             self, infile, worksheet=0, encoding=encoding)
         self._end_header = False
-        self._delimiter = '|'
         self._ar_id = None
         self._kw = None
         self._retentiontime = None
         self._retentiontimeref = None
         self._ions = []
 
-    def _parseline(self, line):
+    def _parserow(self, row):
         if self._end_header:
-            return self.parse_resultsline(line)
-        return self.parse_headerline(line)
+            return self.parse_resultsline(row)
+        return self.parse_headerline(row)
 
-    def parse_headerline(self, line):
+    def parse_headerline(self, row):
         """ Parse everything in parse_resultsline
         """
         self._end_header = True
 
         return 0
 
-    def parse_resultsline(self, line):
-        """ Parses result lines
+    def parse_resultsline(self, row):
+        """ Parses result rows
         """
-        splitted = [token.strip() for token in line.split(self._delimiter)]
+        splitted = row
         if len(filter(lambda x: len(x), splitted)) == 0:
             return 0
 
@@ -126,6 +129,8 @@ class aorcimport(object):
         self.context = context
         self.request = None
 
+    @queued_import
+    @profiled_import
     def Import(self, context, request):
         """ Import Form
         """
@@ -165,7 +170,8 @@ class aorcimport(object):
             elif override == 'overrideempty':
                 over = [True, True]
 
-            importer = AnalysisResultsImporter(
+            importer = make_importer(
+                request,
                 parser=parser,
                 context=context,
                 allowed_sample_states=status,
@@ -174,7 +180,8 @@ class aorcimport(object):
                 instrument_uid=instrument)
             tbex = ''
             try:
-                importer.process()
+                with timed(PROCESS):
+                    importer.process()
                 errors = importer.errors
                 logs = importer.logs
                 warns = importer.warns
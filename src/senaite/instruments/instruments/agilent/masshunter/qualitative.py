@@ -3,7 +3,6 @@ import traceback
 import xml.etree.cElementTree as ET
 from os.path import abspath
 
-from bika.lims import api
 from bika.lims import bikaMessageFactory as _
 from senaite.core.exportimport.instruments import IInstrumentAutoImportInterface
 from senaite.core.exportimport.instruments import IInstrumentExportInterface
@@ -15,12 +14,22 @@ from bika.lims.utils import t
 from DateTime import DateTime
 from plone.i18n.normalizer.interfaces import IIDNormalizer
 from senaite.app.supermodel.interfaces import ISuperModel
+from senaite.instruments.numeric import EMPTY
+from senaite.instruments.numeric import NOT_DETECTED
+from senaite.instruments.numeric import NO_VALUE
+from senaite.instruments.numeric import parse_number
+from senaite.instruments.profiling import PROCESS
+from senaite.instruments.profiling import profiled_import
+from senaite.instruments.profiling import timed
+from senaite.instruments.queuedimport import queued_import
+from senaite.instruments.rawresults import CompactResultsMixin
 from zope.component import getAdapter
 from zope.component import getUtility
 from zope.interface import implements
 
 
-class QualitativeParser(InstrumentCSVResultsFileParser):
+class QualitativeParser(CompactResultsMixin,
+                        InstrumentCSVResultsFileParser):
     """ Parser
     """
 
@@ -96,13 +105,12 @@ class QualitativeParser(InstrumentCSVResultsFileParser):
         return 0
 
     def get_result(self, column_name, result, line):
-        result = str(result)
-        if result.startswith('--') or result == '' or result == 'ND':
+        value, flag = parse_number(str(result))
+        if flag in (EMPTY, NO_VALUE, NOT_DETECTED):
             return 0.0
 
-        if api.is_floatable(result):
-            result = api.to_float(result)
-            return result > 0.0 and result or 0.0
+        if flag is None:
+            return value > 0.0 and value or 0.0
 
         self.err("No valid number ${result} in column (${column_name})",
                  mapping={"result": result,
@@ -124,6 +132,8 @@ class qualitativeimport(object):
         self.context = context
         self.request = None
 
+    @queued_import
+    @profiled_import
     def Import(self, context, request):
         """ Import Form
         """
@@ -173,7 +183,8 @@ class qualitativeimport(object):
             instrument_uid=instrument)
         tbex = ''
         try:
-            importer.process()
+            with timed(PROCESS):
+                importer.process()
             errors = importer.errors
             logs = importer.logs
             warns = importer.warns
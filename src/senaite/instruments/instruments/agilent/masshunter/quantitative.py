@@ -15,12 +15,18 @@ from bika.lims.utils import t
 from DateTime import DateTime
 from plone.i18n.normalizer.interfaces import IIDNormalizer
 from senaite.app.supermodel.interfaces import ISuperModel
+from senaite.instruments.profiling import PROCESS
+from senaite.instruments.profiling import profiled_import
+from senaite.instruments.profiling import timed
+from senaite.instruments.queuedimport import queued_import
+from senaite.instruments.rawresults import CompactResultsMixin
 from zope.component import getAdapter
 from zope.component import getUtility
 from zope.interface import implements
 
 
-class QuantitativeParser(InstrumentCSVResultsFileParser):
+class QuantitativeParser(CompactResultsMixin,
+                         InstrumentCSVResultsFileParser):
     """ Parser
     """
 
@@ -144,6 +150,8 @@ class quantitativeimport(object):
         self.context = context
         self.request = None
 
+    @queued_import
+    @profiled_import
     def Import(self, context, request):
         """ Import Form
         """
@@ -194,7 +202,8 @@ class quantitativeimport(object):
             instrument_uid=instrument)
         tbex = ''
         try:
-            importer.process()
+            with timed(PROCESS):
+                importer.process()
             errors = importer.errors
             logs = importer.logs
             warns = importer.warns
@@ -17,7 +17,6 @@
 #
 # Copyright 2018-2019 by it's authors.
 # Some rights reserved, see README and LICENSE.
-import re
 import csv
 import json
 import traceback
@@ -28,21 +27,28 @@ from os.path import splitext
 from senaite.core.exportimport.instruments import (
     IInstrumentAutoImportInterface, IInstrumentImportInterface
 )
-from senaite.core.exportimport.instruments.resultsimport import (
-    AnalysisResultsImporter)
 from senaite.core.exportimport.instruments.resultsimport import (
     InstrumentResultsFileParser)
-from senaite.instruments.instrument import xls_to_csv
-from senaite.instruments.instrument import xlsx_to_csv
 
 from bika.lims import api
 from bika.lims import bikaMessageFactory as _
-from bika.lims.catalog import CATALOG_ANALYSIS_REQUEST_LISTING
-from senaite.core.catalog import ANALYSIS_CATALOG, SENAITE_CATALOG
-from senaite.instruments.instrument import FileStub
 from senaite.instruments.instrument import SheetNotFound
+from senaite.instruments.instrument import XLS
+from senaite.instruments.instrument import XLSX
+from senaite.instruments.instrument import ascii_cells
+from senaite.instruments.instrument import detect_format
+from senaite.instruments.instrument import iter_ascii_rows
+from senaite.instruments.instrument import iter_rows
+from senaite.instruments.instrument import workbook_cache
+from senaite.instruments.rawresults import CompactResultsMixin
+from senaite.instruments.resolver import ResolverMixin
+from senaite.instruments.profiling import PROCESS
+from senaite.instruments.profiling import ROW_PARSING
+from senaite.instruments.profiling import profiled_import
+from senaite.instruments.profiling import timed
+from senaite.instruments.queuedimport import queued_import
+from senaite.instruments.resultsimport import make_importer
 from zope.interface import implements
-from zope.publisher.browser import FileUpload
 
 
 class SampleNotFound(Exception):
@@ -57,8 +63,11 @@ class AnalysisNotFound(Exception):
     pass
 
 
-class SoftwareParser(InstrumentResultsFileParser):
+class SoftwareParser(ResolverMixin, CompactResultsMixin,
+                     InstrumentResultsFileParser):
     ar = None
+    # the uncertainties are written to the analyses while parsing
+    writes_on_parse = True
 
     def __init__(
             self, infile, instrument, worksheet=None,
@@ -69,62 +78,45 @@ class SoftwareParser(InstrumentResultsFileParser):
         self.analyses = None
         self.worksheet = worksheet if worksheet else 0
         self.infile = infile
-        self.csv_data = None
-        self.csv_comments_data = None
         self.sample_id = None
         self.instrument_uid = instrument
         mimetype, encoding = guess_type(self.infile.filename)
         InstrumentResultsFileParser.__init__(self, infile, mimetype)
 
+    @timed(ROW_PARSING)
     def parse(self):
-        order = []
-        ext = splitext(self.infile.filename.lower())[-1]
-        if ext == ".xlsx":
-            order = (xlsx_to_csv, xls_to_csv)
-        elif ext == ".xls":
-            order = (xls_to_csv, xlsx_to_csv)
-        elif ext == ".csv" or ext == ".prn":
-            self.csv_data = self.infile
-        if order:
-            for importer in order:
+        file_format = detect_format(self.infile)
+        # results and comments are read from the same parsed workbook, one
+        # sheet after the other: streamed sheets share the file
+        with workbook_cache(self.infile):
+            if file_format in (XLSX, XLS):
+                sample_comments = self.comments_parser(
+                    ascii_cells(row) for row in self.read_comments())
                 try:
-                    self.csv_data = importer(
-                        infile=self.infile,
-                        worksheet=self.worksheet,
-                        delimiter=self.delimiter,
-                    )
-                    self.infile.seek(0)
-                    self.csv_comments_data = importer(
-                        infile=self.infile,
-                        worksheet=1,
-                        delimiter=self.delimiter,
-                    )
-                    break
+                    rows = iter_rows(self.infile, self.worksheet)
                 except SheetNotFound:
                     self.err(
                         "Sheet not found in workbook: %s" % self.worksheet)
                     return -1
-                except Exception as e:
-                    pass
+                rows = (ascii_cells(row) for row in rows)
+            elif file_format:
+                sample_comments = {}
+                rows = iter_ascii_rows(self.infile)
             else:
                 self.warn("Can't parse input file as XLS, XLSX, or CSV.")
                 return -1
-
-        stub = FileStub(
-            file=self.csv_data, name=str(self.infile.filename))
-        comments_stub = FileStub(
-            file=self.csv_comments_data, name=str(self.infile.filename))
-        self.csv_data = FileUpload(stub)
-        self.csv_comments_data = FileUpload(comments_stub)
-
-        comments_data = self.csv_comments_data.read()
-        data = self.csv_data.read()
-        lines = self.decode_read_data(data, ext)
-        comments_lines = self.decode_read_data(comments_data, ext)
-        sample_comments = self.comments_parser(comments_lines)
-        self.results_parser(lines, sample_comments)
+            self.results_parser(rows, sample_comments)
         return 1
 
+    def read_comments(self):
+        """Returns the rows of the comments sheet, workbooks without one have
+        no comments
+        """
+        try:
+            return iter_rows(self.infile, worksheet=1)
+        except SheetNotFound:
+            return []
+
     def comments_parser(self, data):
         sample_comments = {}
         for row_num, row in enumerate(data):
@@ -142,6 +134,7 @@ class SoftwareParser(InstrumentResultsFileParser):
                 sample_ids.pop(0)
                 if not sample_ids[-1]:
                     sample_ids.pop(-1)
+                self.prefetch(sample_ids)
             if row_num > 7:
                 if any(row[1:]):  # checking if all row elements are non empty
                     clean_row = row[::]
@@ -149,37 +142,6 @@ class SoftwareParser(InstrumentResultsFileParser):
                     clean_row.pop(1)
                     self.parse_row(clean_row, row_num, sample_ids, comments)
 
-    def decode_read_data(self, data, ext):
-        decoded_data = self.try_utf8(data)
-        if decoded_data:
-            if ext == ".xlsx" or ext == ".xls":
-                lines_with_parentheses = decoded_data.split("\n")
-            else:
-                lines_with_parentheses = decoded_data.split("\r\n")
-        else:
-            decoded_data = self.try_utf16(data)
-            if decoded_data:
-                if "\r\n" in decoded_data:
-                    lines_with_parentheses = data.decode(
-                        'utf-16').split("\r\n")
-                elif "\n" in decoded_data:
-                    lines_with_parentheses = data.decode(
-                        'utf-16').split("\n")
-                else:
-                    # if bad conversion
-                    lines_with_parentheses = re.sub(
-                        r'[^\x00-\x7f]', r'', data).split("\r\n")
-            else:
-                if "\r\n" in data:
-                    lines_with_parentheses = re.sub(
-                        r'[^\x00-\x7f]', r'', data).split("\r\n")
-                else:
-                    lines_with_parentheses = re.sub(
-                        r'[^\x00-\x7f]', r'', data).split("\n")
-        lines = [i.replace('"', '') for i in lines_with_parentheses]
-        ascii_lines = self.extract_relevant_data(lines)
-        return ascii_lines
-
     def parse_row(self, row, row_nr, sample_ids, comments):
         sample_service = row.pop(0)
         for indx, sample_id in enumerate(sample_ids):
@@ -224,16 +186,15 @@ class SoftwareParser(InstrumentResultsFileParser):
     def result_detection_limit(self, result, analysis):
         if '<' not in result and '>' not in result:
             return result
-        analysis_obj = analysis.getObject()
         operand = result[0]
         if operand == '<':
-            ldl = analysis_obj.getLowerDetectionLimit()
+            ldl = self.get_metadata(analysis, "getLowerDetectionLimit")
             if ldl:
                 result = float(ldl) - 1
             else:
                 result = -1
         elif operand == '>':
-            udl = analysis_obj.getUpperDetectionLimit()
+            udl = self.get_metadata(analysis, "getUpperDetectionLimit")
             if udl:
                 result = float(udl) + 1
             else:
@@ -249,44 +210,12 @@ class SoftwareParser(InstrumentResultsFileParser):
         instrument_title = instrument_obj.Title()  # use instrument name
         sample.setRemarks(api.safe_unicode(instrument_title + ": " + remark))
 
-    @staticmethod
-    def is_sample(sample_id):
-        query = dict(portal_type="AnalysisRequest", getId=sample_id)
-        brains = api.search(query, CATALOG_ANALYSIS_REQUEST_LISTING)
-        return True if brains else False
-
-    @staticmethod
-    def is_analysis_group_id(analysis_group_id):
-        portal_types = ["DuplicateAnalysis", "ReferenceAnalysis"]
-        query = dict(
-            portal_type=portal_types,
-            getReferenceAnalysesGroupID=analysis_group_id
-        )
-        brains = api.search(query, ANALYSIS_CATALOG)
-        return True if brains else False
-
-    @staticmethod
-    def get_ar(sample_id):
-        query = dict(portal_type="AnalysisRequest", getId=sample_id)
-        brains = api.search(query, CATALOG_ANALYSIS_REQUEST_LISTING)
-        try:
-            return api.get_object(brains[0])
-        except IndexError:
-            pass
-
-    @staticmethod
-    def get_duplicate_or_qc(analysis_id, sample_service,):
-        portal_types = ["DuplicateAnalysis", "ReferenceAnalysis"]
-        query = dict(
-            portal_type=portal_types, getReferenceAnalysesGroupID=analysis_id
-        )
-        brains = api.search(query, ANALYSIS_CATALOG)
-        analyses = dict((a.Title, a) for a in brains)
-        if len(brains) < 1:
+    def get_duplicate_or_qc(self, analysis_id, sample_service,):
+        analyses = self.get_analysis_index(analysis_id)
+        if len(analyses) < 1:
             msg = (" No sample found with ID {}".format(analysis_id))
             raise AnalysisNotFound(msg)
-        brains = [
-            v for k, v in analyses.items() if k.startswith(sample_service)]
+        brains = analyses.title_startswith(sample_service)
         if len(brains) < 1:
             msg = (
                 " No analysis found matching Title {}".format(
@@ -299,25 +228,14 @@ class SoftwareParser(InstrumentResultsFileParser):
             raise MultipleAnalysesFound(msg)
         return brains[0]
 
-    @staticmethod
-    def get_reference_sample(reference_sample_id, kw):
-        query = dict(
-            portal_type="ReferenceSample", getId=reference_sample_id
-        )  # This method might not be needed
-        brains = api.search(query, SENAITE_CATALOG)
-        if len(brains) < 1:
+    def get_reference_sample(self, reference_sample_id, kw):
+        brain = self.resolver.get_reference_sample(reference_sample_id)
+        if brain is None:
             msg = (
                 "No reference sample found with ID {}".format(
                     reference_sample_id))
             raise AnalysisNotFound(msg)
-        brains = [v for k, v in brains.items() if k == kw]
-        if len(brains) < 1:
-            msg = " No analysis found matching Keyword {}".format(kw)
-            raise AnalysisNotFound(msg)
-        if len(brains) > 1:
-            msg = ("Multiple brains found matching Keyword {}".format(kw))
-            raise MultipleAnalysesFound(msg)
-        return brains[0]
+        return brain
 
     def get_reference_sample_analysis(self, reference_sample, title):
         title = title
@@ -325,7 +243,7 @@ class SoftwareParser(InstrumentResultsFileParser):
         if len(brains) < 1:
             msg = ("No sample found with ID {}".format(reference_sample))
             raise AnalysisNotFound(msg)
-        brains = [v for k, v in brains.items() if k == title]
+        brains = [brains[title]] if title in brains else []
         if len(brains) < 1:
             msg = ("No analysis found matching Keyword {}".format(title))
             raise AnalysisNotFound(msg)
@@ -334,17 +252,16 @@ class SoftwareParser(InstrumentResultsFileParser):
             raise MultipleAnalysesFound(msg)
         return brains[0]
 
-    @staticmethod
-    def get_reference_sample_analyses(reference_sample):
-        brains = reference_sample.getObject().getReferenceAnalyses()
-        return dict((a.Title, a) for a in brains)
+    def get_reference_sample_analyses(self, reference_sample):
+        index = self.get_analysis_index(reference_sample.getId)
+        return index.by_title
 
     def get_analysis(self, ar, title):
         analyses = self.get_analyses(ar)
         if len(analyses) < 1:
             msg = ' No sample found with ID {}'.format(ar)
             raise AnalysisNotFound(msg)
-        analyses = [v for k, v in analyses.items() if k == title]
+        analyses = [analyses[title]] if title in analyses else []
         if len(analyses) < 1:
             msg = ' No analysis found matching keyword {}'.format(title)
             raise AnalysisNotFound(msg)
@@ -353,34 +270,8 @@ class SoftwareParser(InstrumentResultsFileParser):
             raise MultipleAnalysesFound(msg)
         return analyses[0]
 
-    @staticmethod
-    def get_analyses(ar):
-        analyses = ar.getAnalyses()
-        return dict((a.Title, a) for a in analyses)
-
-    @staticmethod
-    def extract_relevant_data(lines):
-        new_lines = []
-        for row in lines:
-            split_row = row.encode("ascii", "ignore").split(",")
-            new_lines.append(split_row)
-        return new_lines
-
-    @staticmethod
-    def try_utf8(data):
-        """Returns a Unicode object on success, or None on failure"""
-        try:
-            return data.decode('utf-8')
-        except UnicodeDecodeError:
-            return None
-
-    @staticmethod
-    def try_utf16(data):
-        """Returns a Unicode object on success, or None on failure"""
-        try:
-            return data.decode('utf-16')
-        except UnicodeDecodeError:
-            return None
+    def get_analyses(self, ar):
+        return self.get_analysis_index(ar.getId()).by_title
 
 
 class softwareimport(object):
@@ -393,6 +284,8 @@ class softwareimport(object):
         self.request = None
 
     @staticmethod
+    @queued_import
+    @profiled_import
     def Import(context, request):
         errors = []
         logs = []
@@ -428,7 +321,8 @@ class softwareimport(object):
             elif override == "overrideempty":
                 over = [True, True]
 
-            importer = AnalysisResultsImporter(
+            importer = make_importer(
+                request,
                 parser=parser,
                 context=context,
                 allowed_sample_states=status,
@@ -438,7 +332,8 @@ class softwareimport(object):
             )
 
             try:
-                importer.process()
+                with timed(PROCESS):
+                    importer.process()
                 errors = importer.errors
                 logs = importer.logs
                 warns = importer.warns
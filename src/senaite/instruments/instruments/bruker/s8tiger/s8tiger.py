@@ -17,35 +17,35 @@
 #
 # Copyright 2018-2019 by it's authors.
 # Some rights reserved, see README and LICENSE.
-import csv
 import json
-import types
 import traceback
-from cStringIO import StringIO
 from mimetypes import guess_type
-from openpyxl import load_workbook
 from os.path import abspath
 from os.path import basename
 from os.path import splitext
 from re import subn
-from xlrd import open_workbook
 
 from senaite.core.exportimport.instruments import (
     IInstrumentAutoImportInterface, IInstrumentImportInterface
 )
-from senaite.core.exportimport.instruments.resultsimport import (
-    AnalysisResultsImporter)
 from senaite.core.exportimport.instruments.resultsimport import (
     InstrumentResultsFileParser)
 
-from bika.lims import api
 from bika.lims import bikaMessageFactory as _
-from bika.lims.catalog import CATALOG_ANALYSIS_REQUEST_LISTING
-from senaite.core.catalog import ANALYSIS_CATALOG, SENAITE_CATALOG
-from senaite.instruments.instrument import FileStub
 from senaite.instruments.instrument import SheetNotFound
+from senaite.instruments.instrument import iter_rows
+from senaite.instruments.instrument import iter_dict_rows
+from senaite.instruments.instrument import percent_cell_text
+from senaite.instruments.numeric import parse_number
+from senaite.instruments.rawresults import CompactResultsMixin
+from senaite.instruments.resolver import ResolverMixin
+from senaite.instruments.profiling import PROCESS
+from senaite.instruments.profiling import ROW_PARSING
+from senaite.instruments.profiling import profiled_import
+from senaite.instruments.profiling import timed
+from senaite.instruments.queuedimport import queued_import
+from senaite.instruments.resultsimport import make_importer
 from zope.interface import implements
-from zope.publisher.browser import FileUpload
 
 field_interim_map = {
     "Formula": "formula",
@@ -73,7 +73,8 @@ class AnalysisNotFound(Exception):
     pass
 
 
-class S8TigerParser(InstrumentResultsFileParser):
+class S8TigerParser(ResolverMixin, CompactResultsMixin,
+                    InstrumentResultsFileParser):
     ar = None
 
     def __init__(self, infile, worksheet=None, encoding=None, delimiter=None):
@@ -88,96 +89,17 @@ class S8TigerParser(InstrumentResultsFileParser):
         mimetype, encoding = guess_type(self.infile.filename)
         InstrumentResultsFileParser.__init__(self, infile, mimetype)
 
-    def xls_to_csv(self, infile, worksheet=0, delimiter=","):
-        """
-        Convert xlsx to easier format first, since we want to use the
-        convenience of the CSV library
-
-        """
-
-        def find_sheet(wb, worksheet):
-            for sheet in wb.sheets():
-                if sheet.name == worksheet:
-                    return sheet
-
-        wb = open_workbook(file_contents=infile.read())
-        sheet = wb.sheets()[worksheet]
-
-        buffer = StringIO()
-
-        # extract all rows
-        for row in sheet.get_rows():
-            line = []
-            for cell in row:
-                value = cell.value
-                if type(value) in types.StringTypes:
-                    value = value.encode("utf8")
-                if value is None:
-                    value = ""
-                line.append(str(value))
-            print >> buffer, delimiter.join(line)
-        buffer.seek(0)
-        return buffer
-
-    def xlsx_to_csv(self, infile, worksheet=None, delimiter=","):
-        worksheet = worksheet if worksheet else 0
-        wb = load_workbook(filename=infile)
-        if worksheet in wb.sheetnames:
-            sheet = wb[worksheet]
-        else:
-            try:
-                index = int(worksheet)
-                sheet = wb.worksheets[index]
-            except (ValueError, TypeError, IndexError):
-                raise SheetNotFound
-
-        buffer = StringIO()
-        for row in sheet.rows:
-            line = []
-            for cell in row:
-                new_val = ''
-                if cell.number_format == "0.00%":
-                    new_val = '{}%'.format(cell.value * 100)
-                cellval = new_val if new_val else cell.value
-
-                value = "" if cellval is None else str(cellval).encode("utf8")
-                if "\n" in value:  # fixme multi-line cell gives only first line
-                    value = value.split("\n")[0]
-                line.append(value.strip())
-            if not any(line):
-                continue
-            buffer.write(delimiter.join(line) + "\n")
-        buffer.seek(0)
-        return buffer
-
+    @timed(ROW_PARSING)
     def parse(self):
-        order = []
-        ext = splitext(self.infile.filename.lower())[-1]
-        if ext == ".xlsx":
-            order = (self.xlsx_to_csv, self.xls_to_csv)
-        elif ext == ".xls":
-            order = (self.xls_to_csv, self.xlsx_to_csv)
-        elif ext == ".csv":
-            self.csv_data = self.infile
-        if order:
-            for importer in order:
-                try:
-                    self.csv_data = importer(
-                        infile=self.infile,
-                        worksheet=self.worksheet,
-                        delimiter=self.delimiter,
-                    )
-                    break
-                except SheetNotFound:
-                    self.err("Sheet not found in workbook: %s" % self.worksheet)
-                    return -1
-                except Exception as e:  # noqa
-                    pass
-            else:
-                self.warn("Can't parse input file as XLS, XLSX, or CSV.")
-                return -1
-        stub = FileStub(file=self.csv_data, name=str(self.infile.filename))
-        self.csv_data = FileUpload(stub)
+        try:
+            rows = iter_rows(
+                self.infile, self.worksheet, cell_text=percent_cell_text)
+        except SheetNotFound:
+            self.err("Sheet not found in workbook: %s" % self.worksheet)
+            return -1
+        except ValueError:
+            self.warn("Can't parse input file as XLS, XLSX, or CSV.")
+            return -1
 
         try:
             sample_id, ext = splitext(basename(self.infile.filename))
@@ -197,19 +119,18 @@ class S8TigerParser(InstrumentResultsFileParser):
         except Exception as e:
             self.err(repr(e))
             return False
-        lines = self.csv_data.readlines()
-        reader = csv.DictReader(lines)
+        reader = iter_dict_rows(rows)
         if portal_type == "AnalysisRequest":
-            for row in reader:
-                self.parse_ar_row(sample_id, reader.line_num, row)
+            for row_nr, row in reader:
+                self.parse_ar_row(sample_id, row_nr, row)
 
         elif portal_type in ["DuplicateAnalysis", "ReferenceAnalysis"]:
-            for row in reader:
-                self.parse_duplicate_row(sample_id, reader.line_num, row)
+            for row_nr, row in reader:
+                self.parse_duplicate_row(sample_id, row_nr, row)
 
         elif portal_type == "ReferenceSample":
-            for row in reader:
-                self.parse_reference_sample_row(sample_id, reader.line_num, row)
+            for row_nr, row in reader:
+                self.parse_reference_sample_row(sample_id, row_nr, row)
         return 1
 
     def get_portal_type(self, sample_id):
@@ -229,9 +150,8 @@ class S8TigerParser(InstrumentResultsFileParser):
         parsed = {field_interim_map.get(k, ""): v for k, v in row.items()}
         # Concentration can be PPM or PCT as it likes, I'll save both.
         concentration = parsed["concentration"]
-        try:
-            val = float(subn(r'[^.\d]', '', str(concentration))[0])
-        except (TypeError, ValueError, IndexError):
+        val = parse_number(str(concentration), strip=True)[0]
+        if val is None:
             self.warn(
                 msg="Can't extract numerical value from `concentration`",
                 numline=row_nr,
@@ -321,15 +241,9 @@ class S8TigerParser(InstrumentResultsFileParser):
         analysis = self.get_reference_sample_analysis(sample_reference, kw)
         return analysis.getKeyword()
 
-    @staticmethod
-    def get_duplicate_or_qc_analysis(analysis_id, kw):
-        portal_types = ["DuplicateAnalysis", "ReferenceAnalysis"]
-        query = dict(
-            portal_type=portal_types, getReferenceAnalysesGroupID=analysis_id
-        )
-        brains = api.search(query, ANALYSIS_CATALOG)
-        analyses = dict((a.getKeyword, a) for a in brains)
-        brains = [v for k, v in analyses.items() if k.startswith(kw)]
+    def get_duplicate_or_qc_analysis(self, analysis_id, kw):
+        analyses = self.get_analysis_index(analysis_id)
+        brains = analyses.startswith(kw)
         if len(brains) < 1:
             msg = ("No analysis found matching Keyword '${kw}'",)
             raise AnalysisNotFound(msg, kw=kw)
@@ -338,29 +252,11 @@ class S8TigerParser(InstrumentResultsFileParser):
             raise MultipleAnalysesFound(msg, kw=kw)
         return brains[0]
 
-    @staticmethod
-    def get_ar(sample_id):
-        query = dict(portal_type="AnalysisRequest", getId=sample_id)
-        brains = api.search(query, CATALOG_ANALYSIS_REQUEST_LISTING)
-        try:
-            return api.get_object(brains[0])
-        except IndexError:
-            pass
-
-    @staticmethod
-    def is_sample(sample_id):
-        query = dict(portal_type="AnalysisRequest", getId=sample_id)
-        brains = api.search(query, CATALOG_ANALYSIS_REQUEST_LISTING)
-        return True if brains else False
-
-    @staticmethod
-    def get_analyses(ar):
-        analyses = ar.getAnalyses()
-        return dict((a.getKeyword, a) for a in analyses)
+    def get_analyses(self, ar):
+        return self.get_analysis_index(ar.getId()).by_keyword
 
     def get_analysis(self, ar, kw):
-        analyses = self.get_analyses(ar)
-        analyses = [v for k, v in analyses.items() if k.startswith(kw)]
+        analyses = self.get_analysis_index(ar.getId()).startswith(kw)
         if len(analyses) < 1:
             self.log('No analysis found matching keyword "${kw}"', mapping=dict(kw=kw))
             return None
@@ -371,29 +267,8 @@ class S8TigerParser(InstrumentResultsFileParser):
             return None
         return analyses[0]
 
-    @staticmethod
-    def is_analysis_group_id(analysis_group_id):
-        portal_types = ["DuplicateAnalysis", "ReferenceAnalysis"]
-        query = dict(
-            portal_type=portal_types, getReferenceAnalysesGroupID=analysis_group_id
-        )
-        brains = api.search(query, ANALYSIS_CATALOG)
-        return True if brains else False
-
-    @staticmethod
-    def is_reference_sample(reference_sample_id):
-        query = dict(
-            portal_type="ReferenceSample", getId=reference_sample_id
-        )
-        brains = api.search(query, SENAITE_CATALOG)
-        return True if brains else False
-
-    @staticmethod
-    def get_reference_sample(reference_sample_id, kw):
-        query = dict(
-            portal_type="ReferenceSample", getId=reference_sample_id
-        )
-        brains = api.search(query, SENAITE_CATALOG)
+    def get_reference_sample(self, reference_sample_id, kw):
+        brains = self.resolver.get_reference_samples(reference_sample_id)
         if len(brains) < 1:
             msg = ("No reference sample found matching Keyword '${kw}'",)
             raise AnalysisNotFound(msg, kw=kw)
@@ -413,6 +288,8 @@ class importer(object):
         self.request = None
 
     @staticmethod
+    @queued_import
+    @profiled_import
     def Import(context, request):
         errors = []
         logs = []
@@ -443,7 +320,8 @@ class importer(object):
             elif override == "overrideempty":
                 over = [True, True]
 
-            importer = AnalysisResultsImporter(
+            importer = make_importer(
+                request,
                 parser=parser,
                 context=context,
                 allowed_sample_states=status,
@@ -453,7 +331,8 @@ class importer(object):
             )
 
             try:
-                importer.process()
+                with timed(PROCESS):
+                    importer.process()
                 errors = importer.errors
                 logs = importer.logs
                 warns = importer.warns
@@ -18,7 +18,6 @@
 # Copyright 2018-2019 by it's authors.
 # Some rights reserved, see README and LICENSE.
 import re
-import csv
 import json
 import traceback
 from mimetypes import guess_type
@@ -31,22 +30,23 @@ from senaite.core.exportimport.instruments import (
     IInstrumentAutoImportInterface, IInstrumentImportInterface
 )
 from senaite.core.exportimport.instruments import IInstrumentExportInterface
-from senaite.core.exportimport.instruments.resultsimport import (
-    AnalysisResultsImporter)
 from senaite.core.exportimport.instruments.resultsimport import (
     InstrumentResultsFileParser)
-from senaite.instruments.instrument import xls_to_csv
-from senaite.instruments.instrument import xlsx_to_csv
 
-from bika.lims import api
 from bika.lims import bikaMessageFactory as _
-from bika.lims.catalog import CATALOG_ANALYSIS_REQUEST_LISTING
-from senaite.core.catalog import ANALYSIS_CATALOG, SENAITE_CATALOG
-from senaite.instruments.instrument import FileStub
 from senaite.instruments.instrument import SheetNotFound
+from senaite.instruments.instrument import iter_rows
+from senaite.instruments.instrument import iter_dict_rows
+from senaite.instruments.rawresults import CompactResultsMixin
+from senaite.instruments.resolver import ResolverMixin
+from senaite.instruments.profiling import PROCESS
+from senaite.instruments.profiling import ROW_PARSING
+from senaite.instruments.profiling import profiled_import
+from senaite.instruments.profiling import timed
+from senaite.instruments.queuedimport import queued_import
+from senaite.instruments.resultsimport import make_importer
 from re import subn
 from zope.interface import implements
-from zope.publisher.browser import FileUpload
 
 
 class SampleNotFound(Exception):
@@ -61,7 +61,8 @@ class AnalysisNotFound(Exception):
     pass
 
 
-class FulcrumAppParser(InstrumentResultsFileParser):
+class FulcrumAppParser(ResolverMixin, CompactResultsMixin,
+                       InstrumentResultsFileParser):
     ar = None
 
     def __init__(self, infile, worksheet=None, encoding=None, delimiter=None):
@@ -77,42 +78,25 @@ class FulcrumAppParser(InstrumentResultsFileParser):
         mimetype, encoding = guess_type(self.infile.filename)
         InstrumentResultsFileParser.__init__(self, infile, mimetype)
 
+    @timed(ROW_PARSING)
     def parse(self):
-        order = []
-        ext = splitext(self.infile.filename.lower())[-1]
-        if ext == ".xlsx":  # check in flameatomic also
-            order = (xlsx_to_csv, xls_to_csv)
-        elif ext == ".xls":
-            order = (xls_to_csv, xlsx_to_csv)
-        elif ext == ".csv" or ext == ".prn":
-            self.csv_data = self.infile
-        if order:
-            for importer in order:
-                try:
-                    self.csv_data = importer(
-                        infile=self.infile,
-                        worksheet=self.worksheet,
-                        delimiter=self.delimiter,
-                    )
-                    break
-                except SheetNotFound:
-                    self.err(
-                        "Sheet not found in workbook: %s" % self.worksheet)
-                    return -1
-                except Exception as e:
-                    pass
-            else:
-                self.warn("Can't parse input file as XLS, XLSX, or CSV.")
-                return -1
-
-        stub = FileStub(file=self.csv_data, name=str(self.infile.filename))
-        self.csv_data = FileUpload(stub)
-        lines = self.csv_data.readlines()
-        reader = csv.DictReader(lines)
-        for row in reader:
-            results = self.get_result_values(row, reader.line_num)
+        try:
+            rows = iter_rows(self.infile, self.worksheet)
+        except SheetNotFound:
+            self.err("Sheet not found in workbook: %s" % self.worksheet)
+            return -1
+        except ValueError:
+            self.warn("Can't parse input file as XLS, XLSX, or CSV.")
+            return -1
+        results_rows = []
+        for row_num, row in iter_dict_rows(rows):
+            results = self.get_result_values(row, row_num)
             if results:
-                self.parse_row(results, reader.line_num)
+                results_rows.append((row_num, results))
+        rows = results_rows
+        self.prefetch([result.get("sample_id") for row_num, result in rows])
+        for row_num, results in rows:
+            self.parse_row(results, row_num)
         return 1
 
     def get_result_values(self, results, row_num):
@@ -268,33 +252,11 @@ class FulcrumAppParser(InstrumentResultsFileParser):
             portal_type = "ReferenceSample"
         return portal_type
 
-    @staticmethod
-    def is_reference_sample(reference_sample_id):
-        query = dict(portal_type="ReferenceSample", getId=reference_sample_id)
-        brains = api.search(query, SENAITE_CATALOG)
-        return True if brains else False
-
-    @staticmethod
-    def get_interim_fields(sample_id):
-        bc = api.get_tool(CATALOG_ANALYSIS_REQUEST_LISTING)
-        ar = bc(portal_type='AnalysisRequest', id=sample_id)
-        if len(ar) == 0:
-            ar = bc(
-                portal_type='AnalysisRequest', getClientSampleID=sample_id)
-        if len(ar) == 1:
-            obj = ar[0].getObject()
-            analyses = obj.getAnalyses(full_objects=True)
-            keywords = {}
-            for analysis_service in analyses:
-                for field in analysis_service.getInterimFields():
-                    interim_kw = field.get("keyword")
-                    as_kw = analysis_service.Keyword
-                    if interim_kw in keywords.keys():
-                        keywords[interim_kw].append(as_kw)
-                    else:
-                        keywords[interim_kw] = [as_kw]
-            return keywords
-        return {}
+    def get_interim_fields(self, sample_id):
+        sample_id = self.resolver.get_sample_id(sample_id)
+        if not sample_id:
+            return {}
+        return self.resolver.get_interims_map(sample_id)
 
     def process_interims(self, interims, kw, sample_id, result):
         as_kw = interims.get(kw)
@@ -324,45 +286,12 @@ class FulcrumAppParser(InstrumentResultsFileParser):
         parsed.update({"DefaultResult": keyword})
         self._addRawResult(sample_id, {keyword: parsed})
 
-    @staticmethod
-    def is_sample(sample_id):
-        query = dict(portal_type="AnalysisRequest", getId=sample_id)
-        brains = api.search(query, CATALOG_ANALYSIS_REQUEST_LISTING)
-        return True if brains else False
-
-    @staticmethod
-    def is_analysis_group_id(analysis_group_id):
-        portal_types = ["DuplicateAnalysis", "ReferenceAnalysis"]
-        query = dict(
-            portal_type=portal_types,
-            getReferenceAnalysesGroupID=analysis_group_id
-        )
-        brains = api.search(query, ANALYSIS_CATALOG)
-        return True if brains else False
-
-    @staticmethod
-    def get_ar(sample_id):
-        query = dict(portal_type="AnalysisRequest", getId=sample_id)
-        brains = api.search(query, CATALOG_ANALYSIS_REQUEST_LISTING)
-        try:
-            return api.get_object(brains[0])
-        except IndexError:
-            pass
-
-    @staticmethod
-    def get_duplicate_or_qc(analysis_id, sample_service,):
-        portal_types = ["DuplicateAnalysis", "ReferenceAnalysis"]
-        query = dict(
-            portal_type=portal_types, getReferenceAnalysesGroupID=analysis_id
-        )
-        brains = api.search(query, ANALYSIS_CATALOG)
-        analyses = dict((a.getKeyword, a) for a in brains)
-        if len(brains) < 1:
+    def get_duplicate_or_qc(self, analysis_id, sample_service):
+        analyses = self.get_analysis_index(analysis_id)
+        if len(analyses) < 1:
             msg = (" No sample found with ID {}".format(analysis_id))
             raise AnalysisNotFound(msg)
-        brains = [
-                v for k,
-                v in analyses.items() if k.startswith(sample_service)]
+        brains = analyses.startswith(sample_service)
         if len(brains) < 1:
             msg = (" No analysis found matching Keyword {}".format(
                                                         sample_service))
@@ -373,24 +302,14 @@ class FulcrumAppParser(InstrumentResultsFileParser):
             raise MultipleAnalysesFound(msg)
         return brains[0]
 
-    @staticmethod
-    def get_reference_sample(reference_sample_id, kw):
-        query = dict(
-            portal_type="ReferenceSample", getId=reference_sample_id
-        )
-        brains = api.search(query, SENAITE_CATALOG)
-        if len(brains) < 1:
-            msg = ("No reference sample found with ID {}".format(
-                                                        reference_sample_id))
-            raise AnalysisNotFound(msg)
-        brains = [v for k, v in brains.items() if k == kw]
-        if len(brains) < 1:
-            msg = " No analysis found matching Keyword {}".format(kw)
+    def get_reference_sample(self, reference_sample_id, kw):
+        brain = self.resolver.get_reference_sample(reference_sample_id)
+        if brain is None:
+            msg = (
+                "No reference sample found with ID {}".format(
+                    reference_sample_id))
             raise AnalysisNotFound(msg)
-        if len(brains) > 1:
-            msg = ("Multiple brains found matching Keyword {}".format(kw))
-            raise MultipleAnalysesFound(msg)
-        return brains[0]
+        return brain
 
     def get_reference_sample_analysis(self, reference_sample, kw):
         kw = kw
@@ -398,7 +317,7 @@ class FulcrumAppParser(InstrumentResultsFileParser):
         if len(brains) < 1:
             msg = ("No sample found with ID {}".format(reference_sample))
             raise AnalysisNotFound(msg)
-        brains = [v for k, v in brains.items() if k == kw]
+        brains = [brains[kw]] if kw in brains else []
         if len(brains) < 1:
             msg = ("No analysis found matching Keyword {}".format(kw))
             raise AnalysisNotFound(msg)
@@ -407,17 +326,16 @@ class FulcrumAppParser(InstrumentResultsFileParser):
             raise MultipleAnalysesFound(msg)
         return brains[0]
 
-    @staticmethod
-    def get_reference_sample_analyses(reference_sample):
-        brains = reference_sample.getObject().getReferenceAnalyses()
-        return dict((a.getKeyword(), a) for a in brains)
+    def get_reference_sample_analyses(self, reference_sample):
+        index = self.get_analysis_index(reference_sample.getId)
+        return index.by_keyword
 
     def get_analysis(self, ar, kw):
         analyses = self.get_analyses(ar)
         if len(analyses) < 1:
             msg = ' No sample found with ID {}'.format(ar)
             raise AnalysisNotFound(msg)
-        analyses = [v for k, v in analyses.items() if k == kw]
+        analyses = [analyses[kw]] if kw in analyses else []
         if len(analyses) < 1:
             msg = ' No analysis found matching keyword {}'.format(kw)
             raise AnalysisNotFound(msg)
@@ -426,10 +344,8 @@ class FulcrumAppParser(InstrumentResultsFileParser):
             raise MultipleAnalysesFound(msg)
         return analyses[0]
 
-    @staticmethod
-    def get_analyses(ar):
-        analyses = ar.getAnalyses()
-        return dict((a.getKeyword, a) for a in analyses)
+    def get_analyses(self, ar):
+        return self.get_analysis_index(ar.getId()).by_keyword
 
 
 class fulcrumappimport(object):
@@ -442,6 +358,8 @@ class fulcrumappimport(object):
         self.request = None
 
     @staticmethod
+    @queued_import
+    @profiled_import
     def Import(context, request):
         errors = []
         logs = []
@@ -471,7 +389,8 @@ class fulcrumappimport(object):
             # ["unassigned","assigned","to_be_verified","rejected",
             # "retracted","verified","published","registered"] all of them
 
-            importer = AnalysisResultsImporter(
+            importer = make_importer(
+                request,
                 parser=parser,
                 context=context,
                 allowed_sample_states=status,
@@ -481,7 +400,8 @@ class fulcrumappimport(object):
             )
 
             try:
-                importer.process()
+                with timed(PROCESS):
+                    importer.process()
                 errors = importer.errors
                 logs = importer.logs
                 warns = importer.warns
@@ -18,7 +18,6 @@
 # Copyright 2018-2019 by it's authors.
 # Some rights reserved, see README and LICENSE.
 import re
-import csv
 import json
 import traceback
 from mimetypes import guess_type
@@ -31,21 +30,28 @@ from senaite.core.exportimport.instruments import (
     IInstrumentAutoImportInterface, IInstrumentImportInterface
 )
 from senaite.core.exportimport.instruments import IInstrumentExportInterface
-from senaite.core.exportimport.instruments.resultsimport import (
-    AnalysisResultsImporter)
 from senaite.core.exportimport.instruments.resultsimport import (
     InstrumentResultsFileParser)
-from senaite.instruments.instrument import xls_to_csv
-from senaite.instruments.instrument import xlsx_to_csv
 
 from bika.lims import api
 from bika.lims import bikaMessageFactory as _
-from bika.lims.catalog import CATALOG_ANALYSIS_REQUEST_LISTING
-from senaite.core.catalog import ANALYSIS_CATALOG, SENAITE_CATALOG
-from senaite.instruments.instrument import FileStub
 from senaite.instruments.instrument import SheetNotFound
+from senaite.instruments.instrument import XLS
+from senaite.instruments.instrument import XLSX
+from senaite.instruments.instrument import ascii_cells
+from senaite.instruments.instrument import detect_format
+from senaite.instruments.instrument import iter_ascii_rows
+from senaite.instruments.instrument import iter_dict_rows
+from senaite.instruments.instrument import iter_rows
+from senaite.instruments.rawresults import CompactResultsMixin
+from senaite.instruments.resolver import ResolverMixin
+from senaite.instruments.profiling import PROCESS
+from senaite.instruments.profiling import ROW_PARSING
+from senaite.instruments.profiling import profiled_import
+from senaite.instruments.profiling import timed
+from senaite.instruments.queuedimport import queued_import
+from senaite.instruments.resultsimport import make_importer
 from zope.interface import implements
-from zope.publisher.browser import FileUpload
 
 field_interim_map = {"Dilution": "Factor", "Result": "Reading"}
 
@@ -62,7 +68,8 @@ class AnalysisNotFound(Exception):
     pass
 
 
-class DR3900Parser(InstrumentResultsFileParser):
+class DR3900Parser(ResolverMixin, CompactResultsMixin,
+                   InstrumentResultsFileParser):
     ar = None
 
     def __init__(self, infile, worksheet=None, encoding=None, delimiter=None):
@@ -72,86 +79,36 @@ class DR3900Parser(InstrumentResultsFileParser):
         self.analyses = None
         self.worksheet = worksheet if worksheet else 0
         self.infile = infile
-        self.csv_data = None
         self.sample_id = None
         self.processed_samples = []
         mimetype, encoding = guess_type(self.infile.filename)
         InstrumentResultsFileParser.__init__(self, infile, mimetype)
 
+    @timed(ROW_PARSING)
     def parse(self):
-        order = []
-        ext = splitext(self.infile.filename.lower())[-1]
-        if ext == ".xlsx":  # fix in flameatomic also
-            order = (xlsx_to_csv, xls_to_csv)
-        elif ext == ".xls":
-            order = (xls_to_csv, xlsx_to_csv)
-        elif ext == ".csv" or ext == ".prn":
-            self.csv_data = self.infile
-        if order:
-            for importer in order:
-                try:
-                    self.csv_data = importer(
-                        infile=self.infile,
-                        worksheet=self.worksheet,
-                        delimiter=self.delimiter,
-                    )
-                    break
-                except SheetNotFound:
-                    self.err(
-                        "Sheet not found in workbook: %s" % self.worksheet)
-                    return -1
-                except Exception as e:
-                    pass
-            else:
-                self.warn("Can't parse input file as XLS, XLSX, or CSV.")
+        file_format = detect_format(self.infile)
+        if file_format in (XLSX, XLS):
+            try:
+                rows = iter_rows(self.infile, self.worksheet)
+            except SheetNotFound:
+                self.err(
+                    "Sheet not found in workbook: %s" % self.worksheet)
                 return -1
-
-        stub = FileStub(file=self.csv_data, name=str(self.infile.filename))
-        self.csv_data = FileUpload(stub)
-        data = self.csv_data.read()
-
-        decoded_data = self.try_utf8(data)
-        if decoded_data:
-            if ext == ".xlsx":
-                lines_with_parentheses = decoded_data.split("\n")
-            else:
-                lines_with_parentheses = decoded_data.split("\r\n")
+            rows = (ascii_cells(row) for row in rows)
+        elif file_format:
+            rows = iter_ascii_rows(self.infile)
         else:
-            decoded_data = self.try_utf16(data)
-            if decoded_data:
-                if "\r\n" in decoded_data:
-                    lines_with_parentheses = data.decode(
-                                                'utf-16').split("\r\n")
-                elif "\n" in decoded_data:
-                    lines_with_parentheses = data.decode(
-                                                'utf-16').split("\n")
-                else:
-                    lines_with_parentheses = re.sub(
-                                        r'[^\x00-\x7f]',
-                                        r'',
-                                        data).split(
-                                                "\r\n")  # if bad conversion
-            else:
-                if "\r\n" in data:
-                    lines_with_parentheses = re.sub(
-                                        r'[^\x00-\x7f]',
-                                        r'',
-                                        data).split("\r\n")
-                else:
-                    lines_with_parentheses = re.sub(
-                                        r'[^\x00-\x7f]',
-                                        r'',
-                                        data).split("\n")
-        lines = [i.replace('"', '') for i in lines_with_parentheses]
-
-        ascii_lines = self.extract_relevant_data(lines)
-        reader = csv.DictReader(ascii_lines)
-
-        headers_parsed = self.parse_headerlines(reader)
+            self.warn("Can't parse input file as XLS, XLSX, or CSV.")
+            return -1
+
+        rows = self.extract_relevant_data(rows)
+        headers_parsed = self.parse_headerlines(rows)
 
         if headers_parsed:
-            for row in reader:
-                self.parse_row(row, reader.line_num)
+            rows = list(iter_dict_rows(rows))
+            self.prefetch([row.get("Sample ID:") for row_nr, row in rows])
+            for row_nr, row in rows:
+                self.parse_row(row, row_nr)
         return 1
 
     def parse_row(self, row, row_nr):
@@ -204,45 +161,12 @@ class DR3900Parser(InstrumentResultsFileParser):
         self._addRawResult(sample_ID, {keyword: parsed})
         return 0
 
-    @staticmethod
-    def is_sample(sample_id):
-        query = dict(portal_type="AnalysisRequest", getId=sample_id)
-        brains = api.search(query, CATALOG_ANALYSIS_REQUEST_LISTING)
-        return True if brains else False
-
-    @staticmethod
-    def is_analysis_group_id(analysis_group_id):
-        portal_types = ["DuplicateAnalysis", "ReferenceAnalysis"]
-        query = dict(
-            portal_type=portal_types,
-            getReferenceAnalysesGroupID=analysis_group_id
-        )
-        brains = api.search(query, ANALYSIS_CATALOG)
-        return True if brains else False
-
-    @staticmethod
-    def get_ar(sample_id):
-        query = dict(portal_type="AnalysisRequest", getId=sample_id)
-        brains = api.search(query, CATALOG_ANALYSIS_REQUEST_LISTING)
-        try:
-            return api.get_object(brains[0])
-        except IndexError:
-            pass
-
-    @staticmethod
-    def get_duplicate_or_qc(analysis_id, sample_service, ):
-        portal_types = ["DuplicateAnalysis", "ReferenceAnalysis"]
-        query = dict(
-            portal_type=portal_types, getReferenceAnalysesGroupID=analysis_id
-        )
-        brains = api.search(query, ANALYSIS_CATALOG)
-        analyses = dict((a.getKeyword, a) for a in brains)
-        if len(brains) < 1:
+    def get_duplicate_or_qc(self, analysis_id, sample_service):
+        analyses = self.get_analysis_index(analysis_id)
+        if len(analyses) < 1:
             msg = (" No sample found with ID {}".format(analysis_id))
             raise AnalysisNotFound(msg)
-        brains = [
-                v for k,
-                v in analyses.items() if k.startswith(sample_service)]
+        brains = analyses.startswith(sample_service)
         if len(brains) < 1:
             msg = (
                 " No analysis found matching Keyword {}".format(
@@ -255,25 +179,14 @@ class DR3900Parser(InstrumentResultsFileParser):
             raise MultipleAnalysesFound(msg)
         return brains[0]
 
-    @staticmethod
-    def get_reference_sample(reference_sample_id, kw):
-        query = dict(
-            portal_type="ReferenceSample", getId=reference_sample_id
-        )
-        brains = api.search(query, SENAITE_CATALOG)
-        if len(brains) < 1:
+    def get_reference_sample(self, reference_sample_id, kw):
+        brain = self.resolver.get_reference_sample(reference_sample_id)
+        if brain is None:
             msg = (
                 "No reference sample found with ID {}".format(
-                                                        reference_sample_id))
-            raise AnalysisNotFound(msg)
-        brains = [v for k, v in brains.items() if k == kw]
-        if len(brains) < 1:
-            msg = " No analysis found matching Keyword {}".format(kw)
+                    reference_sample_id))
             raise AnalysisNotFound(msg)
-        if len(brains) > 1:
-            msg = ("Multiple brains found matching Keyword {}".format(kw))
-            raise MultipleAnalysesFound(msg)
-        return brains[0]
+        return brain
 
     def get_reference_sample_analysis(self, reference_sample, kw):
         kw = kw
@@ -281,7 +194,7 @@ class DR3900Parser(InstrumentResultsFileParser):
         if len(brains) < 1:
             msg = ("No sample found with ID {}".format(reference_sample))
             raise AnalysisNotFound(msg)
-        brains = [v for k, v in brains.items() if k == kw]
+        brains = [brains[kw]] if kw in brains else []
         if len(brains) < 1:
             msg = ("No analysis found matching Keyword {}".format(kw))
             raise AnalysisNotFound(msg)
@@ -290,17 +203,16 @@ class DR3900Parser(InstrumentResultsFileParser):
             raise MultipleAnalysesFound(msg)
         return brains[0]
 
-    @staticmethod
-    def get_reference_sample_analyses(reference_sample):
-        brains = reference_sample.getObject().getReferenceAnalyses()
-        return dict((a.getKeyword(), a) for a in brains)
+    def get_reference_sample_analyses(self, reference_sample):
+        index = self.get_analysis_index(reference_sample.getId)
+        return index.by_keyword
 
     def get_analysis(self, ar, kw):
         analyses = self.get_analyses(ar)
         if len(analyses) < 1:
             msg = ' No sample found with ID {}'.format(ar)
             raise AnalysisNotFound(msg)
-        analyses = [v for k, v in analyses.items() if k == kw]
+        analyses = [analyses[kw]] if kw in analyses else []
         if len(analyses) < 1:
             msg = ' No analysis found matching keyword {}'.format(kw)
             raise AnalysisNotFound(msg)
@@ -309,35 +221,12 @@ class DR3900Parser(InstrumentResultsFileParser):
             raise MultipleAnalysesFound(msg)
         return analyses[0]
 
-    @staticmethod
-    def get_analyses(ar):
-        analyses = ar.getAnalyses()
-        return dict((a.getKeyword, a) for a in analyses)
-
-    @staticmethod
-    def extract_relevant_data(lines):
-        new_lines = []
-        for row in lines:
-            split_row = row.encode("ascii", "ignore").split(",")
-            if len(split_row) > 13:
-                new_lines.append(','.join([str(elem) for elem in split_row]))
-        return new_lines
-
-    @staticmethod
-    def try_utf8(data):
-        """Returns a Unicode object on success, or None on failure"""
-        try:
-            return data.decode('utf-8')
-        except UnicodeDecodeError:
-            return None
+    def get_analyses(self, ar):
+        return self.get_analysis_index(ar.getId()).by_keyword
 
     @staticmethod
-    def try_utf16(data):
-        """Returns a Unicode object on success, or None on failure"""
-        try:
-            return data.decode('utf-16')
-        except UnicodeDecodeError:
-            return None
+    def extract_relevant_data(rows):
+        return [row for row in rows if len(row) > 13]
 
     @staticmethod
     def parse_headerlines(reader):
@@ -377,6 +266,8 @@ class dr3900import(object):
         self.request = None
 
     @staticmethod
+    @queued_import
+    @profiled_import
     def Import(context, request):
         errors = []
         logs = []
@@ -411,7 +302,8 @@ class dr3900import(object):
             elif override == "overrideempty":
                 over = [True, True]
 
-            importer = AnalysisResultsImporter(
+            importer = make_importer(
+                request,
                 parser=parser,
                 context=context,
                 allowed_sample_states=status,
@@ -421,7 +313,8 @@ class dr3900import(object):
             )
 
             try:
-                importer.process()
+                with timed(PROCESS):
+                    importer.process()
                 errors = importer.errors
                 logs = importer.logs
                 warns = importer.warns
@@ -8,7 +8,6 @@ from mimetypes import guess_type
 from os.path import abspath
 from os.path import splitext
 
-from openpyxl import load_workbook
 from zope.interface import implements
 
 from senaite.instruments import senaiteMessageFactory as _
@@ -16,12 +15,16 @@ from senaite.core.exportimport.instruments import (
     IInstrumentAutoImportInterface,
     IInstrumentImportInterface,
 )
-from senaite.core.exportimport.instruments.resultsimport import (
-    AnalysisResultsImporter,
-)
+from senaite.instruments.instrument import SheetNotFound
 from senaite.instruments.instruments.pg.dv5000icp.dv5000 import (
     DV5000ICPParser,
 )
+from senaite.instruments.profiling import PROCESS
+from senaite.instruments.profiling import ROW_PARSING
+from senaite.instruments.profiling import profiled_import
+from senaite.instruments.profiling import timed
+from senaite.instruments.queuedimport import queued_import
+from senaite.instruments.resultsimport import make_importer
 
 
 WORKSHEET = "Conc. in Sample Units"
@@ -36,52 +39,50 @@ class AvioParser(DV5000ICPParser):
         super(AvioParser, self).__init__(
             infile, worksheet=WORKSHEET, encoding=encoding)
 
+    @timed(ROW_PARSING)
     def parse(self):
         ext = splitext(self.infile.filename.lower())[-1]
         if ext not in (".xlsx", ".xlsm"):
             self.err("Unsupported file format: %s" % ext)
             return -1
 
+        # Syngistix repeats the header whenever the analyte set changes.
+        headers = []
+        results = []
         try:
-            workbook = load_workbook(filename=self.infile, data_only=True)
+            for row_nr, row in enumerate(self.iter_rows(), 1):
+                sample_id = self.safe_value(self.get_cells(row, 1, 2)[0])
+                if sample_id == "Sample Id":
+                    headers = self.get_result_headers(row)
+                    continue
+                if not sample_id or not headers:
+                    continue
+
+                values = [
+                    self.safe_value(self.get_cells(row, column - 1, column)[0])
+                    for column, header in headers
+                ]
+                results.append((sample_id, row_nr, values,
+                                [header for column, header in headers]))
+        except SheetNotFound:
+            self.err("Sheet not found in workbook: %s" % WORKSHEET)
+            return -1
         except Exception:
             self.err("Cannot open workbook: %s" % self.infile.filename)
             return -1
 
-        try:
-            worksheet = workbook[WORKSHEET]
-        except KeyError:
-            self.err("Sheet not found in workbook: %s" % WORKSHEET)
-            return -1
-
-        # Syngistix repeats the header whenever the analyte set changes.
-        headers = []
-        for row_nr in range(1, worksheet.max_row + 1):
-            sample_id = self.safe_value(
-                worksheet.cell(row=row_nr, column=2).value)
-            if sample_id == "Sample Id":
-                headers = self.get_result_headers(worksheet, row_nr)
-                continue
-            if not sample_id or not headers:
-                continue
-
-            values = [
-                self.safe_value(
-                    worksheet.cell(row=row_nr, column=column).value)
-                for column, header in headers
-            ]
-            self.headers = [header for column, header in headers]
+        self.prefetch([result[0] for result in results])
+        for sample_id, row_nr, values, row_headers in results:
+            self.headers = row_headers
             self.parse_result_row(sample_id, row_nr, values)
-
         return 1
 
     @staticmethod
-    def get_result_headers(worksheet, row_nr):
+    def get_result_headers(row):
         headers = []
         # Columns A-G contain run metadata. Results start in column H.
-        for column in range(8, worksheet.max_column + 1):
-            value = AvioParser.safe_value(
-                worksheet.cell(row=row_nr, column=column).value)
+        for column in range(8, len(row) + 1):
+            value = AvioParser.safe_value(row[column - 1])
             if value:
                 headers.append((column, value))
         return headers
@@ -104,6 +105,8 @@ class importer(object):
         self.request = None
 
     @staticmethod
+    @queued_import
+    @profiled_import
     def Import(context, request):
         errors = []
         logs = []
@@ -128,7 +131,8 @@ class importer(object):
         elif override == "overrideempty":
             over = [True, True]
 
-        results_importer = AnalysisResultsImporter(
+        results_importer = make_importer(
+            request,
             parser=parser,
             context=context,
             allowed_sample_states=status,
@@ -137,7 +141,8 @@ class importer(object):
             instrument_uid=instrument,
         )
         try:
-            results_importer.process()
+            with timed(PROCESS):
+                results_importer.process()
             errors = results_importer.errors
             logs = results_importer.logs
             warns = results_importer.warns
@@ -17,31 +17,30 @@
 #
 # Copyright 2018-2019 by it's authors.
 # Some rights reserved, see README and LICENSE.
-import csv
 import json
 import traceback
 from mimetypes import guess_type
 from os.path import abspath
-from os.path import splitext
 from re import subn
 
 from senaite.core.exportimport.instruments import IInstrumentAutoImportInterface
 from senaite.core.exportimport.instruments import IInstrumentImportInterface
-from senaite.core.exportimport.instruments.resultsimport import \
-    AnalysisResultsImporter
 from senaite.core.exportimport.instruments.resultsimport import \
     InstrumentResultsFileParser
 
-from bika.lims import api
 from bika.lims import bikaMessageFactory as _
-from bika.lims.catalog import CATALOG_ANALYSIS_REQUEST_LISTING
-from senaite.core.catalog import ANALYSIS_CATALOG, SENAITE_CATALOG
-from senaite.instruments.instrument import FileStub
 from senaite.instruments.instrument import SheetNotFound
-from senaite.instruments.instrument import xls_to_csv
-from senaite.instruments.instrument import xlsx_to_csv
+from senaite.instruments.instrument import iter_rows
+from senaite.instruments.instrument import iter_dict_rows
+from senaite.instruments.rawresults import CompactResultsMixin
+from senaite.instruments.resolver import ResolverMixin
+from senaite.instruments.profiling import PROCESS
+from senaite.instruments.profiling import ROW_PARSING
+from senaite.instruments.profiling import profiled_import
+from senaite.instruments.profiling import timed
+from senaite.instruments.queuedimport import queued_import
+from senaite.instruments.resultsimport import make_importer
 from zope.interface import implements
-from zope.publisher.browser import FileUpload
 
 non_analyte_row_headers = [
     'Sample Id',
@@ -61,7 +60,8 @@ class AnalysisNotFound(Exception):
     pass
 
 
-class Nexion350xParser(InstrumentResultsFileParser):
+class Nexion350xParser(ResolverMixin, CompactResultsMixin,
+                       InstrumentResultsFileParser):
     ar = None
 
     def __init__(self, infile, worksheet=0, encoding=None, delimiter=None):
@@ -74,38 +74,21 @@ class Nexion350xParser(InstrumentResultsFileParser):
         mimetype, encoding = guess_type(self.infile.filename)
         InstrumentResultsFileParser.__init__(self, infile, mimetype)
 
+    @timed(ROW_PARSING)
     def parse(self):
-        order = []
-        ext = splitext(self.infile.filename.lower())[-1]
-        if ext == '.xlsx':
-            order = (xlsx_to_csv, xls_to_csv)
-        elif ext == '.xls':
-            order = (xls_to_csv, xlsx_to_csv)
-        elif ext == '.csv':
-            self.csv_data = self.infile
-        if order:
-            for importer in order:
-                try:
-                    self.csv_data = importer(
-                        infile=self.infile,
-                        worksheet=self.worksheet,
-                        delimiter=self.delimiter)
-                    break
-                except SheetNotFound:
-                    self.err("Sheet not found in workbook: %s" % self.worksheet)
-                    return -1
-                except Exception as e:  # noqa
-                    pass
-            else:
-                self.warn("Can't parse input file as XLS, XLSX, or CSV.")
-                return -1
-        stub = FileStub(file=self.csv_data, name=str(self.infile.filename))
-        self.csv_data = FileUpload(stub)
-
-        lines = self.csv_data.readlines()
-        reader = csv.DictReader(lines)
-        for row in reader:
-            self.parse_row(reader.line_num, row)
+        try:
+            rows = iter_rows(self.infile, self.worksheet)
+        except SheetNotFound:
+            self.err("Sheet not found in workbook: %s" % self.worksheet)
+            return -1
+        except ValueError:
+            self.warn("Can't parse input file as XLS, XLSX, or CSV.")
+            return -1
+        rows = list(iter_dict_rows(rows))
+        self.prefetch([subn(r'[^\w\d\-_]*', '', row.get('Sample Id', ''))[0]
+                       for row_nr, row in rows])
+        for row_nr, row in rows:
+            self.parse_row(row_nr, row)
         return True
 
     def parse_row(self, row_nr, row):
@@ -118,7 +101,8 @@ class Nexion350xParser(InstrumentResultsFileParser):
         for key in row.keys():
             if key in non_analyte_row_headers:
                 continue
-            kw = subn(r'[^\w\d]*', '', key)[0]
+            # analyte headers carry their unit on a second line: "K 39\n(cps)"
+            kw = subn(r'[^\w\d]*', '', key.split('\n')[0])[0]
             if not kw:
                 continue
             try:
@@ -150,39 +134,9 @@ class Nexion350xParser(InstrumentResultsFileParser):
 
         return 0
 
-    @staticmethod
-    def get_ar(sample_id):
-        query = dict(portal_type='AnalysisRequest', getId=sample_id)
-        brains = api.search(query, CATALOG_ANALYSIS_REQUEST_LISTING)
-        try:
-            return api.get_object(brains[0])
-        except IndexError:
-            pass
-
-    @staticmethod
-    def is_sample(sample_id):
-        query = dict(portal_type="AnalysisRequest", getId=sample_id)
-        brains = api.search(query, CATALOG_ANALYSIS_REQUEST_LISTING)
-        return True if brains else False
-
-    @staticmethod
-    def is_analysis_group_id(analysis_group_id):
-        portal_types = ["DuplicateAnalysis", "ReferenceAnalysis"]
-        query = dict(
-            portal_type=portal_types, getReferenceAnalysesGroupID=analysis_group_id
-        )
-        brains = api.search(query, ANALYSIS_CATALOG)
-        return True if brains else False
-
-    @staticmethod
-    def get_duplicate_or_qc_analysis(analysis_id, kw):
-        portal_types = ["DuplicateAnalysis", "ReferenceAnalysis"]
-        query = dict(
-            portal_type=portal_types, getReferenceAnalysesGroupID=analysis_id
-        )
-        brains = api.search(query, ANALYSIS_CATALOG)
-        analyses = dict((a.getKeyword, a) for a in brains)
-        brains = [v for k, v in analyses.items() if k.startswith(kw)]
+    def get_duplicate_or_qc_analysis(self, analysis_id, kw):
+        analyses = self.get_analysis_index(analysis_id)
+        brains = analyses.startswith(kw)
         if len(brains) < 1:
             msg = ("No analysis found matching Keyword '${kw}'",)
             raise AnalysisNotFound(msg, kw=kw)
@@ -193,8 +147,8 @@ class Nexion350xParser(InstrumentResultsFileParser):
 
     def get_reference_sample_analysis(self, reference_sample, kw):
         kw = kw
-        brains = self.get_reference_sample_analyses(reference_sample)
-        brains = [v for k, v in brains.items() if k.startswith(kw)]
+        index = self.get_analysis_index(reference_sample.getId)
+        brains = index.startswith(kw)
         if len(brains) < 1:
             msg = "No analysis found matching Keyword '${kw}'",
             raise AnalysisNotFound(msg, kw=kw)
@@ -204,15 +158,12 @@ class Nexion350xParser(InstrumentResultsFileParser):
         return brains[0]
 
 
-    @staticmethod
-    def get_analyses(ar):
-        analyses = ar.getAnalyses()
-        return dict((a.getKeyword, a) for a in analyses)
+    def get_analyses(self, ar):
+        return self.get_analysis_index(ar.getId()).by_keyword
 
     def get_analysis(self, ar, kw, row_nr="", row=""):
         kw = kw
-        items = self.get_analyses(ar)
-        brains = [v for k, v in items.items() if k.startswith(kw)]
+        brains = self.get_analysis_index(ar.getId()).startswith(kw)
         if len(brains) < 1:
             return None
         if len(brains) > 1:
@@ -220,20 +171,8 @@ class Nexion350xParser(InstrumentResultsFileParser):
             raise MultipleAnalysesFound(msg, kw=kw)
         return brains[0]
 
-    @staticmethod
-    def is_reference_sample(reference_sample_id, kw):
-        query = dict(
-            portal_type="ReferenceSample", getId=reference_sample_id
-        )
-        brains = api.search(query, SENAITE_CATALOG)
-        return True if brains else False
-
-    @staticmethod
-    def get_reference_sample(reference_sample_id, kw):
-        query = dict(
-            portal_type="ReferenceSample", getId=reference_sample_id
-        )
-        brains = api.search(query, SENAITE_CATALOG)
+    def get_reference_sample(self, reference_sample_id, kw):
+        brains = self.resolver.get_reference_samples(reference_sample_id)
         if len(brains) < 1:
             msg = ("No reference sample found matching Keyword '${kw}'",)
             raise AnalysisNotFound(msg, kw=kw)
@@ -253,6 +192,8 @@ class importer(object):
         self.request = None
 
     @staticmethod
+    @queued_import
+    @profiled_import
     def Import(context, request):
         errors = []
         logs = []
@@ -284,7 +225,8 @@ class importer(object):
             elif override == 'overrideempty':
                 over = [True, True]
 
-            importer = AnalysisResultsImporter(
+            importer = make_importer(
+                request,
                 parser=parser,
                 context=context,
                 allowed_sample_states=status,
@@ -293,7 +235,8 @@ class importer(object):
                 instrument_uid=instrument)
 
             try:
-                importer.process()
+                with timed(PROCESS):
+                    importer.process()
                 errors = importer.errors
                 logs = importer.logs
                 warns = importer.warns
@@ -18,37 +18,37 @@
 # Copyright 2018-2019 by it's authors.
 # Some rights reserved, see README and LICENSE.
 
-import csv
 import json
-import types
 import traceback
-from Products.CMFPlone.utils import safe_unicode
-from cStringIO import StringIO
 from mimetypes import guess_type
-from openpyxl import load_workbook
 from os.path import abspath
-from os.path import splitext
 from re import subn
-from xlrd import open_workbook
 from zope.interface import implements
-from zope.publisher.browser import FileUpload
 
 from bika.lims import api
 from bika.lims.browser import BrowserView
-from bika.lims.catalog import CATALOG_ANALYSIS_REQUEST_LISTING
 from senaite.instruments import senaiteMessageFactory as _
-from senaite.core.catalog import ANALYSIS_CATALOG, SENAITE_CATALOG
 from senaite.core.exportimport.instruments import (
     IInstrumentAutoImportInterface,
     IInstrumentExportInterface,
     IInstrumentImportInterface,
 )
 from senaite.core.exportimport.instruments.resultsimport import (
-    AnalysisResultsImporter,
     InstrumentResultsFileParser,
 )
-from senaite.instruments.instrument import FileStub
 from senaite.instruments.instrument import SheetNotFound
+from senaite.instruments.instrument import iter_rows
+from senaite.instruments.instrument import iter_dict_rows
+from senaite.instruments.instrument import percent_cell_text
+from senaite.instruments.rawresults import CompactResultsMixin
+from senaite.instruments.resolver import ResolverMixin
+from senaite.instruments.profiling import PROCESS
+from senaite.instruments.profiling import ROW_PARSING
+from senaite.instruments.profiling import profiled_import
+from senaite.instruments.profiling import timed
+from senaite.instruments.progress import report
+from senaite.instruments.queuedimport import queued_import
+from senaite.instruments.resultsimport import make_importer
 
 
 class SampleNotFound(Exception):
@@ -63,7 +63,8 @@ class AnalysisNotFound(Exception):
     pass
 
 
-class SomascopeH23061316SCCParser(InstrumentResultsFileParser):
+class SomascopeH23061316SCCParser(ResolverMixin, CompactResultsMixin,
+                                  InstrumentResultsFileParser):
     ar = None
 
     def __init__(self, infile, worksheet=None, encoding=None, delimiter=None):
@@ -78,123 +79,64 @@ class SomascopeH23061316SCCParser(InstrumentResultsFileParser):
         mimetype, encoding = guess_type(self.infile.filename)
         InstrumentResultsFileParser.__init__(self, infile, mimetype)
 
-    def xls_to_csv(self, infile, worksheet="", delimiter=","):
-        """
-        Convert xlsx to easier format first, since we want to use the
-        convenience of the CSV library
+    @timed(ROW_PARSING)
+    def parse(self):
+        rows = self.read_rows()
+        if rows is None:
+            return -1
+        for row_nr in self.parse_rows(rows):
+            pass
+        return 1
 
+    def iter_parse(self):
+        rows = self.read_rows()
+        if rows is None:
+            yield -1
+            return
+        for row_nr in self.parse_rows(rows):
+            report(self, "rows")
+            yield row_nr
+
+    def read_rows(self):
+        """Returns the (row number, row) of the file, None when unreadable
+
+        The rows are read and their Samples resolved in batches as they are
+        iterated.
         """
+        try:
+            rows = iter_rows(
+                self.infile, self.worksheet, cell_text=percent_cell_text)
+        except SheetNotFound:
+            self.err("Sheet not found in workbook: %s" % self.worksheet)
+            return None
+        except ValueError:
+            self.warn("Can't parse input file as XLS, XLSX, or CSV.")
+            return None
 
-        def find_sheet(wb, worksheet):
-            for sheet in wb.sheets():
-                if sheet.name == worksheet:
-                    return sheet
-
-        wb = open_workbook(file_contents=infile.read())
-        sheet = wb.sheets()[worksheet]
-
-        buffer = StringIO()
-
-        # extract all rows
-        for row in sheet.get_rows():
-            line = []
-            for cell in row:
-                value = cell.value
-                if type(value) in types.StringTypes:
-                    value = value.encode("utf8")
-                if value is None:
-                    value = ""
-                line.append(str(value))
-            print >> buffer, delimiter.join(line)
-        buffer.seek(0)
-        return buffer
-
-    def xlsx_to_csv(self, infile, worksheet="", delimiter=","):
-        worksheet = worksheet if worksheet else 0
-        wb = load_workbook(filename=infile)
-        if worksheet in wb.sheetnames:
-            sheet = wb[worksheet]
-        else:
-            try:
-                index = int(worksheet)
-                sheet = wb.worksheets[index]
-            except (ValueError, TypeError, IndexError):
-                raise SheetNotFound
-
-        buffer = StringIO()
-        for row in sheet.rows:
-            line = []
-            for cell in row:
-                new_val = ""
-                if cell.number_format == "0.00%":
-                    new_val = "{}%".format(cell.value * 100)
-                cellval = new_val if new_val else cell.value
-
-                try:
-                    value = "" if cellval is None else str(cellval).encode("utf8")
-                except UnicodeEncodeError:
-                    value = (
-                        "" if cellval is None else safe_unicode(cellval).encode("utf8")
-                    )
-                if "\n" in value:  # fixme multi-line cell gives only 1st line
-                    value = value.split("\n")[0]
-                line.append(value.strip())
-            if not any(line):
-                continue
-            buffer.write(delimiter.join(line) + "\n")
-        buffer.seek(0)
-        return buffer
+        return self.iter_prefetched(
+            iter_dict_rows(rows), lambda item: item[1].get("Name", ""))
 
-    def parse(self):
-        order = []
-        ext = splitext(self.infile.filename.lower())[-1]
-        if ext == ".xlsx":
-            order = (self.xlsx_to_csv, self.xls_to_csv)
-        elif ext == ".xls":
-            order = (self.xls_to_csv, self.xlsx_to_csv)
-        elif ext == ".csv":
-            self.csv_data = self.infile
-        if order:
-            for importer in order:
-                try:
-                    self.csv_data = importer(
-                        infile=self.infile,
-                        worksheet=self.worksheet,
-                        delimiter=self.delimiter,
-                    )
-                    break
-                except SheetNotFound:
-                    self.err("Sheet not found in workbook: %s" % self.worksheet)
-                    return -1
-                except Exception as e:  # noqa
-                    pass
-            else:
-                self.warn("Can't parse input file as XLS, XLSX, or CSV.")
-                return -1
-        stub = FileStub(file=self.csv_data, name=str(self.infile.filename))
-        self.csv_data = FileUpload(stub)
-
-        portal_type = ""
-        lines = self.csv_data.readlines()
-        reader = csv.DictReader(lines)
-        for row in reader:
+    def parse_rows(self, rows):
+        """Parses the rows, yields the number of each row parsed
+        """
+        for row_nr, row in rows:
             sample_id = row.get("Name", "")
             portal_type = self.get_portal_type(sample_id)
             if portal_type == "AnalysisRequest":
-                self.parse_ar_row(sample_id, reader.line_num, row)
+                self.parse_ar_row(sample_id, row_nr, row)
 
             elif portal_type in ["DuplicateAnalysis", "ReferenceAnalysis"]:
-                self.parse_duplicate_row(sample_id, reader.line_num, row)
+                self.parse_duplicate_row(sample_id, row_nr, row)
 
             elif portal_type == "ReferenceSample":
-                self.parse_reference_sample_row(sample_id, reader.line_num, row)
+                self.parse_reference_sample_row(sample_id, row_nr, row)
             else:
                 self.warn(
                     msg="No results found for '${sample_id}'",
                     mapping={"sample_id": sample_id},
-                    numline=str(reader.line_num),
+                    numline=str(row_nr),
                 )
-        return 1
+            yield row_nr
 
     def get_portal_type(self, sample_id):
         portal_type = None
@@ -282,7 +224,7 @@ class SomascopeH23061316SCCParser(InstrumentResultsFileParser):
     def get_reference_sample_analysis(self, reference_sample, kw):
         kw = kw
         brains = self.get_reference_sample_analyses(reference_sample)
-        brains = [v for k, v in brains.items() if k == kw]
+        brains = [brains[kw]] if kw in brains else []
         if len(brains) < 1:
             lmsg = "No analysis found for sample {} matching Keyword {}"
             msg = lmsg.format(reference_sample, kw)
@@ -293,18 +235,13 @@ class SomascopeH23061316SCCParser(InstrumentResultsFileParser):
             raise MultipleAnalysesFound(msg)
         return brains[0]
 
-    @staticmethod
-    def get_reference_sample_analyses(reference_sample):
-        brains = reference_sample.getObject().getReferenceAnalyses()
-        return dict((a.getKeyword(), a) for a in brains)
+    def get_reference_sample_analyses(self, reference_sample):
+        index = self.get_analysis_index(reference_sample.getId)
+        return index.by_keyword
 
-    @staticmethod
-    def get_duplicate_or_qc_analysis(analysis_id, kw):
-        portal_types = ["DuplicateAnalysis", "ReferenceAnalysis"]
-        query = dict(portal_type=portal_types, getReferenceAnalysesGroupID=analysis_id)
-        brains = api.search(query, ANALYSIS_CATALOG)
-        analyses = dict((a.getKeyword, a) for a in brains)
-        brains = [v for k, v in analyses.items() if k == kw]
+    def get_duplicate_or_qc_analysis(self, analysis_id, kw):
+        analyses = self.get_analysis_index(analysis_id)
+        brains = [analyses[kw]] if kw in analyses else []
         if len(brains) < 1:
             lmsg = "No analysis found for sample {} matching Keyword {}"
             msg = lmsg.format(analysis_id, kw)
@@ -315,29 +252,12 @@ class SomascopeH23061316SCCParser(InstrumentResultsFileParser):
             raise MultipleAnalysesFound(msg)
         return brains[0]
 
-    @staticmethod
-    def get_ar(sample_id):
-        query = dict(portal_type="AnalysisRequest", getId=sample_id)
-        brains = api.search(query, CATALOG_ANALYSIS_REQUEST_LISTING)
-        try:
-            return api.get_object(brains[0])
-        except IndexError:
-            pass
-
-    @staticmethod
-    def is_sample(sample_id):
-        query = dict(portal_type="AnalysisRequest", getId=sample_id)
-        brains = api.search(query, CATALOG_ANALYSIS_REQUEST_LISTING)
-        return True if brains else False
-
-    @staticmethod
-    def get_analyses(ar):
-        analyses = ar.getAnalyses()
-        return dict((a.getKeyword, a) for a in analyses)
+    def get_analyses(self, ar):
+        return self.get_analysis_index(ar.getId()).by_keyword
 
     def get_analysis(self, ar, kw):
         analyses = self.get_analyses(ar)
-        analyses = [v for k, v in analyses.items() if k == kw]
+        analyses = [analyses[kw]] if kw in analyses else []
         if len(analyses) < 1:
             msg = """No analysis found for sample '${ar}' matching keyword '${kw}'"""
             self.log(msg, mapping=dict(kw=kw, ar=ar.getId()))
@@ -349,26 +269,8 @@ class SomascopeH23061316SCCParser(InstrumentResultsFileParser):
             return None
         return analyses[0]
 
-    @staticmethod
-    def is_analysis_group_id(analysis_group_id):
-        portal_types = ["DuplicateAnalysis", "ReferenceAnalysis"]
-        query = dict(
-            portal_type=portal_types,
-            getReferenceAnalysesGroupID=analysis_group_id
-        )
-        brains = api.search(query, ANALYSIS_CATALOG)
-        return True if brains else False
-
-    @staticmethod
-    def is_reference_sample(reference_sample_id):
-        query = dict(portal_type="ReferenceSample", getId=reference_sample_id)
-        brains = api.search(query, SENAITE_CATALOG)
-        return True if brains else False
-
-    @staticmethod
-    def get_reference_sample(reference_sample_id, kw):
-        query = dict(portal_type="ReferenceSample", getId=reference_sample_id)
-        brains = api.search(query, SENAITE_CATALOG)
+    def get_reference_sample(self, reference_sample_id, kw):
+        brains = self.resolver.get_reference_samples(reference_sample_id)
         if len(brains) < 1:
             lmsg = "No reference sample found for sample {} matching Keyword {}"
             msg = lmsg.format(reference_sample_id, kw)
@@ -390,6 +292,8 @@ class importer(object):
         self.request = None
 
     @staticmethod
+    @queued_import
+    @profiled_import
     def Import(context, request):
         errors = []
         logs = []
@@ -420,7 +324,8 @@ class importer(object):
             elif override == "overrideempty":
                 over = [True, True]
 
-            importer = AnalysisResultsImporter(
+            importer = make_importer(
+                request,
                 parser=parser,
                 context=context,
                 allowed_sample_states=status,
@@ -430,7 +335,8 @@ class importer(object):
             )
 
             try:
-                importer.process()
+                with timed(PROCESS):
+                    importer.process()
                 errors = importer.errors
                 logs = importer.logs
                 warns = importer.warns
@@ -18,24 +18,15 @@
 # Copyright 2018-2019 by it's authors.
 # Some rights reserved, see README and LICENSE.
 
-import csv
 import json
-import types
 import traceback
-from Products.CMFPlone.utils import safe_unicode
-from cStringIO import StringIO
 from mimetypes import guess_type
-from openpyxl import load_workbook
 from os.path import abspath
-from os.path import splitext
 from re import subn
-from xlrd import open_workbook
 from zope.interface import implements
-from zope.publisher.browser import FileUpload
 
 from bika.lims import api
 from bika.lims.browser import BrowserView
-from bika.lims.catalog import CATALOG_ANALYSIS_REQUEST_LISTING
 from senaite.instruments import senaiteMessageFactory as _
 from senaite.core.catalog import ANALYSIS_CATALOG
 from senaite.core.exportimport.instruments import (
@@ -44,11 +35,22 @@ from senaite.core.exportimport.instruments import (
     IInstrumentImportInterface,
 )
 from senaite.core.exportimport.instruments.resultsimport import (
-    AnalysisResultsImporter,
     InstrumentResultsFileParser,
 )
-from senaite.instruments.instrument import FileStub
 from senaite.instruments.instrument import SheetNotFound
+from senaite.instruments.numeric import clean_numbers
+from senaite.instruments.instrument import iter_rows
+from senaite.instruments.instrument import iter_dict_rows
+from senaite.instruments.instrument import percent_cell_text
+from senaite.instruments.rawresults import CompactResultsMixin
+from senaite.instruments.resolver import ResolverMixin
+from senaite.instruments.profiling import PROCESS
+from senaite.instruments.profiling import ROW_PARSING
+from senaite.instruments.profiling import profiled_import
+from senaite.instruments.profiling import timed
+from senaite.instruments.progress import report
+from senaite.instruments.queuedimport import queued_import
+from senaite.instruments.resultsimport import make_importer
 
 
 class SampleNotFound(Exception):
@@ -63,7 +65,8 @@ class AnalysisNotFound(Exception):
     pass
 
 
-class SyngistixParser(InstrumentResultsFileParser):
+class SyngistixParser(ResolverMixin, CompactResultsMixin,
+                      InstrumentResultsFileParser):
     ar = None
 
     def __init__(self, infile, worksheet=None, encoding=None, delimiter=None):
@@ -78,118 +81,49 @@ class SyngistixParser(InstrumentResultsFileParser):
         mimetype, encoding = guess_type(self.infile.filename)
         InstrumentResultsFileParser.__init__(self, infile, mimetype)
 
-    def xls_to_csv(self, infile, worksheet="", delimiter=","):
-        """
-        Convert xlsx to easier format first, since we want to use the
-        convenience of the CSV library
+    @timed(ROW_PARSING)
+    def parse(self):
+        rows = self.read_rows()
+        if rows is None:
+            return -1
+        for row_num in self.parse_rows(rows):
+            pass
+        return 1
+
+    def iter_parse(self):
+        rows = self.read_rows()
+        if rows is None:
+            yield -1
+            return
+        for row_num in self.parse_rows(rows):
+            report(self, "rows")
+            yield row_num
+
+    def read_rows(self):
+        """Returns the (row number, row) of the file, None when unreadable
 
+        The rows are read and their Samples resolved in batches as they are
+        iterated.
         """
+        try:
+            rows = iter_rows(
+                self.infile, self.worksheet, cell_text=percent_cell_text)
+        except SheetNotFound:
+            self.err("Sheet not found in workbook: %s" % self.worksheet)
+            return None
+        except ValueError:
+            self.warn("Can't parse input file as XLS, XLSX, or CSV.")
+            return None
 
-        def find_sheet(wb, worksheet):
-            for sheet in wb.sheets():
-                if sheet.name == worksheet:
-                    return sheet
-
-        wb = open_workbook(file_contents=infile.read())
-        sheet = wb.sheets()[worksheet]
-
-        buffer = StringIO()
-
-        # extract all rows
-        for row in sheet.get_rows():
-            line = []
-            for cell in row:
-                value = cell.value
-                if type(value) in types.StringTypes:
-                    value = value.encode("utf8")
-                if value is None:
-                    value = ""
-                line.append(str(value))
-            print >> buffer, delimiter.join(line)
-        buffer.seek(0)
-        return buffer
-
-    def xlsx_to_csv(self, infile, worksheet="", delimiter=","):
-        worksheet = worksheet if worksheet else 0
-        wb = load_workbook(filename=infile)
-        if worksheet in wb.sheetnames:
-            sheet = wb[worksheet]
-        else:
-            try:
-                index = int(worksheet)
-                sheet = wb.worksheets[index]
-            except (ValueError, TypeError, IndexError):
-                raise SheetNotFound
-
-        buffer = StringIO()
-        for row in sheet.rows:
-            line = []
-            for cell in row:
-                new_val = ""
-                if cell.number_format == "0.00%":
-                    new_val = "{}%".format(cell.value * 100)
-                cellval = new_val if new_val else cell.value
-
-                try:
-                    value = (
-                        "" if cellval is None else str(cellval).encode("utf8")
-                    )
-                except UnicodeEncodeError:
-                    value = (
-                        ""
-                        if cellval is None
-                        else safe_unicode(cellval).encode("utf8")
-                    )
-                if "\n" in value:  # fixme multi-line cell gives only 1st line
-                    value = value.split("\n")[0]
-                line.append(value.strip())
-            if not any(line):
-                continue
-            buffer.write(delimiter.join(line) + "\n")
-        buffer.seek(0)
-        return buffer
+        results = ((row_num, self.remove_unwanted_columns(row))
+                   for row_num, row in iter_dict_rows(rows))
+        return self.iter_prefetched(
+            results, lambda item: item[1].get("Sample Id", ""))
 
-    def parse(self):
-        order = []
-        ext = splitext(self.infile.filename.lower())[-1]
-        if ext == ".xlsx":
-            order = (self.xlsx_to_csv, self.xls_to_csv)
-        elif ext == ".xls":
-            order = (self.xls_to_csv, self.xlsx_to_csv)
-        elif ext == ".csv":
-            self.csv_data = self.infile
-        if order:
-            for importer in order:
-                try:
-                    self.csv_data = importer(
-                        infile=self.infile,
-                        worksheet=self.worksheet,
-                        delimiter=self.delimiter,
-                    )
-                    break
-                except SheetNotFound:
-                    self.err(
-                        "Sheet not found in workbook: %s" % self.worksheet
-                    )
-                    return -1
-                except Exception as e:  # noqa
-                    pass
-            else:
-                self.warn("Can't parse input file as XLS, XLSX, or CSV.")
-                return -1
-        stub = FileStub(file=self.csv_data, name=str(self.infile.filename))
-        self.csv_data = FileUpload(stub)
-
-        portal_type = ""
-        lines = self.csv_data.readlines()
-        reader = csv.DictReader(lines)
-        results = []
-        for row in reader:
-            new_row = self.remove_unwanted_columns(row)
-            results.append(new_row)
-
-        row_num = 2
-        for row in results:
+    def parse_rows(self, rows):
+        """Parses the rows, yields the number of each row parsed
+        """
+        for row_num, row in rows:
             sample_id = row.get("Sample Id", "")
             del row["Sample Id"]
 
@@ -202,10 +136,9 @@ class SyngistixParser(InstrumentResultsFileParser):
                 self.warn(
                     msg="No results found for '${sample_id}'",
                     mapping={"sample_id": sample_id},
-                    numline=str(reader.line_num),
+                    numline=str(row_num),
                 )
-            row_num = row_num + 1
-        return 1
+            yield row_num
 
     def get_portal_type(self, sample_id):
         portal_type = None
@@ -260,14 +193,14 @@ class SyngistixParser(InstrumentResultsFileParser):
             for k, v in items
             if k
         }
+        readings = []
         for item in items:
             keyword = item[0]
             try:
                 analysis = self.get_analysis(ar, keyword)
-                analysis_obj = analysis.getObject()
-                interim_fields = analysis_obj.InterimFields
-                precision = analysis_obj.Precision or 2
-                field_kws = [x.get("keyword") for x in interim_fields if x]
+                precision = self.get_metadata(
+                    analysis, "Precision") or 2
+                field_kws = self.resolver.get_interim_keywords(analysis)
                 if "Reading" not in field_kws:
                     self.warn(
                         msg="No interim field 'Reading' was found for Analysis"
@@ -279,11 +212,8 @@ class SyngistixParser(InstrumentResultsFileParser):
                 elif not analysis:
                     del parsed[keyword]
                 else:
-                    result = float(parsed[keyword][interim_kw])
-                    if result != 0:
-                        result = result / 10000
-                    rounded_result = round(result, precision)
-                    parsed[keyword][interim_kw] = str(rounded_result)
+                    readings.append(
+                        (keyword, parsed[keyword][interim_kw], precision))
             except Exception:
                 self.warn(
                     msg="Error getting analysis for '${kw}': ${sample_id}",
@@ -291,6 +221,7 @@ class SyngistixParser(InstrumentResultsFileParser):
                     numline=row_nr,
                 )
                 del parsed[keyword]
+        self.convert_readings(parsed, readings, sample_id, row_nr)
         return self.parse_row(row_nr, parsed, sample_id)
 
     def parse_duplicate_and_reference_row(self, sample_id, row_nr, row):
@@ -304,6 +235,7 @@ class SyngistixParser(InstrumentResultsFileParser):
             for k, v in items
             if k
         }
+        readings = []
         for item in items:
             keyword = item[0]
             try:
@@ -311,7 +243,8 @@ class SyngistixParser(InstrumentResultsFileParser):
                     sample_id, keyword
                 )
                 dup_keyword = self.getDuplicateKeyword(analysis)
-                precision = analysis.getObject().Precision or 2
+                precision = self.get_metadata(
+                    analysis, "Precision") or 2
                 if not dup_keyword:
                     del parsed[keyword]
                 elif "No Interim Field" in dup_keyword:
@@ -324,11 +257,8 @@ class SyngistixParser(InstrumentResultsFileParser):
                     )
                     del parsed[keyword]
                 else:
-                    result = float(parsed[keyword][interim_kw])
-                    if result != 0:
-                        result = result / 10000
-                    rounded_result = round(result, precision)
-                    parsed[keyword][interim_kw] = str(rounded_result)
+                    readings.append(
+                        (keyword, parsed[keyword][interim_kw], precision))
             except Exception:
                 self.warn(
                     msg="Error getting analysis for '${kw}': ${sample_id}",
@@ -336,26 +266,45 @@ class SyngistixParser(InstrumentResultsFileParser):
                     numline=row_nr,
                 )
                 del parsed[keyword]
+        self.convert_readings(parsed, readings, sample_id, row_nr)
         return self.parse_row(row_nr, parsed, sample_id)
 
+    def convert_readings(self, parsed, readings, sample_id, row_nr):
+        """Converts the readings of a row to results, all at once
+
+        readings are (keyword, reading, precision) of the analyses found,
+        the readings are divided by 10000 and rounded to the precision of
+        their analysis. Readings that are not numbers are not imported.
+        """
+        interim_kw = "Reading"
+        values = clean_numbers(
+            [reading for keyword, reading, precision in readings],
+            divisor=10000,
+            precision=[precision for keyword, reading, precision in readings],
+        )
+        for (keyword, reading, precision), (value, flag) in zip(
+                readings, values):
+            if flag is not None:
+                self.warn(
+                    msg="Error getting analysis for '${kw}': ${sample_id}",
+                    mapping={"kw": keyword, "sample_id": sample_id},
+                    numline=row_nr,
+                )
+                del parsed[keyword]
+            else:
+                parsed[keyword][interim_kw] = str(value)
+
     def getDuplicateKeyword(self, analysis):
         keyword = analysis.getKeyword
         if analysis:
-            interim_fields = analysis.getObject().InterimFields
-            field_kws = [x.get("keyword") for x in interim_fields if x]
+            field_kws = self.resolver.get_interim_keywords(analysis)
             if "Reading" not in field_kws:
                 keyword = "No Interim Field"
         return keyword
 
-    @staticmethod
-    def get_duplicate_or_qc_analysis(analysis_id, kw):
-        portal_types = ["DuplicateAnalysis", "ReferenceAnalysis"]
-        query = dict(
-            portal_type=portal_types, getReferenceAnalysesGroupID=analysis_id
-        )
-        brains = api.search(query, ANALYSIS_CATALOG)
-        analyses = dict((a.getKeyword, a) for a in brains)
-        brains = [v for k, v in analyses.items() if k == kw]
+    def get_duplicate_or_qc_analysis(self, analysis_id, kw):
+        analyses = self.get_analysis_index(analysis_id)
+        brains = [analyses[kw]] if kw in analyses else []
         if len(brains) < 1:
             lmsg = "No analysis found for sample {} matching Keyword {}"
             msg = lmsg.format(analysis_id, kw)
@@ -366,29 +315,12 @@ class SyngistixParser(InstrumentResultsFileParser):
             raise MultipleAnalysesFound(msg)
         return brains[0]
 
-    @staticmethod
-    def get_ar(sample_id):
-        query = dict(portal_type="AnalysisRequest", getId=sample_id)
-        brains = api.search(query, CATALOG_ANALYSIS_REQUEST_LISTING)
-        try:
-            return api.get_object(brains[0])
-        except IndexError:
-            pass
-
-    @staticmethod
-    def is_sample(sample_id):
-        query = dict(portal_type="AnalysisRequest", getId=sample_id)
-        brains = api.search(query, CATALOG_ANALYSIS_REQUEST_LISTING)
-        return True if brains else False
-
-    @staticmethod
-    def get_analyses(ar):
-        analyses = ar.getAnalyses()
-        return dict((a.getKeyword, a) for a in analyses)
+    def get_analyses(self, ar):
+        return self.get_analysis_index(ar.getId()).by_keyword
 
     def get_analysis(self, ar, kw):
         analyses = self.get_analyses(ar)
-        analyses = [v for k, v in analyses.items() if k == kw]
+        analyses = [analyses[kw]] if kw in analyses else []
         if len(analyses) < 1:
             msg = (
                 "No analysis found for sample '${ar}' matching keyword '${kw}'"
@@ -403,16 +335,6 @@ class SyngistixParser(InstrumentResultsFileParser):
             return None
         return analyses[0]
 
-    @staticmethod
-    def is_analysis_group_id(analysis_group_id):
-        portal_types = ["DuplicateAnalysis", "ReferenceAnalysis"]
-        query = dict(
-            portal_type=portal_types,
-            getReferenceAnalysesGroupID=analysis_group_id,
-        )
-        brains = api.search(query, ANALYSIS_CATALOG)
-        return True if brains else False
-
     def remove_unwanted_columns(self, row):
         del row["R"]
         del row["Acquisition Time"]
@@ -434,6 +356,8 @@ class importer(object):
         self.request = None
 
     @staticmethod
+    @queued_import
+    @profiled_import
     def Import(context, request):
         errors = []
         logs = []
@@ -468,7 +392,8 @@ class importer(object):
             elif override == "overrideempty":
                 over = [True, True]
 
-            importer = AnalysisResultsImporter(
+            importer = make_importer(
+                request,
                 parser=parser,
                 context=context,
                 allowed_sample_states=status,
@@ -478,7 +403,8 @@ class importer(object):
             )
 
             try:
-                importer.process()
+                with timed(PROCESS):
+                    importer.process()
                 errors = importer.errors
                 logs = importer.logs
                 warns = importer.warns
@@ -552,7 +478,7 @@ class MyExport(BrowserView):
     def get_sample_weight_value(self, sample):
         weight_kw = "WeightDigested"
         services = sample.getAnalyses()
-        services_kw = [x.getObject().Keyword for x in services]
+        services_kw = [x.getKeyword for x in services]
         if weight_kw in services_kw:
             weight_indx = services_kw.index(weight_kw)
             weight_object = services[weight_indx].getObject()
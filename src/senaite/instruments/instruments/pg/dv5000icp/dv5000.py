@@ -22,22 +22,26 @@ from mimetypes import guess_type
 from os.path import abspath
 from os.path import splitext
 
-from openpyxl import load_workbook
 from zope.interface import implements
 
-from bika.lims import api
-from bika.lims.catalog import CATALOG_ANALYSIS_REQUEST_LISTING
 from senaite.instruments import senaiteMessageFactory as _
-from senaite.core.catalog import ANALYSIS_CATALOG
 from senaite.core.exportimport.instruments import (
     IInstrumentAutoImportInterface,
     IInstrumentImportInterface,
 )
 from senaite.core.exportimport.instruments.resultsimport import (
-    AnalysisResultsImporter,
     InstrumentResultsFileParser,
 )
 from senaite.instruments.instrument import SheetNotFound
+from senaite.instruments.instrument import iter_xlsx_rows
+from senaite.instruments.rawresults import CompactResultsMixin
+from senaite.instruments.resolver import ResolverMixin
+from senaite.instruments.profiling import PROCESS
+from senaite.instruments.profiling import ROW_PARSING
+from senaite.instruments.profiling import profiled_import
+from senaite.instruments.profiling import timed
+from senaite.instruments.queuedimport import queued_import
+from senaite.instruments.resultsimport import make_importer
 
 
 MEAN_MARKERS = (u"χ", "x", "X", "mean", "Mean", "MEAN")
@@ -63,7 +67,8 @@ class AnalysisNotFound(Exception):
     pass
 
 
-class DV5000ICPParser(InstrumentResultsFileParser):
+class DV5000ICPParser(ResolverMixin, CompactResultsMixin,
+                      InstrumentResultsFileParser):
     """Parser for PG DV5000 ICP Excel result files."""
 
     def __init__(self, infile, worksheet="Result", encoding=None):
@@ -77,33 +82,32 @@ class DV5000ICPParser(InstrumentResultsFileParser):
         mimetype, enc = guess_type(self.infile.filename)
         InstrumentResultsFileParser.__init__(self, infile, mimetype)
 
+    @timed(ROW_PARSING)
     def parse(self):
         ext = splitext(self.infile.filename.lower())[-1]
         if ext not in (".xlsx", ".xlsm"):
             self.err("Unsupported file format: %s" % ext)
             return -1
 
+        rows = self.iter_rows()
         try:
-            wb = load_workbook(filename=self.infile, data_only=True)
+            self.headers = self.get_headers(next(rows, []))
+            self.units = self.get_units(next(rows, []))
+        except SheetNotFound:
+            self.err("Sheet not found in workbook: %s" % self.worksheet)
+            return -1
         except Exception:
             self.err("Cannot open workbook: %s" % self.infile.filename)
             return -1
 
-        try:
-            ws = wb[self.worksheet]
-        except KeyError:
-            self.err("Sheet not found in workbook: %s" % self.worksheet)
-            return -1
-
-        self.headers = self.get_headers(ws)
-        self.units = self.get_units(ws)
         if not self.headers:
             self.err("No analyte headers found in row 1")
             return -1
 
+        results = []
         sample_id = None
-        for row_nr in range(3, ws.max_row + 1):
-            marker = self.safe_value(ws.cell(row=row_nr, column=1).value)
+        for row_nr, row in enumerate(rows, 3):
+            marker = self.safe_value(self.get_cells(row, 0, 1)[0])
             if not marker:
                 continue
 
@@ -113,25 +117,42 @@ class DV5000ICPParser(InstrumentResultsFileParser):
 
             if sample_id and marker in MEAN_MARKERS:
                 values = [
-                    self.safe_value(ws.cell(row=row_nr, column=col_nr).value)
-                    for col_nr in range(2, len(self.headers) + 2)
+                    self.safe_value(value) for value in
+                    self.get_cells(row, 1, len(self.headers) + 1)
                 ]
-                self.parse_result_row(sample_id, row_nr, values)
+                results.append((sample_id, row_nr, values))
 
+        self.prefetch([result[0] for result in results])
+        for sample_id, row_nr, values in results:
+            self.parse_result_row(sample_id, row_nr, values)
         return 1
 
-    def get_headers(self, ws):
+    def iter_rows(self):
+        """Yields the cell values of the worksheet rows, read one at a time
+        """
+        for row in iter_xlsx_rows(self.infile, self.worksheet):
+            yield [cell.value for cell in row]
+
+    @staticmethod
+    def get_cells(row, start, stop):
+        """Returns the values row[start:stop], padded with None when the row
+        is shorter
+        """
+        values = list(row[start:stop])
+        return values + [None] * (stop - start - len(values))
+
+    def get_headers(self, row):
         headers = []
-        for col_nr in range(2, ws.max_column + 1):
-            value = self.safe_value(ws.cell(row=1, column=col_nr).value)
+        for value in row[1:]:
+            value = self.safe_value(value)
             if value:
                 headers.append(value)
         return headers
 
-    def get_units(self, ws):
+    def get_units(self, row):
         units = []
-        for col_nr in range(2, len(self.headers) + 2):
-            units.append(self.safe_value(ws.cell(row=2, column=col_nr).value))
+        for value in self.get_cells(row, 1, len(self.headers) + 1):
+            units.append(self.safe_value(value))
         return units
 
     @staticmethod
@@ -204,7 +225,7 @@ class DV5000ICPParser(InstrumentResultsFileParser):
             return 0
 
         parsed = {}
-        analyses = ar.getAnalyses()
+        analyses = self.resolver.get_analyses(sample_id)
         for header, value in zip(self.headers, values):
             keyword = self.normalize_keyword(header)
             if not keyword or value == "":
@@ -216,11 +237,7 @@ class DV5000ICPParser(InstrumentResultsFileParser):
         return 0
 
     def parse_duplicate_and_reference_row(self, sample_id, row_nr, values):
-        query = dict(
-            portal_type=["DuplicateAnalysis", "ReferenceAnalysis"],
-            getReferenceAnalysesGroupID=sample_id,
-        )
-        analyses = api.search(query, ANALYSIS_CATALOG)
+        analyses = self.resolver.get_group_analyses(sample_id)
         parsed = {}
         for header, value in zip(self.headers, values):
             keyword = self.normalize_keyword(header)
@@ -293,13 +310,8 @@ class DV5000ICPParser(InstrumentResultsFileParser):
     def analysis_keyword(analysis):
         return analysis.getKeyword
 
-    @staticmethod
-    def interim_keywords(analysis):
-        obj = analysis.getObject() if hasattr(analysis, "getObject") \
-            else analysis
-        fields = obj.getInterimFields() if hasattr(obj, "getInterimFields") \
-            else getattr(obj, "InterimFields", [])
-        return [field.get("keyword") for field in fields if field]
+    def interim_keywords(self, analysis):
+        return self.resolver.get_interim_keywords(analysis)
 
     def get_portal_type(self, sample_id):
         if self.is_sample(sample_id):
@@ -311,29 +323,12 @@ class DV5000ICPParser(InstrumentResultsFileParser):
             return "DuplicateAnalysis"
         return None
 
-    @staticmethod
-    def get_ar(sample_id):
-        query = dict(portal_type="AnalysisRequest", getId=sample_id)
-        brains = api.search(query, CATALOG_ANALYSIS_REQUEST_LISTING)
-        try:
-            return api.get_object(brains[0])
-        except IndexError:
-            return None
-
-    @staticmethod
-    def is_sample(sample_id):
-        query = dict(portal_type="AnalysisRequest", getId=sample_id)
-        brains = api.search(query, CATALOG_ANALYSIS_REQUEST_LISTING)
-        return True if brains else False
-
-    @staticmethod
-    def get_analyses(ar):
-        analyses = ar.getAnalyses()
-        return dict((a.getKeyword, a) for a in analyses)
+    def get_analyses(self, ar):
+        return self.get_analysis_index(ar.getId()).by_keyword
 
     def get_analysis(self, ar, kw):
         analyses = self.get_analyses(ar)
-        analyses = [v for k, v in analyses.items() if k == kw]
+        analyses = [analyses[kw]] if kw in analyses else []
         if len(analyses) < 1:
             self.warn(
                 msg="No analysis found for sample '${ar}' matching keyword '${kw}'",
@@ -348,26 +343,9 @@ class DV5000ICPParser(InstrumentResultsFileParser):
             return None
         return analyses[0]
 
-    @staticmethod
-    def is_analysis_group_id(analysis_group_id):
-        portal_types = ["DuplicateAnalysis", "ReferenceAnalysis"]
-        query = dict(
-            portal_type=portal_types,
-            getReferenceAnalysesGroupID=analysis_group_id,
-        )
-        brains = api.search(query, ANALYSIS_CATALOG)
-        return True if brains else False
-
-    @staticmethod
-    def get_duplicate_or_qc_analysis(analysis_id, kw):
-        portal_types = ["DuplicateAnalysis", "ReferenceAnalysis"]
-        query = dict(
-            portal_type=portal_types,
-            getReferenceAnalysesGroupID=analysis_id,
-        )
-        brains = api.search(query, ANALYSIS_CATALOG)
-        analyses = dict((a.getKeyword, a) for a in brains)
-        brains = [v for k, v in analyses.items() if k == kw]
+    def get_duplicate_or_qc_analysis(self, analysis_id, kw):
+        analyses = self.get_analysis_index(analysis_id)
+        brains = [analyses[kw]] if kw in analyses else []
         if len(brains) < 1:
             msg = "No analysis found for sample {} matching Keyword {}"
             raise AnalysisNotFound(msg.format(analysis_id, kw))
@@ -387,6 +365,8 @@ class importer(object):
         self.request = None
 
     @staticmethod
+    @queued_import
+    @profiled_import
     def Import(context, request):
         errors = []
         logs = []
@@ -421,7 +401,8 @@ class importer(object):
             elif override == "overrideempty":
                 over = [True, True]
 
-            results_importer = AnalysisResultsImporter(
+            results_importer = make_importer(
+                request,
                 parser=parser,
                 context=context,
                 allowed_sample_states=status,
@@ -431,7 +412,8 @@ class importer(object):
             )
 
             try:
-                results_importer.process()
+                with timed(PROCESS):
+                    results_importer.process()
                 errors = results_importer.errors
                 logs = results_importer.logs
                 warns = results_importer.warns
@@ -7,7 +7,6 @@ from os.path import abspath
 
 from DateTime import DateTime
 from bika.lims import api
-from bika.lims.catalog import CATALOG_ANALYSIS_REQUEST_LISTING
 from senaite.core.exportimport.instruments import IInstrumentAutoImportInterface
 from senaite.core.exportimport.instruments import IInstrumentExportInterface
 from senaite.core.exportimport.instruments import IInstrumentImportInterface
@@ -18,6 +17,18 @@ from senaite.core.exportimport.instruments.utils import \
 from senaite.core.exportimport.instruments.resultsimport import AnalysisResultsImporter
 from senaite.core.exportimport.instruments.resultsimport import \
     InstrumentCSVResultsFileParser
+from senaite.instruments.numeric import EMPTY
+from senaite.instruments.numeric import NOT_DETECTED
+from senaite.instruments.numeric import NO_VALUE
+from senaite.instruments.numeric import parse_number
+from senaite.instruments.rawresults import CompactResultsMixin
+from senaite.instruments.resolver import ResolverMixin
+from senaite.instruments.resolver import SampleResolver
+from senaite.instruments.resolver import get_interim_fields
+from senaite.instruments.profiling import PROCESS
+from senaite.instruments.profiling import profiled_import
+from senaite.instruments.profiling import timed
+from senaite.instruments.queuedimport import queued_import
 from plone.i18n.normalizer.interfaces import IIDNormalizer
 from zope.component import getUtility
 from zope.interface import implements
@@ -106,6 +117,8 @@ class xcaliburimport(object):
         self.context = context
         self.request = None
 
+    @queued_import
+    @profiled_import
     def Import(self, context, request):
         """ Read Dimensional-CSV analysis results
         """
@@ -138,7 +151,8 @@ class xcaliburimport(object):
             form=form)
         tbex = ''
         try:
-            importer.process()
+            with timed(PROCESS):
+                importer.process()
         except Exception as e:
             tbex = traceback.format_exc()
         errors = importer.errors
@@ -152,12 +166,34 @@ class xcaliburimport(object):
         return json.dumps(results)
 
 
-def is_keyword(kw):
+# Keywords indexed in the setup catalog per catalog path, together with the
+# catalog counter they were loaded at
+_keywords_cache = {}
+
+
+def get_keywords():
+    """ Returns the set of keywords indexed in bika_setup_catalog
+
+        The set is kept for the whole process and only loaded again when the
+        catalog counter changes, that is, when setup items were (re)indexed.
+    """
     bsc = api.get_tool('bika_setup_catalog')
-    return len(bsc(getKeyword=kw))
+    path = bsc.getPhysicalPath()
+    counter = bsc.getCounter()
+    cached = _keywords_cache.get(path)
+    if cached is None or cached[0] != counter:
+        keywords = frozenset(bsc.uniqueValuesFor('getKeyword'))
+        cached = _keywords_cache[path] = (counter, keywords)
+    return cached[1]
+
 
+def is_keyword(kw, keywords=None):
+    if keywords is None:
+        keywords = get_keywords()
+    return kw in keywords
 
-def find_analyses(ar_or_sample):
+
+def find_analyses(ar_or_sample, resolver=None):
     """ This function is used to find keywords that are not on the analysis
         but keywords that are on the interim fields.
 
@@ -165,23 +201,30 @@ def find_analyses(ar_or_sample):
         resultsimport.py or somewhere central where it can be used by other
         instrument interfaces.
     """
-    bc = api.get_tool(CATALOG_ANALYSIS_REQUEST_LISTING)
-    ar = bc(portal_type='AnalysisRequest', id=ar_or_sample)
-    if len(ar) == 0:
-        ar = bc(portal_type='AnalysisRequest', getClientSampleID=ar_or_sample)
-    if len(ar) == 1:
-        obj = ar[0].getObject()
-        analyses = obj.getAnalyses(full_objects=True)
-        return analyses
+    resolver = resolver or SampleResolver()
+    sample_id = resolver.get_sample_id(ar_or_sample)
+    if sample_id:
+        return map(api.get_object, resolver.get_analyses(sample_id))
     return []
 
 
 def get_interims_keywords(analysis):
-    interims = api.safe_getattr(analysis, 'getInterimFields')
+    interims = get_interim_fields(analysis)
     return map(lambda item: item['keyword'], interims)
 
 
-def find_analysis_interims(ar_or_sample):
+def find_interims_map(ar_or_sample, resolver=None):
+    """ Returns a mapping of interim keyword -> analysis keywords for the
+        sample, built once per sample and import by the resolver
+    """
+    resolver = resolver or SampleResolver()
+    sample_id = resolver.get_sample_id(ar_or_sample)
+    if sample_id:
+        return resolver.get_interims_map(sample_id)
+    return {}
+
+
+def find_analysis_interims(ar_or_sample, resolver=None):
     """ This function is used to find keywords that are not on the analysis
         but keywords that are on the interim fields.
 
@@ -189,14 +232,10 @@ def find_analysis_interims(ar_or_sample):
         resultsimport.py or somewhere central where it can be used by other
         instrument interfaces.
     """
-    interim_fields = list()
-    for analysis in find_analyses(ar_or_sample):
-        keywords = get_interims_keywords(analysis)
-        interim_fields.extend(keywords)
-    return list(set(interim_fields))
+    return list(find_interims_map(ar_or_sample, resolver))
 
 
-def find_kw(ar_or_sample, kw):
+def find_kw(ar_or_sample, kw, resolver=None):
     """ This function is used to find keywords that are not on the analysis
         but keywords that are on the interim fields.
 
@@ -204,13 +243,14 @@ def find_kw(ar_or_sample, kw):
         resultsimport.py or somewhere central where it can be used by other
         instrument interfaces.
     """
-    for analysis in find_analyses(ar_or_sample):
-        if kw in get_interims_keywords(analysis):
-            return analysis.getKeyword()
+    keywords = find_interims_map(ar_or_sample, resolver).get(kw)
+    if keywords:
+        return keywords[0]
     return None
 
 
-class XCaliburCSVParser(InstrumentCSVResultsFileParser):
+class XCaliburCSVParser(ResolverMixin, CompactResultsMixin,
+                        InstrumentCSVResultsFileParser):
 
     QUANTITATIONRESULTS_NUMERICHEADERS = ('Title8', 'Title9', 'Title31',
                                           'Title32', 'Title41', 'Title42',
@@ -220,6 +260,8 @@ class XCaliburCSVParser(InstrumentCSVResultsFileParser):
         InstrumentCSVResultsFileParser.__init__(self, csv)
         self._end_header = False
         self._keywords = []
+        self._clean_keywords = []
+        self._service_keywords = frozenset()
         self._quantitationresultsheader = []
         self._numline = 0
 
@@ -241,6 +283,9 @@ class XCaliburCSVParser(InstrumentCSVResultsFileParser):
         splitted = [token.strip() for token in line.split(',')]
         if splitted[-1] == 'end':
             self._keywords = splitted[1:-1]  # exclude the word end
+            self._clean_keywords = [re.sub(r"\W", "", keyword)
+                                    for keyword in self._keywords]
+            self._service_keywords = get_keywords()
             self._end_header = True
         return 0
 
@@ -289,9 +334,9 @@ class XCaliburCSVParser(InstrumentCSVResultsFileParser):
             result = self.get_result(column_name, result, line)
             quantitation[quantitation['DefaultResult']] = result
 
-            kw = re.sub(r"\W", "", self._keywords[i])
-            if not is_keyword(kw):
-                new_kw = find_kw(quantitation['AR'], kw)
+            kw = self._clean_keywords[i]
+            if not is_keyword(kw, self._service_keywords):
+                new_kw = find_kw(quantitation['AR'], kw, self.resolver)
                 if new_kw:
                     quantitation[kw] = quantitation['resultValue']
                     del quantitation['resultValue']
@@ -302,7 +347,8 @@ class XCaliburCSVParser(InstrumentCSVResultsFileParser):
                             break
                     if found:
                         continue
-                    interims = find_analysis_interims(quantitation['AR'])
+                    interims = find_analysis_interims(
+                        quantitation['AR'], self.resolver)
                     # pairing headers(keywords) and their values(results) per line
                     keyword_value_dict = dict(zip(self._keywords, clean_splitted))
                     for interim in interims:
@@ -319,13 +365,12 @@ class XCaliburCSVParser(InstrumentCSVResultsFileParser):
             found = False
 
     def get_result(self, column_name, result, line):
-        result = str(result)
-        if result.startswith('--') or result == '' or result == 'ND':
+        value, flag = parse_number(str(result))
+        if flag in (EMPTY, NO_VALUE, NOT_DETECTED):
             return 0.0
 
-        if api.is_floatable(result):
-            result = api.to_float(result)
-            return result > 0.0 and result or 0.0
+        if flag is None:
+            return value > 0.0 and value or 0.0
         self.err("No valid number ${result} in column (${column_name})",
                  mapping={"result": result,
                           "column_name": column_name},
@@ -18,37 +18,35 @@
 # Copyright 2018-2019 by it's authors.
 # Some rights reserved, see README and LICENSE.
 
-import csv
 import json
-import types
 import traceback
-from Products.CMFPlone.utils import safe_unicode
-from cStringIO import StringIO
 from mimetypes import guess_type
-from openpyxl import load_workbook
 from os.path import abspath
-from os.path import splitext
 from re import subn
-from xlrd import open_workbook
 from zope.interface import implements
-from zope.publisher.browser import FileUpload
 
-from bika.lims import api
 from bika.lims.browser import BrowserView
-from bika.lims.catalog import CATALOG_ANALYSIS_REQUEST_LISTING
 from senaite.instruments import senaiteMessageFactory as _
-from senaite.core.catalog import ANALYSIS_CATALOG, SENAITE_CATALOG
 from senaite.core.exportimport.instruments import (
     IInstrumentAutoImportInterface,
     IInstrumentExportInterface,
     IInstrumentImportInterface,
 )
 from senaite.core.exportimport.instruments.resultsimport import (
-    AnalysisResultsImporter,
     InstrumentResultsFileParser,
 )
-from senaite.instruments.instrument import FileStub
 from senaite.instruments.instrument import SheetNotFound
+from senaite.instruments.instrument import iter_rows
+from senaite.instruments.instrument import iter_dict_rows
+from senaite.instruments.instrument import percent_cell_text
+from senaite.instruments.rawresults import CompactResultsMixin
+from senaite.instruments.resolver import ResolverMixin
+from senaite.instruments.profiling import PROCESS
+from senaite.instruments.profiling import ROW_PARSING
+from senaite.instruments.profiling import profiled_import
+from senaite.instruments.profiling import timed
+from senaite.instruments.queuedimport import queued_import
+from senaite.instruments.resultsimport import make_importer
 
 
 class SampleNotFound(Exception):
@@ -63,7 +61,8 @@ class AnalysisNotFound(Exception):
     pass
 
 
-class ALSXRFParser(InstrumentResultsFileParser):
+class ALSXRFParser(ResolverMixin, CompactResultsMixin,
+                   InstrumentResultsFileParser):
     ar = None
 
     def __init__(self, infile, worksheet=None, encoding=None, delimiter=None):
@@ -78,114 +77,20 @@ class ALSXRFParser(InstrumentResultsFileParser):
         mimetype, encoding = guess_type(self.infile.filename)
         InstrumentResultsFileParser.__init__(self, infile, mimetype)
 
-    def xls_to_csv(self, infile, worksheet="", delimiter=","):
-        """
-        Convert xlsx to easier format first, since we want to use the
-        convenience of the CSV library
-
-        """
-
-        def find_sheet(wb, worksheet):
-            for sheet in wb.sheets():
-                if sheet.name == worksheet:
-                    return sheet
-
-        wb = open_workbook(file_contents=infile.read())
-        sheet = wb.sheets()[worksheet]
-
-        buffer = StringIO()
-
-        # extract all rows
-        for row in sheet.get_rows():
-            line = []
-            for cell in row:
-                value = cell.value
-                if type(value) in types.StringTypes:
-                    value = value.encode("utf8")
-                if value is None:
-                    value = ""
-                line.append(str(value))
-            print >> buffer, delimiter.join(line)
-        buffer.seek(0)
-        return buffer
-
-    def xlsx_to_csv(self, infile, worksheet="", delimiter=","):
-        worksheet = worksheet if worksheet else 0
-        wb = load_workbook(filename=infile)
-        if worksheet in wb.sheetnames:
-            sheet = wb[worksheet]
-        else:
-            try:
-                index = int(worksheet)
-                sheet = wb.worksheets[index]
-            except (ValueError, TypeError, IndexError):
-                raise SheetNotFound
-
-        buffer = StringIO()
-        for row in sheet.rows:
-            line = []
-            for cell in row:
-                new_val = ""
-                if cell.number_format == "0.00%":
-                    new_val = "{}%".format(cell.value * 100)
-                cellval = new_val if new_val else cell.value
-
-                try:
-                    value = (
-                        "" if cellval is None
-                        else str(cellval).encode("utf8")
-                    )
-                except UnicodeEncodeError:
-                    value = (
-                        "" if cellval is None
-                        else safe_unicode(cellval).encode("utf8")
-                    )
-                if "\n" in value:  # fixme multi-line cell gives only 1st line
-                    value = value.split("\n")[0]
-                line.append(value.strip())
-            if not any(line):
-                continue
-            buffer.write(delimiter.join(line) + "\n")
-        buffer.seek(0)
-        return buffer
-
+    @timed(ROW_PARSING)
     def parse(self):
-        order = []
-        ext = splitext(self.infile.filename.lower())[-1]
-        if ext == ".xlsx":
-            order = (self.xlsx_to_csv, self.xls_to_csv)
-        elif ext == ".xls":
-            order = (self.xls_to_csv, self.xlsx_to_csv)
-        elif ext == ".csv":
-            self.csv_data = self.infile
-        if order:
-            for importer in order:
-                try:
-                    self.csv_data = importer(
-                        infile=self.infile,
-                        worksheet=self.worksheet,
-                        delimiter=self.delimiter,
-                    )
-                    break
-                except SheetNotFound:
-                    self.err(
-                        "Sheet not found in workbook: %s" % self.worksheet
-                    )
-                    return -1
-                except Exception as e:  # noqa
-                    pass
-            else:
-                self.warn("Can't parse input file as XLS, XLSX, or CSV.")
-                return -1
-        stub = FileStub(file=self.csv_data, name=str(self.infile.filename))
-        self.csv_data = FileUpload(stub)
+        try:
+            rows = iter_rows(
+                self.infile, self.worksheet, cell_text=percent_cell_text)
+        except SheetNotFound:
+            self.err("Sheet not found in workbook: %s" % self.worksheet)
+            return -1
+        except ValueError:
+            self.warn("Can't parse input file as XLS, XLSX, or CSV.")
+            return -1
 
         portal_type = ""
-        lines = self.csv_data.readlines()
-
-        # Process CSV rows
-        list_reader = csv.reader(lines)
-        rows = list(list_reader)
+        rows = list(rows)
         if len(rows) < 3:
             self.warn("CSV file does not have enough rows.")
             return -1
@@ -200,26 +105,13 @@ class ALSXRFParser(InstrumentResultsFileParser):
         combined_headers = self.make_headers_unique(combined_headers)
 
         # Process remaining rows using the combined headers
-        combined_list = [combined_headers] + rows[2:]
-
-        output = StringIO()
-        writer = csv.writer(output)
-        for row in combined_list:
-            writer.writerow(row)
-
-        # Move to the beginning so DictReader can read from it
-        output.seek(0)
-
-        # Read using DictReader
-        reader = csv.DictReader(output)
         results = []
-
-        for row in reader:
+        for row_num, row in iter_dict_rows([combined_headers] + rows[2:]):
             new_row = self.remove_unwanted_columns(row)
-            results.append(new_row)
+            results.append((row_num, new_row))
+        self.prefetch([row.get("SID Value 5", "") for row_num, row in results])
 
-        row_num = 1
-        for row in results:
+        for row_num, row in results:
             sample_id = row.get("SID Value 5", "")
             del row["SID Value 5"]
             portal_type = self.get_portal_type(sample_id)
@@ -233,9 +125,8 @@ class ALSXRFParser(InstrumentResultsFileParser):
                 self.warn(
                     msg="No results found for '${sample_id}'",
                     mapping={"sample_id": sample_id},
-                    numline=str(reader.line_num),
+                    numline=str(row_num),
                 )
-            row_num = row_num + 1
         return 1
 
     def make_headers_unique(self, headers):
@@ -316,10 +207,9 @@ class ALSXRFParser(InstrumentResultsFileParser):
             keyword = item[0]
             try:
                 analysis = self.get_analysis(ar, keyword)
-                analysis_obj = analysis.getObject()
-                interim_fields = analysis_obj.InterimFields
-                precision = analysis_obj.Precision or 5
-                field_kws = [x.get("keyword") for x in interim_fields if x]
+                precision = self.get_metadata(
+                    analysis, "Precision") or 5
+                field_kws = self.resolver.get_interim_keywords(analysis)
                 if "Reading" not in field_kws:
                     self.warn(
                         msg="No interim field 'Reading' was found for Analysis"
@@ -362,7 +252,8 @@ class ALSXRFParser(InstrumentResultsFileParser):
                     sample_id, keyword
                 )
                 dup_keyword = self.getDuplicateKeyword(analysis)
-                precision = analysis.getObject().Precision or 5
+                precision = self.get_metadata(
+                    analysis, "Precision") or 5
                 if not dup_keyword:
                     del parsed[keyword]
                 elif "No Interim Field" in dup_keyword:
@@ -390,22 +281,14 @@ class ALSXRFParser(InstrumentResultsFileParser):
     def getDuplicateKeyword(self, analysis):
         keyword = analysis.getKeyword
         if analysis:
-            interim_fields = analysis.getObject().InterimFields
-            field_kws = [x.get("keyword") for x in interim_fields if x]
+            field_kws = self.resolver.get_interim_keywords(analysis)
             if "Reading" not in field_kws:
                 keyword = "No Interim Field"
         return keyword
 
-    @staticmethod
-    def get_duplicate_or_qc_analysis(analysis_id, kw):
-        portal_types = ["DuplicateAnalysis", "ReferenceAnalysis"]
-        query = dict(
-            portal_type=portal_types,
-            getReferenceAnalysesGroupID=analysis_id
-            )
-        brains = api.search(query, ANALYSIS_CATALOG)
-        analyses = dict((a.getKeyword, a) for a in brains)
-        brains = [v for k, v in analyses.items() if k == kw]
+    def get_duplicate_or_qc_analysis(self, analysis_id, kw):
+        analyses = self.get_analysis_index(analysis_id)
+        brains = [analyses[kw]] if kw in analyses else []
         if len(brains) < 1:
             lmsg = "No analysis found for sample {} matching Keyword {}"
             msg = lmsg.format(analysis_id, kw)
@@ -416,29 +299,12 @@ class ALSXRFParser(InstrumentResultsFileParser):
             raise MultipleAnalysesFound(msg)
         return brains[0]
 
-    @staticmethod
-    def get_ar(sample_id):
-        query = dict(portal_type="AnalysisRequest", getId=sample_id)
-        brains = api.search(query, CATALOG_ANALYSIS_REQUEST_LISTING)
-        try:
-            return api.get_object(brains[0])
-        except IndexError:
-            pass
-
-    @staticmethod
-    def is_sample(sample_id):
-        query = dict(portal_type="AnalysisRequest", getId=sample_id)
-        brains = api.search(query, CATALOG_ANALYSIS_REQUEST_LISTING)
-        return True if brains else False
-
-    @staticmethod
-    def get_analyses(ar):
-        analyses = ar.getAnalyses()
-        return dict((a.getKeyword, a) for a in analyses)
+    def get_analyses(self, ar):
+        return self.get_analysis_index(ar.getId()).by_keyword
 
     def get_analysis(self, ar, kw):
         analyses = self.get_analyses(ar)
-        analyses = [v for k, v in analyses.items() if k == kw]
+        analyses = [analyses[kw]] if kw in analyses else []
         if len(analyses) < 1:
             msg = (
                 "No analysis found for sample '${ar}' matching keyword '${kw}'"
@@ -453,22 +319,6 @@ class ALSXRFParser(InstrumentResultsFileParser):
             return None
         return analyses[0]
 
-    @staticmethod
-    def is_analysis_group_id(analysis_group_id):
-        portal_types = ["DuplicateAnalysis", "ReferenceAnalysis"]
-        query = dict(
-            portal_type=portal_types,
-            getReferenceAnalysesGroupID=analysis_group_id
-        )
-        brains = api.search(query, ANALYSIS_CATALOG)
-        return True if brains else False
-
-    @staticmethod
-    def is_reference_sample(reference_sample_id):
-        query = dict(portal_type="ReferenceSample", getId=reference_sample_id)
-        brains = api.search(query, SENAITE_CATALOG)
-        return True if brains else False
-
     def remove_unwanted_columns(self, row):
         del row["SID Value 1"]
         del row["SID Value 2"]
@@ -494,6 +344,8 @@ class importer(object):
         self.request = None
 
     @staticmethod
+    @queued_import
+    @profiled_import
     def Import(context, request):
         errors = []
         logs = []
@@ -527,7 +379,8 @@ class importer(object):
             elif override == "overrideempty":
                 over = [True, True]
 
-            importer = AnalysisResultsImporter(
+            importer = make_importer(
+                request,
                 parser=parser,
                 context=context,
                 allowed_sample_states=status,
@@ -537,7 +390,8 @@ class importer(object):
             )
 
             try:
-                importer.process()
+                with timed(PROCESS):
+                    importer.process()
                 errors = importer.errors
                 logs = importer.logs
                 warns = importer.warns
@@ -8,20 +8,27 @@ import traceback
 from cStringIO import StringIO
 from mimetypes import guess_type
 from os.path import abspath
-from os.path import splitext
 
-from openpyxl import load_workbook
 from xlrd import open_workbook
 from zope.interface import implements
 
-from bika.lims import api
-from bika.lims.catalog import CATALOG_ANALYSIS_REQUEST_LISTING
-from senaite.core.catalog import ANALYSIS_CATALOG
 from senaite.core.exportimport.instruments import IInstrumentAutoImportInterface
 from senaite.core.exportimport.instruments import IInstrumentImportInterface
-from senaite.core.exportimport.instruments.resultsimport import AnalysisResultsImporter
 from senaite.core.exportimport.instruments.resultsimport import InstrumentResultsFileParser
 from senaite.instruments import senaiteMessageFactory as _
+from senaite.instruments.instrument import CSV
+from senaite.instruments.instrument import XLS
+from senaite.instruments.instrument import XLSX
+from senaite.instruments.instrument import detect_format
+from senaite.instruments.instrument import iter_xlsx_rows
+from senaite.instruments.rawresults import CompactResultsMixin
+from senaite.instruments.resolver import ResolverMixin
+from senaite.instruments.profiling import PROCESS
+from senaite.instruments.profiling import ROW_PARSING
+from senaite.instruments.profiling import profiled_import
+from senaite.instruments.profiling import timed
+from senaite.instruments.queuedimport import queued_import
+from senaite.instruments.resultsimport import make_importer
 
 
 IDENTITY_HEADERS = ("sample name", "seq", "meas date/time", "sum",
@@ -34,7 +41,8 @@ INTERIM_HEADERS = {
 }
 
 
-class AxiosXRFParser(InstrumentResultsFileParser):
+class AxiosXRFParser(ResolverMixin, CompactResultsMixin,
+                     InstrumentResultsFileParser):
     """Parse the result table in an Axios CSV, XLS, or XLSX export."""
 
     def __init__(self, infile, worksheet=0, encoding=None, delimiter=None):
@@ -45,15 +53,16 @@ class AxiosXRFParser(InstrumentResultsFileParser):
         mimetype, unused = guess_type(infile.filename)
         InstrumentResultsFileParser.__init__(self, infile, mimetype)
 
+    @timed(ROW_PARSING)
     def parse(self):
         try:
-            rows = self.read_rows()
+            rows = iter(self.read_rows())
+            header_nr, columns, result_columns = self.find_header(rows)
         except Exception:
             self.err("Unable to read '{}':\n{}".format(
                 self.infile.filename, traceback.format_exc()))
             return -1
 
-        header_nr, columns, result_columns = self.find_header(rows)
         if header_nr is None:
             self.err("Could not find the 'Sample name' result table header")
             return -1
@@ -61,7 +70,11 @@ class AxiosXRFParser(InstrumentResultsFileParser):
             self.err("No analyte result columns were found")
             return -1
 
-        for row_nr, row in enumerate(rows[header_nr + 1:], header_nr + 2):
+        # the rows after the header, read and resolved in batches
+        rows = self.iter_prefetched(
+            enumerate(rows, header_nr + 2),
+            lambda item: self.cell(item[1], columns["sample name"]))
+        for row_nr, row in rows:
             sample_id = self.cell(row, columns["sample name"])
             if not sample_id:
                 continue
@@ -148,30 +161,19 @@ class AxiosXRFParser(InstrumentResultsFileParser):
     def analysis_keyword(analysis):
         return analysis.getKeyword
 
-    @staticmethod
-    def interim_keywords(analysis):
-        obj = analysis.getObject() if hasattr(analysis, "getObject") else analysis
-        fields = obj.getInterimFields() if hasattr(obj, "getInterimFields") \
-            else getattr(obj, "InterimFields", [])
-        return [field.get("keyword") for field in fields if field]
+    def interim_keywords(self, analysis):
+        return self.resolver.get_interim_keywords(analysis)
 
     def get_analyses(self, sample_id):
-        ar = self.get_ar(sample_id)
-        if ar:
-            return ar.getAnalyses()
-        query = dict(
-            portal_type=["DuplicateAnalysis", "ReferenceAnalysis"],
-            getReferenceAnalysesGroupID=sample_id,
-        )
-        return api.search(query, ANALYSIS_CATALOG)
-
-    @staticmethod
-    def get_ar(sample_id):
-        query = dict(portal_type="AnalysisRequest", getId=sample_id)
-        brains = api.search(query, CATALOG_ANALYSIS_REQUEST_LISTING)
-        return api.get_object(brains[0]) if brains else None
+        if self.is_sample(sample_id):
+            return self.resolver.get_analyses(sample_id)
+        return self.resolver.get_group_analyses(sample_id)
 
     def find_header(self, rows):
+        """Returns the header row number, identity and result columns
+
+        Only the rows up to the header are read from an iterator.
+        """
         for row_nr, row in enumerate(rows):
             normalized = [self.normalize_label(value) for value in row]
             sample_columns = [i for i, value in enumerate(normalized)
@@ -198,35 +200,27 @@ class AxiosXRFParser(InstrumentResultsFileParser):
         return None
 
     def read_rows(self):
-        extension = splitext(self.infile.filename.lower())[-1]
-        self.infile.seek(0)
-        if extension == ".csv":
+        """Returns an iterator over the rows of the file as lists of strings
+        """
+        file_format = detect_format(self.infile)
+        if file_format == CSV:
             data = self.infile.read()
             if isinstance(data, unicode):
                 data = data.encode(self.encoding)
             delimiter = self.delimiter or self.detect_delimiter(data)
-            return [self.clean_row(row) for row in
-                    csv.reader(StringIO(data), delimiter=delimiter)]
-        if extension in (".xlsx", ".xlsm"):
-            workbook = load_workbook(filename=self.infile, data_only=True)
-            sheet = self.get_xlsx_sheet(workbook)
-            return [[self.safe_value(cell.value) for cell in row]
-                    for row in sheet.iter_rows()]
-        if extension == ".xls":
+            return (self.clean_row(row) for row in
+                    csv.reader(StringIO(data), delimiter=delimiter))
+        if file_format == XLSX:
+            return ([self.safe_value(cell.value) for cell in row]
+                    for row in iter_xlsx_rows(self.infile, self.worksheet))
+        if file_format == XLS:
             workbook = open_workbook(file_contents=self.infile.read())
             sheet = workbook.sheet_by_name(self.worksheet) \
                 if isinstance(self.worksheet, basestring) \
                 else workbook.sheet_by_index(int(self.worksheet))
-            return [[self.safe_value(sheet.cell_value(r, c))
-                    for c in range(sheet.ncols)] for r in range(sheet.nrows)]
-        raise ValueError("Unsupported file format: {}".format(extension))
-
-    def get_xlsx_sheet(self, workbook):
-        if isinstance(self.worksheet, basestring):
-            if self.worksheet not in workbook.sheetnames:
-                raise ValueError("Sheet not found: {}".format(self.worksheet))
-            return workbook[self.worksheet]
-        return workbook.worksheets[int(self.worksheet)]
+            return ([self.safe_value(sheet.cell_value(r, c))
+                    for c in range(sheet.ncols)] for r in range(sheet.nrows))
+        raise ValueError("Can't parse input file as XLS, XLSX, or CSV.")
 
     @staticmethod
     def detect_delimiter(data):
@@ -279,6 +273,8 @@ class importer(object):
         self.parser = None
 
     @staticmethod
+    @queued_import
+    @profiled_import
     def Import(context, request):
         errors, logs, warns = [], [], []
         infile = request.form["instrument_results_file"]
@@ -293,12 +289,14 @@ class importer(object):
         override = request.form.get("results_override", "overrideempty")
         over = {"override": [True, False],
                 "overrideempty": [True, True]}.get(override, [False, False])
-        results_importer = AnalysisResultsImporter(
+        results_importer = make_importer(
+            request,
             parser=parser, context=context, allowed_sample_states=states,
             allowed_analysis_states=None, override=over,
             instrument_uid=request.form.get("instrument"))
         try:
-            results_importer.process()
+            with timed(PROCESS):
+                results_importer.process()
             errors.extend(results_importer.errors)
             logs.extend(results_importer.logs)
             warns.extend(results_importer.warns)
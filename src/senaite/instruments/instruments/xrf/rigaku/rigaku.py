@@ -13,10 +13,15 @@ from zope.interface import implements
 
 from senaite.core.exportimport.instruments import IInstrumentAutoImportInterface
 from senaite.core.exportimport.instruments import IInstrumentImportInterface
-from senaite.core.exportimport.instruments.resultsimport import AnalysisResultsImporter
 from senaite.core.exportimport.instruments.resultsimport import InstrumentResultsFileParser
 from senaite.instruments import senaiteMessageFactory as _
 from senaite.instruments.instruments.xrf.axios.axios import AxiosXRFParser
+from senaite.instruments.profiling import PROCESS
+from senaite.instruments.profiling import ROW_PARSING
+from senaite.instruments.profiling import profiled_import
+from senaite.instruments.profiling import timed
+from senaite.instruments.queuedimport import queued_import
+from senaite.instruments.resultsimport import make_importer
 
 
 class RigakuXRFParser(AxiosXRFParser):
@@ -28,6 +33,7 @@ class RigakuXRFParser(AxiosXRFParser):
         mimetype, unused = guess_type(infile.filename)
         InstrumentResultsFileParser.__init__(self, infile, mimetype)
 
+    @timed(ROW_PARSING)
     def parse(self):
         extension = splitext(self.infile.filename.lower())[-1]
         if extension != ".csv":
@@ -87,6 +93,8 @@ class importer(object):
         self.parser = None
 
     @staticmethod
+    @queued_import
+    @profiled_import
     def Import(context, request):
         errors, logs, warns = [], [], []
         infile = request.form["instrument_results_file"]
@@ -100,12 +108,14 @@ class importer(object):
         override = request.form.get("results_override", "overrideempty")
         over = {"override": [True, False],
                 "overrideempty": [True, True]}.get(override, [False, False])
-        results_importer = AnalysisResultsImporter(
+        results_importer = make_importer(
+            request,
             parser=parser, context=context, allowed_sample_states=states,
             allowed_analysis_states=None, override=over,
             instrument_uid=request.form.get("instrument"))
         try:
-            results_importer.process()
+            with timed(PROCESS):
+                results_importer.process()
             errors.extend(results_importer.errors)
             logs.extend(results_importer.logs)
             warns.extend(results_importer.warns)
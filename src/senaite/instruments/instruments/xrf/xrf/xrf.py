@@ -24,18 +24,21 @@ from os.path import abspath
 from re import subn
 from zope.interface import implements
 
-from bika.lims import api
-from senaite.core.catalog import SAMPLE_CATALOG
-from senaite.core.catalog import ANALYSIS_CATALOG, SENAITE_CATALOG
 from senaite.instruments import senaiteMessageFactory as _
 from senaite.core.exportimport.instruments import (
     IInstrumentAutoImportInterface,
     IInstrumentImportInterface,
 )
 from senaite.core.exportimport.instruments.resultsimport import (
-    AnalysisResultsImporter,
     InstrumentCSVResultsFileParser,
 )
+from senaite.instruments.rawresults import CompactResultsMixin
+from senaite.instruments.resolver import ResolverMixin
+from senaite.instruments.profiling import PROCESS
+from senaite.instruments.profiling import profiled_import
+from senaite.instruments.profiling import timed
+from senaite.instruments.queuedimport import queued_import
+from senaite.instruments.resultsimport import make_importer
 
 
 class MultipleAnalysesFound(Exception):
@@ -56,6 +59,8 @@ class importer(object):
         self.request = None
 
     @staticmethod
+    @queued_import
+    @profiled_import
     def Import(context, request):
         """ Read XRF results
         """
@@ -95,7 +100,8 @@ class importer(object):
             elif override == "overrideempty":
                 over = [True, True]
 
-            importer = AnalysisResultsImporter(
+            importer = make_importer(
+                                   request,
                                    parser=parser,
                                    context=context,
                                    allowed_sample_states=status,
@@ -104,7 +110,8 @@ class importer(object):
                                    instrument_uid=instrument)
             tbex = ''
             try:
-                importer.process()
+                with timed(PROCESS):
+                    importer.process()
             except Exception:
                 tbex = traceback.format_exc()
             errors = importer.errors
@@ -117,7 +124,8 @@ class importer(object):
         return json.dumps(results)
 
 
-class XRFTXTParser2(InstrumentCSVResultsFileParser):
+class XRFTXTParser2(ResolverMixin, CompactResultsMixin,
+                    InstrumentCSVResultsFileParser):
     HEADERTABLE = []
     HEADERTABLE_DATA = []
     COMMAS = '\t '
@@ -275,7 +283,7 @@ class XRFTXTParser2(InstrumentCSVResultsFileParser):
     def get_reference_sample_analysis(self, reference_sample, kw):
         kw = kw
         brains = self.get_reference_sample_analyses(reference_sample)
-        brains = [v for k, v in brains.items() if k == kw]
+        brains = [brains[kw]] if kw in brains else []
         if len(brains) < 1:
             lmsg = "No analysis found for sample {} matching Keyword {}"
             msg = lmsg.format(reference_sample, kw)
@@ -286,19 +294,13 @@ class XRFTXTParser2(InstrumentCSVResultsFileParser):
             raise MultipleAnalysesFound(msg)
         return brains[0]
 
-    @staticmethod
-    def get_reference_sample_analyses(reference_sample):
-        brains = reference_sample.getObject().getReferenceAnalyses()
-        return dict((a.getKeyword(), a) for a in brains)
+    def get_reference_sample_analyses(self, reference_sample):
+        index = self.get_analysis_index(reference_sample.getId)
+        return index.by_keyword
 
-    @staticmethod
-    def get_duplicate_or_qc_analysis(analysis_id, kw):
-        portal_types = ["DuplicateAnalysis", "ReferenceAnalysis"]
-        query = dict(portal_type=portal_types,
-                     getReferenceAnalysesGroupID=analysis_id)
-        brains = api.search(query, ANALYSIS_CATALOG)
-        analyses = dict((a.getKeyword, a) for a in brains)
-        brains = [v for k, v in analyses.items() if k == kw]
+    def get_duplicate_or_qc_analysis(self, analysis_id, kw):
+        analyses = self.get_analysis_index(analysis_id)
+        brains = [analyses[kw]] if kw in analyses else []
         if len(brains) < 1:
             lmsg = "No analysis found for sample {} matching Keyword {}"
             msg = lmsg.format(analysis_id, kw)
@@ -309,29 +311,12 @@ class XRFTXTParser2(InstrumentCSVResultsFileParser):
             raise MultipleAnalysesFound(msg)
         return brains[0]
 
-    @staticmethod
-    def get_ar(sample_id):
-        query = dict(portal_type="AnalysisRequest", getId=sample_id)
-        brains = api.search(query, SAMPLE_CATALOG)
-        try:
-            return api.get_object(brains[0])
-        except IndexError:
-            pass
-
-    @staticmethod
-    def is_sample(sample_id):
-        query = dict(portal_type="AnalysisRequest", getId=sample_id)
-        brains = api.search(query, SAMPLE_CATALOG)
-        return True if brains else False
-
-    @staticmethod
-    def get_analyses(ar):
-        analyses = ar.getAnalyses()
-        return dict((a.getKeyword, a) for a in analyses)
+    def get_analyses(self, ar):
+        return self.get_analysis_index(ar.getId()).by_keyword
 
     def get_analysis(self, ar, kw):
         analyses = self.get_analyses(ar)
-        analyses = [v for k, v in analyses.items() if k == kw]
+        analyses = [analyses[kw]] if kw in analyses else []
         if len(analyses) < 1:
             msg = "No analysis found for sample '${ar}' matching keyword '${kw}'"
             self.log(msg, mapping=dict(kw=kw, ar=ar.getId()))
@@ -344,26 +329,8 @@ class XRFTXTParser2(InstrumentCSVResultsFileParser):
             return None
         return analyses[0]
 
-    @staticmethod
-    def is_analysis_group_id(analysis_group_id):
-        portal_types = ["DuplicateAnalysis", "ReferenceAnalysis"]
-        query = dict(
-            portal_type=portal_types,
-            getReferenceAnalysesGroupID=analysis_group_id
-        )
-        brains = api.search(query, ANALYSIS_CATALOG)
-        return True if brains else False
-
-    @staticmethod
-    def is_reference_sample(reference_sample_id):
-        query = dict(portal_type="ReferenceSample", getId=reference_sample_id)
-        brains = api.search(query, SENAITE_CATALOG)
-        return True if brains else False
-
-    @staticmethod
-    def get_reference_sample(reference_sample_id, kw):
-        query = dict(portal_type="ReferenceSample", getId=reference_sample_id)
-        brains = api.search(query, SENAITE_CATALOG)
+    def get_reference_sample(self, reference_sample_id, kw):
+        brains = self.resolver.get_reference_samples(reference_sample_id)
         if len(brains) < 1:
             lmsg = "No reference sample found for sample {} matching Keyword {}"
             msg = lmsg.format(reference_sample_id, kw)
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.INSTRUMENTS.
+#
+# SENAITE.CORE is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright 2018-2019 by it's authors.
+# Some rights reserved, see README and LICENSE.
+
+"""Numeric cleaning of result cells, a whole column or row at a time
+
+Cells are parsed once into numbers and flags for the markers instruments
+write instead of numbers, then scaled and rounded the way the parsers did
+cell by cell, so the results are the same.
+"""
+
+import re
+
+# Flags of the cells that are not plain numbers
+EMPTY = "empty"
+BELOW = "<"
+ABOVE = ">"
+NOT_DETECTED = "ND"
+NO_VALUE = "--"
+OVER_RANGE = "OVER"
+INVALID = "invalid"
+
+NON_NUMERIC = re.compile(r"[^.\d]")
+
+
+def parse_number(value, strip=False):
+    """Returns the number of a cell and its flag, None for plain numbers
+
+    Cells starting with "<" or ">" have the number following the marker.
+    With strip, everything but digits and dots is removed before parsing,
+    so "12.5 ppm" is 12.5 (and "-1" is 1).
+    """
+    if isinstance(value, (int, long, float)):
+        return float(value), None
+    if value is None:
+        return None, EMPTY
+    if not isinstance(value, basestring):
+        value = str(value)
+    if value == "":
+        return None, EMPTY
+    if value.startswith(NO_VALUE):
+        return None, NO_VALUE
+    if value == NOT_DETECTED:
+        return None, NOT_DETECTED
+    if value.upper() == OVER_RANGE:
+        return None, OVER_RANGE
+    flag = None
+    text = value
+    if value[0] in (BELOW, ABOVE):
+        flag = value[0]
+        text = value[1:]
+    if strip:
+        text = NON_NUMERIC.sub("", text)
+    try:
+        return float(text), flag
+    except ValueError:
+        return None, INVALID
+
+
+class CleanValues(object):
+    """Numbers and flags of a set of cells, in the order of the cells
+    """
+
+    def __init__(self, values, flags):
+        self.values = values
+        self.flags = flags
+
+    def __len__(self):
+        return len(self.values)
+
+    def __iter__(self):
+        return iter(zip(self.values, self.flags))
+
+    @property
+    def invalid(self):
+        """Returns the positions of the cells that are not numbers
+        """
+        return [pos for pos, flag in enumerate(self.flags)
+                if flag == INVALID]
+
+
+def scale(values, factor=None, divisor=None):
+    """Multiplies by factor and divides by divisor the numbers of values
+
+    None stays None. The operations are the ones of the parsers, a division
+    is not turned into a multiplication, so the results are the same.
+    """
+    if factor is None and divisor is None:
+        return values
+    scaled = []
+    for value in values:
+        if value is not None:
+            if factor is not None:
+                value = value * factor
+            if divisor is not None:
+                value = value / divisor
+        scaled.append(value)
+    return scaled
+
+
+def clean_numbers(cells, factor=None, divisor=None, precision=None,
+                  strip=False):
+    """Parses, scales and rounds a column or row of result cells
+
+    precision is the number of decimals of all cells, or a list with the
+    decimals of each cell. Returns the CleanValues of the cells, flagged
+    cells keep the number after their marker, if any.
+    """
+    values = []
+    flags = []
+    for cell in cells:
+        value, flag = parse_number(cell, strip=strip)
+        values.append(value)
+        flags.append(flag)
+    values = scale(values, factor=factor, divisor=divisor)
+    if precision is not None:
+        if not isinstance(precision, (list, tuple)):
+            precision = [precision] * len(values)
+        values = [number if number is None else round(number, decimals)
+                  for number, decimals in zip(values, precision)]
+    return CleanValues(values, flags)
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.INSTRUMENTS.
+#
+# SENAITE.CORE is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright 2018-2019 by it's authors.
+# Some rights reserved, see README and LICENSE.
+
+"""Parsed results of the files imported lately, keyed by file content
+
+Uploading the same export twice, or an auto-import picking a file up again,
+then skips reading the file and resolving its Samples: the parser is handed
+the raw results of the first parse and only the results are applied.
+
+The parsers resolve the rows against the Samples and analyses, an entry is
+only used while the counters of the catalogs they are found in are the ones
+it was parsed with. Parsers that write to objects while parsing are marked
+with writes_on_parse and never answered from the cache, a cache hit would
+skip their writes.
+"""
+
+import threading
+from collections import OrderedDict
+from copy import deepcopy
+from time import time
+
+from bika.lims import api
+from senaite.core.catalog import ANALYSIS_CATALOG
+from senaite.core.catalog import SAMPLE_CATALOG
+from senaite.core.catalog import SENAITE_CATALOG
+from senaite.instruments import logger
+
+# Parsed files kept per process and for how many seconds
+CACHE_SIZE = 20
+CACHE_TTL = 600
+
+# Catalogs the parsed results depend on, a change in any of them means
+# Samples, analyses or services were added, changed or removed since
+STATE_CATALOGS = (SAMPLE_CATALOG, ANALYSIS_CATALOG, SENAITE_CATALOG,
+                  "bika_setup_catalog")
+
+_cache = OrderedDict()
+_lock = threading.Lock()
+
+
+def cache_key(checksum, parser, artoapply=None, override=None):
+    """Returns the key of an import of the file by the parser
+
+    The options are the values of the import form ("received", "override"
+    and so on) and the worksheet is the one the parser reads, so uploads and
+    batch imports of a file share their entries.
+    """
+    parser_class = parser.__class__
+    worksheet = getattr(parser, "worksheet",
+                        getattr(parser, "_worksheet", None))
+    return (checksum,
+            "%s.%s" % (parser_class.__module__, parser_class.__name__),
+            str(worksheet), str(artoapply), str(override))
+
+
+def get_state():
+    """Returns the counters of the catalogs the parsed results depend on
+    """
+    state = []
+    for name in STATE_CATALOGS:
+        catalog = api.get_tool(name)
+        state.append((catalog.getPhysicalPath(), catalog.getCounter()))
+    return tuple(state)
+
+
+def get_entry(key):
+    with _lock:
+        entry = _cache.get(key)
+    if entry is None:
+        return None
+    if entry["expires"] < time() or entry["state"] != get_state():
+        with _lock:
+            if _cache.get(key) is entry:
+                del _cache[key]
+        return None
+    return entry
+
+
+def store(key, parser, parsed):
+    """Keeps the raw results of a clean parse
+
+    Files with errors or warnings are not kept: their rows may refer to
+    Samples that do not exist yet and would be found the next time.
+    """
+    if parser.errors or parser.warns:
+        return
+    entry = dict(parsed=parsed, expires=time() + CACHE_TTL,
+                 state=get_state(),
+                 rawresults=deepcopy(parser.getRawResults()),
+                 logs=list(parser.logs))
+    with _lock:
+        _cache.pop(key, None)
+        _cache[key] = entry
+        while len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+
+
+def refresh(key):
+    """Takes the catalog counters of the entry again
+    """
+    with _lock:
+        entry = _cache.get(key)
+    if entry is not None:
+        entry["state"] = get_state()
+
+
+def clear():
+    with _lock:
+        _cache.clear()
+
+
+def use_parse_cache(parser, key):
+    """Lets the parser answer parse() from the cache
+
+    When the file was parsed lately the parser gets its raw results and does
+    not read the file, otherwise the results of its parse are kept.
+    Returns True on a cache hit.
+    """
+    if getattr(parser, "writes_on_parse", False):
+        return False
+    entry = get_entry(key)
+    if entry is not None:
+        parser._rawresults = deepcopy(entry["rawresults"])
+        parser.logs.extend(entry["logs"])
+        parsed = entry["parsed"]
+        parser.parse = lambda: parsed
+        logger.info("Using the cached results of %s" % key[0])
+        return True
+
+    parse = parser.parse
+
+    def cached_parse():
+        parsed = parse()
+        store(key, parser, parsed)
+        return parsed
+
+    parser.parse = cached_parse
+    return False
+
+
+def keep_fresh(importer, key):
+    """Takes the catalog counters of the entry again once the importer has
+    applied the results
+
+    Applying the results reindexes the analyses, the entry would be stale for
+    the next upload of the same file otherwise.
+    """
+    process = importer.process
+
+    def process_and_refresh():
+        processed = process()
+        refresh(key)
+        return processed
+
+    importer.process = process_and_refresh
@@ -0,0 +1,287 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.INSTRUMENTS.
+#
+# SENAITE.CORE is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright 2018-2019 by it's authors.
+# Some rights reserved, see README and LICENSE.
+
+import json
+import os
+import threading
+from collections import OrderedDict
+from functools import wraps
+from time import time
+
+from Products.ZCatalog.CatalogBrains import AbstractCatalogBrain
+from Products.ZCatalog.ZCatalog import ZCatalog
+from senaite.instruments import logger
+
+# Request form key that turns on the timing report of an import
+TIMINGS_KEY = "timings"
+
+# Environment variable that turns it on for every import
+TIMINGS_ENV = "SENAITE_INSTRUMENTS_TIMINGS"
+
+FILE_DECODE = "file_decode"
+SPREADSHEET_LOAD = "spreadsheet_load"
+ROW_PARSING = "row_parsing"
+CATALOG_LOOKUPS = "catalog_lookups"
+OBJECT_WAKEUPS = "object_wakeups"
+PROCESS = "process"
+
+_local = threading.local()
+
+
+class ImportTimer(object):
+    """Wall time and number of calls of each phase of an import
+
+    Phases are inclusive: a nested phase, e.g. the catalog lookups done while
+    parsing the rows, is counted both on its own and in the outer phase.
+    """
+
+    def __init__(self):
+        self.phases = OrderedDict()
+
+    def add(self, phase, seconds, calls=1):
+        total = self.phases.setdefault(phase, {"calls": 0, "seconds": 0.0})
+        total["calls"] += calls
+        total["seconds"] += seconds
+
+    def report(self):
+        report = OrderedDict()
+        for phase, total in self.phases.items():
+            report[phase] = {"calls": total["calls"],
+                             "seconds": round(total["seconds"], 6)}
+        return report
+
+
+def get_timer():
+    """Returns the timer of the import running in this thread or None
+    """
+    return getattr(_local, "timer", None)
+
+
+class timed(object):
+    """Adds the time spent in a block or call to a phase of the import timer
+
+    Used as a context manager or as a decorator. Does nothing when no import
+    is being timed in this thread.
+    """
+
+    def __init__(self, phase):
+        self.phase = phase
+        self.timer = None
+        self.start = None
+
+    def __enter__(self):
+        self.timer = get_timer()
+        if self.timer is not None:
+            self.start = time()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.timer is not None:
+            self.timer.add(self.phase, time() - self.start)
+
+    def __call__(self, func):
+        phase = self.phase
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with timed(phase):
+                return func(*args, **kwargs)
+        return wrapper
+
+
+def timings_enabled(request):
+    if os.environ.get(TIMINGS_ENV):
+        return True
+    form = getattr(request, "form", None) or {}
+    return bool(form.get(TIMINGS_KEY))
+
+
+def profiled_import(func):
+    """Decorates the Import entry point of an instrument interface
+
+    When the request asks for it, the phases of the import are timed and
+    returned in the "timings" key of the results JSON and written to the
+    log. Otherwise the import runs untouched.
+    """
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        request = kwargs.get("request", args[-1] if args else None)
+        if get_timer() is not None or not timings_enabled(request):
+            return func(*args, **kwargs)
+
+        timer = _local.timer = ImportTimer()
+        try:
+            start = time()
+            output = func(*args, **kwargs)
+            timer.add("total", time() - start)
+        finally:
+            del _local.timer
+
+        infile = request.form.get("instrument_results_file")
+        filename = getattr(infile, "filename", "")
+        report = timer.report()
+        for phase, total in report.items():
+            logger.info("Import timings of '%s': %s: %s calls, %.3fs",
+                        filename, phase, total["calls"], total["seconds"])
+
+        results = json.loads(output)
+        results[TIMINGS_KEY] = report
+        return json.dumps(results)
+    return wrapper
+
+
+def query_key(query):
+    return json.dumps(query, sort_keys=True, default=repr)
+
+
+def get_counters():
+    """Returns the query counters active in this thread
+    """
+    return getattr(_local, "counters", ())
+
+
+def record_query(catalog, query):
+    """Records a catalog search on the counters active in this thread
+    """
+    for counter in get_counters():
+        counter.queries.append((catalog, query_key(query)))
+
+
+def record_wakeup():
+    """Records the wake-up of a catalogued object on the active counters
+    """
+    for counter in get_counters():
+        counter.wakeups += 1
+
+
+_hooks_lock = threading.Lock()
+
+# The original methods while the hooks are installed, and the number of
+# query counters of all threads using them
+_hooks = dict(originals=[], users=0)
+
+
+def install_query_hooks():
+    """Wraps ZCatalog.searchResults and the getObject of catalog brains to
+    report to the query counters, until remove_query_hooks
+
+    The hooks are installed by the first active counter of the process and
+    removed when the last one exits. The wrappers only look up the counters
+    of the calling thread, other threads are not counted meanwhile.
+    """
+    with _hooks_lock:
+        _hooks["users"] += 1
+        if _hooks["users"] > 1:
+            return
+        search_results = ZCatalog.__dict__["searchResults"]
+        get_object = AbstractCatalogBrain.__dict__["getObject"]
+
+        def searchResults(self, *args, **kw):
+            if get_counters():
+                query = dict(kw)
+                if args and isinstance(args[0], dict):
+                    query.update(args[0])
+                record_query(self.getId(), query)
+            return search_results(self, *args, **kw)
+
+        def getObject(self, *args, **kw):
+            record_wakeup()
+            return get_object(self, *args, **kw)
+
+        originals = _hooks["originals"]
+        # ZCatalog.__call__ is an alias of searchResults
+        for name in ("searchResults", "__call__"):
+            if ZCatalog.__dict__.get(name) is search_results:
+                originals.append((ZCatalog, name, search_results))
+                setattr(ZCatalog, name, searchResults)
+        originals.append((AbstractCatalogBrain, "getObject", get_object))
+        AbstractCatalogBrain.getObject = getObject
+
+
+def remove_query_hooks():
+    """Puts the original methods back once no query counter is active
+    """
+    with _hooks_lock:
+        _hooks["users"] -= 1
+        if _hooks["users"] > 0:
+            return
+        originals = _hooks["originals"]
+        while originals:
+            klass, name, method = originals.pop()
+            setattr(klass, name, method)
+
+
+class QueryCounter(object):
+    """Counts the catalog searches and object wake-ups of the current thread
+
+    Every search of a ZCatalog is counted, whether it is done through
+    api.search, by calling the catalog tool or with unrestrictedSearchResults,
+    and so is every brain.getObject(), also when called by api.get_object.
+    Objects reached otherwise, e.g. by traversal, are not counted, nor are
+    the queries of the requests served by other threads meanwhile. The
+    catalog and brain methods are only wrapped while a counter is active.
+
+    Identical queries to the same catalog are reported in duplicates and
+    logged, they usually mean a lookup is done per row instead of once per
+    import::
+
+        with QueryCounter() as counter:
+            parser.parse()
+        counter.counts  # {catalog: number of queries}
+    """
+
+    def __init__(self):
+        self.queries = []
+        self.wakeups = 0
+
+    def __enter__(self):
+        install_query_hooks()
+        _local.counters = get_counters() + (self, )
+        return self
+
+    def __exit__(self, *exc_info):
+        _local.counters = tuple(
+            [counter for counter in get_counters() if counter is not self])
+        remove_query_hooks()
+        for (catalog, query), count in self.duplicates.items():
+            logger.warn("Query to %s issued %s times: %s",
+                        catalog, count, query)
+
+    def __len__(self):
+        return len(self.queries)
+
+    def count(self, catalog):
+        return self.counts.get(catalog, 0)
+
+    @property
+    def counts(self):
+        counts = {}
+        for catalog, query in self.queries:
+            counts[catalog] = counts.get(catalog, 0) + 1
+        return counts
+
+    @property
+    def duplicates(self):
+        counts = {}
+        for key in self.queries:
+            counts[key] = counts.get(key, 0) + 1
+        return dict([(key, count) for key, count in counts.items()
+                     if count > 1])
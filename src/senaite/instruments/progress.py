@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.INSTRUMENTS.
+#
+# SENAITE.CORE is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright 2018-2019 by it's authors.
+# Some rights reserved, see README and LICENSE.
+
+
+"""Progress of the results imports running in this process
+
+An import started with an import_token in its form publishes its counts
+under the token while it runs: the rows parsed, the Samples resolved, the
+results parsed and the Samples applied, with an estimate of the time left.
+The browser polls them with the instrument_import_progress view::
+
+    @@instrument_import_progress?import_token=<token>
+
+Only the user who started the import is answered. The counts are kept in
+memory, the view has to be asked on the instance running the import.
+"""
+
+import json
+import threading
+from collections import OrderedDict
+from time import time
+
+from bika.lims import api
+from bika.lims.browser import BrowserView
+
+# Form field with the token the browser polls the progress with
+PROGRESS_KEY = "import_token"
+
+# Imports kept per process and for how many seconds after their last update
+PROGRESS_SIZE = 100
+PROGRESS_TTL = 3600
+
+# States of an import
+PARSING = "parsing"
+IMPORTING = "importing"
+DONE = "done"
+FAILED = "failed"
+
+# Counts of an import
+COUNTS = ("rows", "samples", "results", "applied")
+
+_imports = OrderedDict()
+_lock = threading.Lock()
+
+
+class ImportProgress(object):
+    """Counts of a running import
+    """
+
+    def __init__(self, token, userid=None):
+        self.token = token
+        self.userid = userid
+        self.state = PARSING
+        self.started = self.since = self.updated = time()
+        self.counts = dict.fromkeys(COUNTS, 0)
+        self.totals = dict.fromkeys(COUNTS)
+
+    def set_state(self, state):
+        if state != self.state:
+            self.state = state
+            self.since = time()
+        self.updated = time()
+
+    def add(self, name, count=1):
+        self.counts[name] += count
+        self.updated = time()
+
+    def set_total(self, name, total):
+        self.totals[name] = total
+        self.updated = time()
+
+    def eta(self):
+        """Returns the seconds the import is expected to take still, or None
+
+        The rows parsed tell the time left while parsing, the Samples applied
+        out of the Samples of the file while importing. Importers that do
+        not report the Samples they applied have no ETA.
+        """
+        if self.state in (DONE, FAILED):
+            return 0
+        if self.state == PARSING:
+            done, total = self.counts["rows"], self.totals["rows"]
+        else:
+            done = self.counts["applied"]
+            total = self.totals["applied"] or self.totals["samples"]
+        if not done or not total:
+            return None
+        elapsed = time() - self.since
+        return max(elapsed * (total - done) / float(done), 0)
+
+    def as_dict(self):
+        return dict(token=self.token, state=self.state,
+                    counts=dict(self.counts), totals=dict(self.totals),
+                    elapsed=time() - self.started, eta=self.eta())
+
+
+def start_progress(token, userid=None):
+    """Returns the progress of a new import with the token, by the user
+    """
+    progress = ImportProgress(token, userid)
+    with _lock:
+        expired = time() - PROGRESS_TTL
+        for key, entry in _imports.items():
+            if entry.updated < expired:
+                del _imports[key]
+        _imports.pop(token, None)
+        _imports[token] = progress
+        while len(_imports) > PROGRESS_SIZE:
+            _imports.popitem(last=False)
+    return progress
+
+
+def get_progress(token):
+    with _lock:
+        return _imports.get(token)
+
+
+def clear():
+    with _lock:
+        _imports.clear()
+
+
+def report(obj, name, count=1):
+    """Adds to a count of the import of a parser or importer, if tracked
+    """
+    progress = getattr(obj, "progress", None)
+    if progress is not None:
+        progress.add(name, count)
+
+
+def report_total(obj, name, total):
+    progress = getattr(obj, "progress", None)
+    if progress is not None:
+        progress.set_total(name, total)
+
+
+def report_state(obj, state):
+    progress = getattr(obj, "progress", None)
+    if progress is not None:
+        progress.set_state(state)
+
+
+def track_progress(importer, parser, progress):
+    """Publishes the progress of the import of the parser by the importer
+
+    The parse and process of the two are wrapped to follow the state of the
+    import, the parser and the importer report their counts to progress.
+    """
+    parser.progress = progress
+    importer.progress = progress
+    parse = parser.parse
+    process = importer.process
+
+    def tracked_parse():
+        parsed = parse()
+        progress.set_state(IMPORTING)
+        return parsed
+
+    def tracked_process():
+        try:
+            processed = process()
+        except Exception:
+            progress.set_state(FAILED)
+            raise
+        progress.set_state(DONE)
+        return processed
+
+    parser.parse = tracked_parse
+    importer.process = tracked_process
+    return importer
+
+
+class ImportProgressView(BrowserView):
+    """Returns the progress of the import with the token as JSON
+
+    Imports started by other users are answered as unknown.
+    """
+
+    def __call__(self):
+        token = self.request.form.get(PROGRESS_KEY)
+        progress = token and get_progress(token)
+        userid = api.get_current_user().getId()
+        if progress and progress.userid == userid:
+            data = progress.as_dict()
+        else:
+            data = dict(token=token, state=None)
+        self.request.response.setHeader("Content-Type", "application/json")
+        return json.dumps(data)
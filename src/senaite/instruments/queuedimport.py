@@ -0,0 +1,343 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.INSTRUMENTS.
+#
+# SENAITE.CORE is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright 2018-2019 by it's authors.
+# Some rights reserved, see README and LICENSE.
+
+
+"""Results imports run by a background worker instead of the request
+
+An import submitted with queued=1 in its form, or any import when the
+SENAITE_INSTRUMENTS_QUEUED environment variable is set, only stores the
+uploaded file and queues the import. The request returns the job ID at once
+and a worker thread of the instance runs the Import of the instrument with
+the stored file, as the user who submitted it, and commits it. The browser
+polls the job for its state and results::
+
+    @@instrument_import_job?job_id=<job ID>
+
+Only the user who submitted the import is answered. The queue is kept in
+the memory of the instance, jobs queued when it stops are lost and the view
+has to be asked on the instance the file was sent to.
+"""
+
+import json
+import os
+import tempfile
+import threading
+import traceback
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+from cStringIO import StringIO
+from functools import partial
+from functools import wraps
+from Queue import Empty
+from Queue import Queue
+from time import time
+
+import transaction
+from AccessControl.SecurityManagement import newSecurityManager
+from AccessControl.SecurityManagement import noSecurityManager
+from bika.lims import api
+from bika.lims.browser import BrowserView
+from senaite.instruments import logger
+from senaite.instruments.instrument import FileStub
+from Testing.makerequest import makerequest
+from ZODB.POSException import ConflictError
+from zope.component.hooks import setSite
+from zope.publisher.browser import FileUpload
+
+# Request form key that queues the import
+QUEUED_KEY = "queued"
+
+# Environment variable that queues every import
+QUEUED_ENV = "SENAITE_INSTRUMENTS_QUEUED"
+
+# Folder the uploaded files are kept in until their import runs
+SPOOL_ENV = "SENAITE_INSTRUMENTS_SPOOL"
+
+# Worker threads per instance, imports of the same Samples must not run
+# side by side so one is the safe default
+WORKERS = 1
+
+# Attempts of an import failing with a conflict, like the publisher does
+CONFLICT_RETRIES = 3
+
+# Finished jobs kept per process and for how many seconds
+JOBS_SIZE = 100
+JOBS_TTL = 3600
+
+# States of a job
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+_jobs = OrderedDict()
+_queue = Queue()
+_workers = []
+_lock = threading.Lock()
+_local = threading.local()
+
+
+class ImportJob(object):
+    """An import waiting for or run by a worker
+    """
+
+    def __init__(self, function, context, form, filename, path):
+        self.id = uuid.uuid4().hex
+        self.function = function
+        self.context_path = context.getPhysicalPath()
+        self.site_path = api.get_portal().getPhysicalPath()
+        self.userid = api.get_current_user().getId()
+        self.form = form
+        self.filename = filename
+        self.path = path
+        self.state = QUEUED
+        self.created = time()
+        self.started = None
+        self.finished = None
+        self.results = None
+        self.event = threading.Event()
+
+    def wait(self, timeout=None):
+        """Waits for the job to finish, returns whether it did
+        """
+        self.event.wait(timeout)
+        return self.event.is_set()
+
+    def as_dict(self):
+        return dict(job_id=self.id, state=self.state, filename=self.filename,
+                    created=self.created, started=self.started,
+                    finished=self.finished, results=self.results)
+
+
+def is_queued(request):
+    """Returns whether the import of the request is to be queued
+    """
+    if getattr(_local, "job", None) is not None:
+        # the import of a job
+        return False
+    if os.environ.get(QUEUED_ENV):
+        return True
+    form = getattr(request, "form", None) or {}
+    return bool(form.get(QUEUED_KEY))
+
+
+def spool_file(infile):
+    """Writes the uploaded file to the spool folder and returns its path
+    """
+    spool = os.environ.get(SPOOL_ENV) or None
+    handle, path = tempfile.mkstemp(prefix="senaite-import-", dir=spool)
+    with os.fdopen(handle, "wb") as spooled:
+        infile.seek(0)
+        spooled.write(infile.read())
+    infile.seek(0)
+    return path
+
+
+def get_job(job_id):
+    with _lock:
+        return _jobs.get(job_id)
+
+
+def clear():
+    """Drops the jobs, those still queued with their spooled files
+    """
+    with _lock:
+        while True:
+            try:
+                job = _queue.get_nowait()
+            except Empty:
+                break
+            if job.path and os.path.exists(job.path):
+                os.remove(job.path)
+        _jobs.clear()
+
+
+def enqueue(function, context, request):
+    """Stores the upload of the request and queues the import of it
+
+    The function is called with the context and a request with the form of
+    this one by the worker. Returns the job.
+    """
+    form = dict([(key, value) for key, value in request.form.items()
+                 if isinstance(value, basestring) and key != QUEUED_KEY])
+    infile = request.form.get("instrument_results_file")
+    filename = getattr(infile, "filename", "")
+    path = spool_file(infile) if hasattr(infile, "read") else None
+    job = ImportJob(function, context, form, filename, path)
+    with _lock:
+        expired = time() - JOBS_TTL
+        for key, entry in _jobs.items():
+            if entry.finished and entry.finished < expired:
+                del _jobs[key]
+        _jobs[job.id] = job
+        while len(_jobs) > JOBS_SIZE:
+            _jobs.popitem(last=False)
+    start_workers(context._p_jar.db())
+    _queue.put(job)
+    logger.info("Queued the import of %s as job %s" % (filename, job.id))
+    return job
+
+
+def start_workers(db):
+    """Starts the worker threads of the instance, unless they run already
+    """
+    with _lock:
+        while len(_workers) < WORKERS:
+            worker = threading.Thread(
+                target=work, args=(db, ),
+                name="senaite.instruments import %s" % len(_workers))
+            worker.daemon = True
+            worker.start()
+            _workers.append(worker)
+
+
+def work(db):
+    while True:
+        job = _queue.get()
+        try:
+            run_job(db, job)
+        except Exception:
+            logger.error("Import job %s failed: %s" % (
+                job.id, traceback.format_exc()))
+
+
+@contextmanager
+def worker_site(db, path, userid):
+    """Opens a connection of the calling thread with the site at path set up
+
+    ZODB connections must not be shared between threads, the worker gets its
+    own one, the site and the user are set up as in the calling thread.
+    Changes not committed in the block are discarded.
+    """
+    connection = db.open()
+    try:
+        app = makerequest(connection.root()["Application"])
+        site = app.unrestrictedTraverse(path)
+        setSite(site)
+        acl_users = site.acl_users
+        user = acl_users.getUserById(userid)
+        if user is None:
+            acl_users = app.acl_users
+            user = acl_users.getUserById(userid)
+        if user is not None:
+            newSecurityManager(None, user.__of__(acl_users))
+        yield site
+    finally:
+        transaction.abort()
+        noSecurityManager()
+        setSite(None)
+        connection.close()
+
+
+def process_job(job, site):
+    """Runs the import of the job with the site of the current connection
+
+    Returns the JSON output of the Import, nothing is committed.
+    """
+    context = site.unrestrictedTraverse(job.context_path)
+    request = site.REQUEST
+    request.form.update(job.form)
+    if job.path:
+        with open(job.path, "rb") as spooled:
+            data = spooled.read()
+        request.form["instrument_results_file"] = FileUpload(
+            FileStub(file=StringIO(data), name=job.filename))
+    _local.job = job
+    try:
+        return job.function(context, request)
+    finally:
+        _local.job = None
+
+
+def run_job(db, job):
+    """Runs the import of the job in a connection of its own and commits it
+    """
+    job.state = RUNNING
+    job.started = time()
+    try:
+        for attempt in range(CONFLICT_RETRIES):
+            try:
+                with worker_site(db, job.site_path, job.userid) as site:
+                    output = process_job(job, site)
+                    transaction.get().note(
+                        u"Queued instrument import: %s" % job.filename)
+                    transaction.commit()
+                break
+            except ConflictError:
+                if attempt == CONFLICT_RETRIES - 1:
+                    raise
+                logger.warn("Conflict importing %s, retrying" % job.filename)
+        job.results = json.loads(output)
+        job.state = DONE
+    except Exception as error:
+        job.results = dict(errors=[repr(error), traceback.format_exc()],
+                           log=[], warns=[])
+        job.state = FAILED
+    finally:
+        job.finished = time()
+        if job.path and os.path.exists(job.path):
+            os.remove(job.path)
+        job.event.set()
+    logger.info("Import job %s of %s: %s" % (job.id, job.filename, job.state))
+
+
+def queued_import(func):
+    """Decorates the Import entry point of an instrument interface
+
+    When the request asks for it, the import is queued and the job ID is
+    returned in the "job_id" key of the results JSON. Otherwise the import
+    runs untouched.
+    """
+
+    @wraps(func)
+    def wrapper(*args):
+        context, request = args[-2:]
+        if not is_queued(request):
+            return func(*args)
+        job = enqueue(partial(func, *args[:-2]), context, request)
+        return json.dumps(dict(
+            errors=[], warns=[], job_id=job.id,
+            log=["Import of %s queued as job %s" % (job.filename, job.id)]))
+
+    return wrapper
+
+
+class ImportJobView(BrowserView):
+    """Returns the state of the import job with the ID as JSON
+
+    Jobs submitted by other users are answered as unknown.
+
+    The jobs live in the memory of the instance the file was uploaded to.
+    Jobs queued or running when it restarts are lost, their files are left
+    in the spool folder. Other ZEO clients do not know the job, the polling
+    has to reach the same instance, e.g. with sticky sessions.
+    """
+
+    def __call__(self):
+        job_id = self.request.form.get("job_id")
+        job = job_id and get_job(job_id)
+        userid = api.get_current_user().getId()
+        if job and job.userid == userid:
+            data = job.as_dict()
+        else:
+            data = dict(job_id=job_id, state=None)
+        self.request.response.setHeader("Content-Type", "application/json")
+        return json.dumps(data)
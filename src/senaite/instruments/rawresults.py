@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.INSTRUMENTS.
+#
+# SENAITE.CORE is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright 2018-2019 by it's authors.
+# Some rights reserved, see README and LICENSE.
+
+
+"""Compact store of the raw results of a parser
+
+Parsers hand _addRawResult a dict of dicts per Sample row, most of them
+with the same few column names and, for analytes read from the same row,
+the same header fields. The results are kept as records instead: the
+column names are interned and shared by all records with the same columns,
+the cells are a tuple, and the fields an analyte repeats from the previous
+analyte of the Sample are kept once in a record both of them point to.
+
+Records are mappings, so AnalysisResultsImporter and the parsers read them
+as they read the dicts. Changing a record turns it into a plain dict of its
+own, leaving the records sharing fields with it as they were.
+
+Parsers can also stream their results: iter_records yields them while the
+file is read instead of keeping them until the end of the parse.
+"""
+
+from collections import MutableMapping
+from collections import deque
+
+from senaite.instruments.progress import report
+
+# Columns not shared between the analytes of a row
+OWN_COLUMNS = ("DefaultResult", )
+
+# Smallest number of fields worth a shared record
+MIN_SHARED = 2
+
+_names = {}
+_layouts = {}
+_missing = object()
+
+
+def intern_name(name):
+    """Returns the one copy of the column name kept for all records
+    """
+    return _names.setdefault(name, name)
+
+
+def get_layout(columns):
+    """Returns the layout shared by the records with the columns
+    """
+    columns = tuple(map(intern_name, columns))
+    layout = _layouts.get(columns)
+    if layout is None:
+        layout = _layouts.setdefault(columns, Layout(columns))
+    return layout
+
+
+class Layout(object):
+    """Column names of a record and the position of their cells
+    """
+    __slots__ = ("columns", "index")
+
+    def __init__(self, columns):
+        self.columns = columns
+        self.index = dict([(name, pos) for pos, name in enumerate(columns)])
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+
+class Record(MutableMapping):
+    """Mapping of column names to cells, backed by a layout and a tuple
+
+    Fields missing in the record are looked up in its shared record.
+    """
+    __slots__ = ("layout", "cells", "shared")
+
+    def __init__(self, items=(), shared=None):
+        if isinstance(items, dict):
+            items = items.items()
+        items = list(items)
+        self.layout = get_layout([name for name, value in items])
+        self.cells = tuple([value for name, value in items])
+        self.shared = shared
+
+    def _materialize(self):
+        """Turns the record into a plain dict before it is changed
+        """
+        if self.layout is not None:
+            items = dict(self.items())
+            self.layout = None
+            self.cells = items
+            self.shared = None
+        return self.cells
+
+    def __getitem__(self, name):
+        if self.layout is None:
+            return self.cells[name]
+        pos = self.layout.index.get(name)
+        if pos is not None:
+            return self.cells[pos]
+        if self.shared is not None:
+            return self.shared[name]
+        raise KeyError(name)
+
+    def __contains__(self, name):
+        if self.layout is None:
+            return name in self.cells
+        if name in self.layout.index:
+            return True
+        return self.shared is not None and name in self.shared
+
+    def __iter__(self):
+        if self.layout is None:
+            return iter(self.cells)
+        if self.shared is None:
+            return iter(self.layout.columns)
+        return iter(self.layout.columns + tuple(self.shared))
+
+    def __len__(self):
+        if self.layout is None:
+            return len(self.cells)
+        if self.shared is None:
+            return len(self.cells)
+        return len(self.cells) + len(self.shared)
+
+    def __setitem__(self, name, value):
+        self._materialize()[name] = value
+
+    def __delitem__(self, name):
+        del self._materialize()[name]
+
+    def has_key(self, name):
+        return name in self
+
+    def copy(self):
+        return dict(self.items())
+
+    def __repr__(self):
+        return repr(self.copy())
+
+
+def make_record(values, previous=None):
+    """Returns the record of the dict of a raw result
+
+    Fields with the same value as in the previous record of the Sample are
+    taken from a record shared with it.
+    """
+    if previous is None or previous.layout is None:
+        return Record(values)
+
+    shared = previous.shared
+    if shared is not None and shared.layout is not None:
+        for name, value in shared.items():
+            if not same_value(values.get(name, _missing), value):
+                shared = None
+                break
+    if shared is None:
+        common = [(name, value) for name, value in values.items()
+                  if name not in OWN_COLUMNS and name in previous and
+                  same_value(previous[name], value)]
+        if len(common) < MIN_SHARED:
+            return Record(values)
+        shared = Record(common)
+    own = [(name, value) for name, value in values.items()
+           if name not in shared]
+    return Record(own, shared=shared)
+
+
+def same_value(first, second):
+    return first is second or \
+        (type(first) is type(second) and first == second)
+
+
+def last_record(results):
+    """Returns the record of the last analyte of the raw results, if any
+    """
+    if isinstance(results, Record) and results.layout is not None:
+        for cell in reversed(results.cells):
+            if isinstance(cell, Record):
+                return cell
+    return None
+
+
+class CompactResultsMixin(object):
+    """Keeps the raw results of a results file parser as records
+    """
+
+    # records parsed and not handed out by iter_records yet
+    _stream = None
+    # id and last record of the object the last streamed results were for
+    _streamed = (None, None)
+
+    def _addRawResult(self, resid, values={}, override=False):
+        """Adds the raw results of the object with id resid
+
+        Same as InstrumentResultsFileParser._addRawResult, with the dicts of
+        values kept as records. While streaming, the results are queued for
+        iter_records instead, override has no effect then.
+        """
+        report(self, "results", len(values))
+        if self._stream is not None:
+            return self._queue_records(resid, values)
+        results = self._rawresults.get(resid)
+        if override or results is None:
+            results = self._rawresults[resid] = []
+        previous = None
+        if results:
+            previous = last_record(results[-1])
+        records = []
+        for keyword, result in values.items():
+            if isinstance(result, dict):
+                result = previous = make_record(result, previous)
+            records.append((keyword, result))
+        results.append(Record(records))
+
+    def _queue_records(self, resid, values):
+        last_resid, previous = self._streamed
+        if last_resid != resid:
+            previous = None
+        for keyword, result in values.items():
+            if isinstance(result, dict):
+                result = previous = make_record(result, previous)
+            self._stream.append((resid, keyword, result))
+        self._streamed = (resid, previous)
+
+    def iter_parse(self):
+        """Parses the file, yields after each row parsed
+
+        Parsers reading their rows one after the other override it, by
+        default the whole file is parsed at once.
+        """
+        yield self.parse()
+
+    def iter_records(self):
+        """Yields the (object id, keyword, values) of the results of the file
+
+        The results are handed out as the rows are parsed instead of being
+        added to the raw results, those of an object come one after the
+        other as long as the file has its rows together.
+        """
+        self._stream = deque()
+        try:
+            for parsed in self.iter_parse():
+                while self._stream:
+                    yield self._stream.popleft()
+        finally:
+            self._stream = None
+            self._streamed = (None, None)
@@ -0,0 +1,570 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.INSTRUMENTS.
+#
+# SENAITE.CORE is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright 2018-2019 by it's authors.
+# Some rights reserved, see README and LICENSE.
+
+from bisect import bisect_left
+from itertools import islice
+
+from bika.lims import api
+from Missing import MV
+from senaite.core.catalog import ANALYSIS_CATALOG
+from senaite.core.catalog import SAMPLE_CATALOG
+from senaite.core.catalog import SENAITE_CATALOG
+from senaite.instruments.profiling import CATALOG_LOOKUPS
+from senaite.instruments.profiling import OBJECT_WAKEUPS
+from senaite.instruments.profiling import timed
+from senaite.instruments.progress import report
+from senaite.instruments.progress import report_total
+
+SAMPLE = "AnalysisRequest"
+DUPLICATE_ANALYSIS = "DuplicateAnalysis"
+REFERENCE_ANALYSIS = "ReferenceAnalysis"
+REFERENCE_SAMPLE = "ReferenceSample"
+QC_ANALYSIS_TYPES = [DUPLICATE_ANALYSIS, REFERENCE_ANALYSIS]
+
+# Rows read ahead and resolved together by the parsers that stream their rows
+ROW_BATCH_SIZE = 100
+
+# Attributes of the analyses read while parsing, the catalog metadata
+# columns and the object getters or fields have the same names
+ANALYSIS_METADATA = (
+    "getKeyword",
+    "Precision",
+    "getInterimFields",
+    "getLowerDetectionLimit",
+    "getUpperDetectionLimit",
+)
+
+# Attributes always read from the objects. The stored Precision field is
+# what results are rounded with, a metadata column of the same name would
+# hold the value of the last reindex.
+OBJECT_ATTRIBUTES = (
+    "Precision",
+)
+
+
+def get_value(analysis, name):
+    """Returns the attribute of a brain or the result of the object's getter
+    """
+    value = getattr(analysis, name, None)
+    return value() if callable(value) else value
+
+
+def get_interim_fields(analysis):
+    """Returns the interim fields of an analysis brain or object
+
+    The catalog metadata is used when available, the object is only woken up
+    when the brain does not provide the interim fields.
+    """
+    if api.is_brain(analysis):
+        interims = getattr(analysis, "getInterimFields", None)
+        if isinstance(interims, (list, tuple)):
+            return interims
+        with timed(OBJECT_WAKEUPS):
+            analysis = api.get_object(analysis)
+    return get_value(analysis, "getInterimFields") or []
+
+
+def get_metadata(brain):
+    """Returns the analysis attributes the brain has metadata columns for
+
+    The OBJECT_ATTRIBUTES are left out, they are read from the objects.
+    """
+    metadata = {}
+    for column in ANALYSIS_METADATA:
+        if column in OBJECT_ATTRIBUTES:
+            continue
+        value = getattr(brain, column, MV)
+        if value is not MV:
+            metadata[column] = value
+    return metadata
+
+
+def wake_up(brains):
+    """Returns the objects of the brains, loaded in the order of their OIDs
+
+    The objects are looked up first, which only touches their containers,
+    and then loaded sorted by OID, close records of the storage one after
+    the other. Connections that can prefetch load all of them in a single
+    round trip to the storage.
+    """
+    with timed(OBJECT_WAKEUPS):
+        objects = [api.get_object(brain) for brain in brains]
+        ghosts = sorted([obj for obj in objects
+                         if getattr(obj, "_p_oid", None) is not None],
+                        key=lambda obj: obj._p_oid)
+        if ghosts:
+            prefetch = getattr(ghosts[0]._p_jar, "prefetch", None)
+            if prefetch is not None:
+                prefetch([obj._p_oid for obj in ghosts])
+            for obj in ghosts:
+                obj._p_activate()
+    return objects
+
+
+def iter_batches(items, size):
+    """Yields lists of up to size items, reading only one list at a time
+    """
+    items = iter(items)
+    while True:
+        batch = list(islice(items, size))
+        if not batch:
+            return
+        yield batch
+
+
+def prefix_range(prefix):
+    """Returns a catalog range query for the index values starting with prefix
+
+    The upper bound is the prefix with its last character bumped, values up to
+    and including it are returned, so results still need a startswith check.
+    """
+    last = ord(prefix[-1]) + 1
+    if isinstance(prefix, unicode):
+        upper = prefix[:-1] + unichr(last)
+    else:
+        upper = prefix[:-1] + chr(min(last, 255))
+    return {"query": [prefix, upper], "range": "min:max"}
+
+
+class AnalysisIndex(object):
+    """Keyword and title lookups over the analyses of a single sample
+
+    Brains expose getKeyword and Title as metadata, the analyses of
+    ReferenceSamples are objects with getters, both are handled alike.
+    """
+
+    def __init__(self, analyses):
+        self.analyses = list(analyses)
+        self.keywords = {}
+        self.titles = {}
+        for analysis in self.analyses:
+            keyword = get_value(analysis, "getKeyword")
+            title = get_value(analysis, "Title")
+            self.keywords.setdefault(keyword, []).append(analysis)
+            self.titles.setdefault(title, []).append(analysis)
+        self.by_keyword = dict(
+            [(k, v[-1]) for k, v in self.keywords.items()])
+        self.by_title = dict([(k, v[-1]) for k, v in self.titles.items()])
+        self._sorted_keywords = sorted(filter(None, self.by_keyword))
+        self._sorted_titles = sorted(filter(None, self.by_title))
+
+    def __len__(self):
+        return len(self.analyses)
+
+    def __contains__(self, keyword):
+        return keyword in self.by_keyword
+
+    def __getitem__(self, keyword):
+        return self.by_keyword[keyword]
+
+    def get(self, keyword, default=None):
+        return self.by_keyword.get(keyword, default)
+
+    def get_by_title(self, title, default=None):
+        return self.by_title.get(title, default)
+
+    def filter(self, keyword):
+        """Returns all the analyses with the keyword
+        """
+        return list(self.keywords.get(keyword, []))
+
+    def startswith(self, prefix):
+        """Returns one analysis per keyword starting with the prefix
+        """
+        return self._prefixed(self._sorted_keywords, self.by_keyword, prefix)
+
+    def title_startswith(self, prefix):
+        """Returns one analysis per title starting with the prefix
+        """
+        return self._prefixed(self._sorted_titles, self.by_title, prefix)
+
+    @staticmethod
+    def _prefixed(keys, mapping, prefix):
+        matches = []
+        for i in range(bisect_left(keys, prefix), len(keys)):
+            if not keys[i].startswith(prefix):
+                break
+            matches.append(mapping[keys[i]])
+        return matches
+
+
+class SampleResolver(object):
+    """Answers "what is this ID and what are its analyses" once per import
+
+    The IDs found in a results file are either Samples, the group ID of
+    Duplicate/Reference analyses of a worksheet or ReferenceSamples. Every
+    answer is memoized, so a parser can ask for each row or cell without
+    searching the catalogs again for an ID it has already seen.
+    """
+
+    def __init__(self):
+        self._sample_brains = {}
+        self._samples = {}
+        self._groups = {}
+        self._reference_samples = {}
+        self._analyses = {}
+        self._indexes = {}
+        self._client_sample_ids = {}
+        self._interim_keywords = {}
+        self._interims = {}
+        self._prefixed_groups = {}
+        self._metadata = {}
+        self._batches = {}
+
+    def search(self, query, catalog):
+        with timed(CATALOG_LOOKUPS):
+            return api.search(query, catalog)
+
+    def prefetch(self, sample_ids):
+        """Resolve all the IDs of a results file with one query per catalog
+
+        IDs that are not Samples are looked up as QC groups and the rest as
+        ReferenceSamples, so a file with only Samples costs a single query.
+        Parsers call this after reading the file, or a batch of its rows, and
+        before parsing the rows, the per-ID lookups are then answered from
+        memory. IDs resolved before are not looked up again.
+        """
+        pending = set(filter(None, sample_ids))
+        pending.difference_update(self._sample_brains)
+        if not pending:
+            return
+
+        query = dict(portal_type=SAMPLE, getId=sorted(pending))
+        for brain in self.search(query, SAMPLE_CATALOG):
+            self._sample_brains.setdefault(brain.getId, brain)
+        for sample_id in pending:
+            self._sample_brains.setdefault(sample_id, None)
+
+        pending = set([sample_id for sample_id in pending
+                       if self._sample_brains[sample_id] is None and
+                       sample_id not in self._groups])
+        if not pending:
+            return
+
+        query = dict(portal_type=QC_ANALYSIS_TYPES,
+                     getReferenceAnalysesGroupID=sorted(pending))
+        groups = dict([(group_id, []) for group_id in pending])
+        for brain in self.search(query, ANALYSIS_CATALOG):
+            group_id = brain.getReferenceAnalysesGroupID
+            groups.setdefault(group_id, []).append(brain)
+        self._groups.update(groups)
+
+        pending = set([sample_id for sample_id in pending
+                       if not self._groups[sample_id] and
+                       sample_id not in self._reference_samples])
+        if not pending:
+            return
+
+        query = dict(portal_type=REFERENCE_SAMPLE, getId=sorted(pending))
+        references = dict([(sample_id, []) for sample_id in pending])
+        for brain in self.search(query, SENAITE_CATALOG):
+            references.setdefault(brain.getId, []).append(brain)
+        self._reference_samples.update(references)
+
+    def get_sample_brain(self, sample_id):
+        """Returns the catalog brain of the Sample or None
+        """
+        if sample_id not in self._sample_brains:
+            query = dict(portal_type=SAMPLE, getId=sample_id)
+            brains = self.search(query, SAMPLE_CATALOG)
+            self._sample_brains[sample_id] = brains[0] if brains else None
+        return self._sample_brains[sample_id]
+
+    def is_sample(self, sample_id):
+        return self.get_sample_brain(sample_id) is not None
+
+    def get_sample_id(self, sample_id):
+        """Returns the ID of the Sample with the given ID or ClientSampleID
+
+        The ClientSampleID is only used when it identifies a single Sample.
+        """
+        if self.is_sample(sample_id):
+            return sample_id
+        if sample_id not in self._client_sample_ids:
+            query = dict(portal_type=SAMPLE, getClientSampleID=sample_id)
+            brains = self.search(query, SAMPLE_CATALOG)
+            if len(brains) == 1:
+                self._sample_brains.setdefault(brains[0].getId, brains[0])
+                self._client_sample_ids[sample_id] = brains[0].getId
+            else:
+                self._client_sample_ids[sample_id] = None
+        return self._client_sample_ids[sample_id]
+
+    def get_sample(self, sample_id):
+        """Returns the Sample object or None
+        """
+        if sample_id not in self._samples:
+            brain = self.get_sample_brain(sample_id)
+            with timed(OBJECT_WAKEUPS):
+                sample = api.get_object(brain) if brain else None
+            self._samples[sample_id] = sample
+        return self._samples[sample_id]
+
+    def get_group_analyses(self, group_id, portal_type=None):
+        """Returns the Duplicate/Reference analysis brains of the group
+
+        Both types are fetched with a single query, portal_type only
+        filters the memoized result.
+        """
+        if group_id not in self._groups:
+            query = dict(portal_type=QC_ANALYSIS_TYPES,
+                         getReferenceAnalysesGroupID=group_id)
+            self._groups[group_id] = list(
+                self.search(query, ANALYSIS_CATALOG))
+        brains = self._groups[group_id]
+        self._add_batch(brains)
+        if portal_type:
+            brains = [b for b in brains if b.portal_type == portal_type]
+        return brains
+
+    def get_prefixed_group_analyses(self, prefix, portal_type=None):
+        """Returns the QC analysis brains of the groups starting with prefix
+
+        A range query on the group ID index only touches the groups sharing
+        the prefix instead of every Duplicate/Reference analysis of the site.
+        """
+        if not prefix:
+            return []
+        key = (prefix, portal_type)
+        if key not in self._prefixed_groups:
+            query = dict(portal_type=portal_type or QC_ANALYSIS_TYPES,
+                         getReferenceAnalysesGroupID=prefix_range(prefix))
+            brains = self.search(query, ANALYSIS_CATALOG)
+            self._prefixed_groups[key] = [
+                b for b in brains
+                if (b.getReferenceAnalysesGroupID or "").startswith(prefix)]
+        return self._prefixed_groups[key]
+
+    def is_analysis_group_id(self, group_id, portal_type=None):
+        brains = self.get_group_analyses(group_id, portal_type)
+        return True if brains else False
+
+    def get_reference_samples(self, reference_sample_id):
+        """Returns the ReferenceSample brains matching the ID
+        """
+        if reference_sample_id not in self._reference_samples:
+            query = dict(portal_type=REFERENCE_SAMPLE,
+                         getId=reference_sample_id)
+            self._reference_samples[reference_sample_id] = list(
+                self.search(query, SENAITE_CATALOG))
+        return self._reference_samples[reference_sample_id]
+
+    def get_reference_sample(self, reference_sample_id):
+        """Returns the ReferenceSample brain with the ID or None
+        """
+        brains = self.get_reference_samples(reference_sample_id)
+        by_id = dict([(api.get_id(brain), brain) for brain in brains])
+        return by_id.get(reference_sample_id)
+
+    def is_reference_sample(self, reference_sample_id):
+        return True if self.get_reference_samples(
+            reference_sample_id) else False
+
+    def get_portal_type(self, sample_id):
+        """Returns the portal type the ID stands for or None
+
+        Groups are reported as DuplicateAnalysis when they contain at least
+        one duplicate, as ReferenceAnalysis otherwise.
+        """
+        if self.is_sample(sample_id):
+            return SAMPLE
+        if self.is_analysis_group_id(sample_id, DUPLICATE_ANALYSIS):
+            return DUPLICATE_ANALYSIS
+        if self.is_analysis_group_id(sample_id):
+            return REFERENCE_ANALYSIS
+        if self.is_reference_sample(sample_id):
+            return REFERENCE_SAMPLE
+        return None
+
+    def get_analyses(self, sample_id):
+        """Returns the analyses of the Sample, QC group or ReferenceSample
+        """
+        if sample_id not in self._analyses:
+            analyses = self._fetch_analyses(sample_id)
+            self._analyses[sample_id] = analyses
+            self._add_batch(analyses)
+        return self._analyses[sample_id]
+
+    def get_analysis_index(self, sample_id, portal_type=None):
+        """Returns the AnalysisIndex of the Sample, QC group or ReferenceSample
+
+        When a portal_type is given, only the analyses of that type in the QC
+        group are indexed.
+        """
+        key = (sample_id, portal_type)
+        if key not in self._indexes:
+            if portal_type:
+                analyses = self.get_group_analyses(sample_id, portal_type)
+            else:
+                analyses = self.get_analyses(sample_id)
+            self._indexes[key] = AnalysisIndex(analyses)
+        return self._indexes[key]
+
+    def _add_batch(self, analyses):
+        """Keeps the analyses together to load the metadata of all at once
+        """
+        if not analyses:
+            return
+        uid = get_value(analyses[0], "UID")
+        if uid in self._batches:
+            return
+        batch = list(analyses)
+        for analysis in batch:
+            self._batches.setdefault(get_value(analysis, "UID"), batch)
+
+    def get_metadata(self, analysis, column):
+        """Returns an attribute of the ANALYSIS_METADATA of the analysis
+
+        Attributes are answered from the catalog metadata of the brain, or
+        from a cache kept for the import. When a column is missing, or for
+        the OBJECT_ATTRIBUTES, the objects of the Sample, QC group or
+        ReferenceSample the analysis was found with are woken up all at once
+        and their attributes cached.
+        Raises ValueError without an analysis.
+        """
+        if analysis is None:
+            raise ValueError("No analysis")
+        uid = get_value(analysis, "UID")
+        if uid not in self._metadata:
+            self._load_metadata(self._batches.get(uid) or [analysis])
+        return self._metadata[uid].get(column)
+
+    def _load_metadata(self, analyses):
+        missing = []
+        for analysis in analyses:
+            uid = get_value(analysis, "UID")
+            if uid in self._metadata:
+                continue
+            if api.is_brain(analysis):
+                metadata = get_metadata(analysis)
+                if len(metadata) < len(ANALYSIS_METADATA):
+                    missing.append(analysis)
+            else:
+                metadata = dict([(column, get_value(analysis, column))
+                                 for column in ANALYSIS_METADATA])
+            self._metadata[uid] = metadata
+        for brain, obj in zip(missing, wake_up(missing)):
+            metadata = self._metadata[get_value(brain, "UID")]
+            for column in ANALYSIS_METADATA:
+                if column not in metadata:
+                    metadata[column] = get_value(obj, column)
+
+    def get_interim_keywords(self, analysis):
+        """Returns the keywords of the interim fields of the analysis
+        """
+        uid = get_value(analysis, "UID")
+        if uid not in self._interim_keywords:
+            fields = self.get_metadata(analysis, "getInterimFields") or []
+            self._interim_keywords[uid] = [
+                field.get("keyword") for field in fields if field]
+        return self._interim_keywords[uid]
+
+    def get_interims_map(self, sample_id, portal_type=None):
+        """Returns a mapping of interim keyword -> analysis keywords
+
+        The mapping is built once per Sample, QC group or ReferenceSample and
+        lists the keyword of every analysis that has the interim field.
+        """
+        key = (sample_id, portal_type)
+        if key not in self._interims:
+            interims = {}
+            index = self.get_analysis_index(sample_id, portal_type)
+            for analysis in index.analyses:
+                keyword = get_value(analysis, "getKeyword")
+                for interim in self.get_interim_keywords(analysis):
+                    interims.setdefault(interim, []).append(keyword)
+            self._interims[key] = interims
+        return self._interims[key]
+
+    def _fetch_analyses(self, sample_id):
+        sample = self.get_sample(sample_id)
+        if sample is not None:
+            return list(sample.getAnalyses())
+        group = self.get_group_analyses(sample_id)
+        if group:
+            return group
+        reference_samples = self.get_reference_samples(sample_id)
+        if len(reference_samples) == 1:
+            with timed(OBJECT_WAKEUPS):
+                obj = api.get_object(reference_samples[0])
+            return list(obj.getReferenceAnalyses())
+        return []
+
+
+class ResolverMixin(object):
+    """Gives a results file parser a SampleResolver for the current import
+    """
+
+    _resolver = None
+
+    @property
+    def resolver(self):
+        if self._resolver is None:
+            self._resolver = SampleResolver()
+        return self._resolver
+
+    @resolver.setter
+    def resolver(self, value):
+        self._resolver = value
+
+    def prefetch(self, sample_ids):
+        self.resolver.prefetch(sample_ids)
+        count = len(set(filter(None, sample_ids)))
+        report_total(self, "samples", count)
+        report(self, "samples", count)
+
+    def iter_prefetched(self, rows, get_sample_id, size=ROW_BATCH_SIZE):
+        """Yields the rows, resolving the IDs of each batch of rows first
+
+        Only size rows are read ahead, a file costs one query per catalog and
+        batch. The rows and the Samples read so far are reported as totals,
+        they grow while the file is read.
+        """
+        sample_ids = set()
+        count = 0
+        for batch in iter_batches(rows, size):
+            new_ids = set(filter(None, map(get_sample_id, batch)))
+            new_ids.difference_update(sample_ids)
+            self.resolver.prefetch(new_ids)
+            sample_ids.update(new_ids)
+            count += len(batch)
+            report_total(self, "rows", count)
+            report_total(self, "samples", len(sample_ids))
+            report(self, "samples", len(new_ids))
+            for row in batch:
+                yield row
+
+    def is_sample(self, sample_id):
+        return self.resolver.is_sample(sample_id)
+
+    def get_ar(self, sample_id):
+        return self.resolver.get_sample(sample_id)
+
+    def is_analysis_group_id(self, analysis_group_id):
+        return self.resolver.is_analysis_group_id(analysis_group_id)
+
+    def is_reference_sample(self, reference_sample_id, *args):
+        return self.resolver.is_reference_sample(reference_sample_id)
+
+    def get_analysis_index(self, sample_id, portal_type=None):
+        return self.resolver.get_analysis_index(sample_id, portal_type)
+
+    def get_metadata(self, analysis, column):
+        return self.resolver.get_metadata(analysis, column)
@@ -0,0 +1,478 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.INSTRUMENTS.
+#
+# SENAITE.CORE is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright 2018-2019 by it's authors.
+# Some rights reserved, see README and LICENSE.
+
+import os
+from time import time
+
+import transaction
+from BTrees.OOBTree import OOBTree
+from BTrees.OOBTree import OOTreeSet
+from bika.lims import api
+from senaite.core.exportimport.instruments.logger import Logger
+from senaite.core.exportimport.instruments.resultsimport import \
+    AnalysisResultsImporter
+from senaite.instruments import logger
+from senaite.instruments.instrument import file_checksum
+from senaite.instruments.parsecache import cache_key
+from senaite.instruments.parsecache import keep_fresh
+from senaite.instruments.parsecache import use_parse_cache
+from senaite.instruments.progress import IMPORTING
+from senaite.instruments.progress import PROGRESS_KEY
+from senaite.instruments.progress import report
+from senaite.instruments.progress import report_state
+from senaite.instruments.progress import report_total
+from senaite.instruments.progress import start_progress
+from senaite.instruments.progress import track_progress
+from zope.annotation.interfaces import IAnnotations
+
+# Form field and environment variable asking for chunked commits, the value
+# is the number of Samples per transaction
+CHUNK_SIZE_KEY = "chunk_size"
+CHUNK_SIZE_ENV = "SENAITE_INSTRUMENTS_CHUNK_SIZE"
+
+# Form field and environment variable asking to apply the results while the
+# file is parsed
+STREAM_KEY = "stream"
+STREAM_ENV = "SENAITE_INSTRUMENTS_STREAM"
+
+# Samples between two savepoints inside a chunk
+SAVEPOINT_SIZE = 25
+
+# Portal annotation with the Samples applied by unfinished chunked imports
+CHECKPOINTS_KEY = "senaite.instruments.checkpoints"
+
+# Seconds a checkpoint is kept after the last chunk it recorded
+CHECKPOINT_TTL = 7 * 24 * 3600
+
+# Messages of AnalysisResultsImporter.process
+FINISHED_MSG = "Import finished successfully: ${nr_updated_ars} Samples and " \
+    "${nr_updated_results} results updated"
+FINISHED_INSTRUMENTS_MSG = "Import finished successfully: " \
+    "${nr_updated_ars} Samples, ${nr_updated_instruments} Instruments and " \
+    "${nr_updated_results} results updated"
+IMPORTED_MSG = "${request_id}: ${analysis_keywords} imported sucessfully"
+# logged the same on every call, only the first time is kept
+REPEATED_MSGS = (
+    "Allowed Sample states: ${allowed_states}",
+    "Allowed analysis states: ${allowed_states}",
+    "Service keyword ${analysis_keyword} not found",
+    "Service keywords: no matches found",
+)
+
+
+def get_chunk_size(request):
+    """Returns the number of Samples per transaction asked for, or None
+    """
+    form = getattr(request, "form", None) or {}
+    value = form.get(CHUNK_SIZE_KEY) or os.environ.get(CHUNK_SIZE_ENV)
+    try:
+        chunk_size = int(value or 0)
+    except (TypeError, ValueError):
+        logger.warn("Invalid chunk size: %r" % value)
+        return None
+    return chunk_size if chunk_size > 0 else None
+
+
+def get_stream(request, parser):
+    """Returns whether the results are to be applied while they are parsed
+    """
+    if not hasattr(parser, "iter_records"):
+        return False
+    form = getattr(request, "form", None) or {}
+    value = form.get(STREAM_KEY) or os.environ.get(STREAM_ENV) or ""
+    return str(value).lower() in ("1", "true", "on", "yes")
+
+
+def checkpoint_key(key, instrument_uid):
+    """Returns the checkpoint key of an import: the parse cache key of the
+    file with the instrument the results are imported for
+    """
+    return tuple(key) + (str(instrument_uid), )
+
+
+def get_checkpoints(create=False):
+    """Returns the checkpoints of the chunked imports, see checkpoint_key
+
+    Each checkpoint is the time of its last update with the set of IDs of the
+    Samples the import has committed so far. Returns None when there are none
+    and create is False, so that reading them does not write to the portal.
+    """
+    annotations = IAnnotations(api.get_portal())
+    checkpoints = annotations.get(CHECKPOINTS_KEY)
+    if checkpoints is None and create:
+        checkpoints = annotations[CHECKPOINTS_KEY] = OOBTree()
+    return checkpoints
+
+
+def is_expired(checkpoint):
+    modified, sample_ids = checkpoint
+    return modified + CHECKPOINT_TTL < time()
+
+
+def get_checkpoint(key):
+    """Returns the IDs of the Samples applied by earlier runs of the import
+    """
+    checkpoints = get_checkpoints()
+    if not checkpoints or key not in checkpoints:
+        return []
+    checkpoint = checkpoints[key]
+    if is_expired(checkpoint):
+        return []
+    return list(checkpoint[1])
+
+
+def update_checkpoint(key, sample_ids):
+    """Adds the Samples to the checkpoint and removes the expired ones of
+    imports that were never run again
+    """
+    checkpoints = get_checkpoints(create=True)
+    for expired in [other for other, checkpoint in checkpoints.items()
+                    if other != key and is_expired(checkpoint)]:
+        logger.info("Removing the expired checkpoint of %r" % (expired, ))
+        del checkpoints[expired]
+    samples = OOTreeSet()
+    if key in checkpoints and not is_expired(checkpoints[key]):
+        samples = checkpoints[key][1]
+    samples.update(sample_ids)
+    checkpoints[key] = (time(), samples)
+
+
+def remove_checkpoint(key):
+    checkpoints = get_checkpoints()
+    if checkpoints and key in checkpoints:
+        del checkpoints[key]
+
+
+def make_importer(request, **kwargs):
+    """Returns the results importer for the parser of an Import request
+
+    See select_importer. With an import token in the form, the progress of
+    the import is published under the token for the current user.
+    """
+    importer = select_importer(request, **kwargs)
+    form = getattr(request, "form", None) or {}
+    token = form.get(PROGRESS_KEY)
+    parser = kwargs.get("parser")
+    if token and parser is not None:
+        userid = api.get_current_user().getId()
+        track_progress(importer, parser, start_progress(token, userid))
+    return importer
+
+
+def select_importer(request, **kwargs):
+    """Returns the results importer asked for by the request
+
+    A ChunkedResultsImporter when the request or the environment asks for a
+    chunk size, the default AnalysisResultsImporter otherwise. Chunked
+    imports are checkpointed under the parse cache key of the uploaded file
+    and the instrument, so uploading the same file again with the same
+    options after a failure resumes the import.
+
+    The parser answers from the parse cache when the same file was imported
+    lately with the same options.
+
+    Without a chunk size, a StreamingResultsImporter when streaming is asked
+    for and the parser can stream its results. The parse cache is not used
+    then, streamed results are not kept.
+    """
+    form = getattr(request, "form", None) or {}
+    parser = kwargs.get("parser")
+    chunk_size = get_chunk_size(request)
+    if not chunk_size and get_stream(request, parser):
+        return StreamingResultsImporter(**kwargs)
+
+    infile = form.get("instrument_results_file")
+    checksum = file_checksum(infile) if hasattr(infile, "seek") else None
+    key = None
+    if checksum and parser is not None:
+        key = cache_key(checksum, parser, form.get("artoapply"),
+                        form.get("results_override"))
+        use_parse_cache(parser, key)
+
+    if not chunk_size:
+        importer = AnalysisResultsImporter(**kwargs)
+    else:
+        if key is not None and "checkpoint" not in kwargs:
+            kwargs["checkpoint"] = checkpoint_key(
+                key, kwargs.get("instrument_uid"))
+        importer = ChunkedResultsImporter(chunk_size=chunk_size, **kwargs)
+    if key is not None:
+        keep_fresh(importer, key)
+    return importer
+
+
+class ChunkParser(object):
+    """The parsed results of some of the Samples of a parser
+
+    Everything but the raw results and the counts and keywords taken from
+    them is the parser's, the messages logged while importing a chunk end up
+    in the parser's lists like for a whole import. The importer only looks
+    up the services of the keywords of the chunk.
+    """
+
+    def __init__(self, parser, sample_ids, rawresults=None):
+        self._parser = parser
+        raw = rawresults
+        if raw is None:
+            raw = parser.getRawResults()
+        self._rawresults = dict([(sample_id, raw[sample_id])
+                                 for sample_id in sample_ids])
+
+    def __getattr__(self, name):
+        return getattr(self._parser, name)
+
+    def parse(self):
+        # the parser has already parsed the file
+        return True
+
+    def resume(self):
+        if not self._rawresults:
+            return self._parser.resume()
+        return True
+
+    def getRawResults(self):
+        return self._rawresults
+
+    def getObjectsTotalCount(self):
+        return len(self._rawresults)
+
+    def getResultsTotalCount(self):
+        return sum([len(rows) for rows in self._rawresults.values()])
+
+    def getAnalysesTotalCount(self):
+        return len(self.getAnalysisKeywords())
+
+    def getAnalysisKeywords(self):
+        keywords = set()
+        for rows in self._rawresults.values():
+            for row in rows:
+                keywords.update(row.keys())
+        return list(keywords)
+
+
+class CombinedSummary:
+    """Reports several calls of AnalysisResultsImporter.process as one import
+
+    Between start_summary and log_summary, the messages each call logs about
+    the allowed states and the unknown services are only logged once, and the
+    "Import finished" message of each call is held back and added up into the
+    one log_summary logs. Old-style, like the Logger of the importer.
+    """
+    _summary = None
+
+    def start_summary(self):
+        self._summary = dict(samples=set(), results=0, instruments=0,
+                             logged=set())
+
+    def log_summary(self):
+        summary, self._summary = self._summary, None
+        mapping = {"nr_updated_ars": str(len(summary["samples"])),
+                   "nr_updated_results": str(summary["results"])}
+        if self.instrument_uid:
+            mapping["nr_updated_instruments"] = str(summary["instruments"])
+            self.log(FINISHED_INSTRUMENTS_MSG, mapping=mapping)
+        else:
+            self.log(FINISHED_MSG, mapping=mapping)
+
+    def summarize(self, msg, mapping):
+        """Returns whether the message is to be logged now
+        """
+        summary = self._summary
+        if summary is None:
+            return True
+        if msg in (FINISHED_MSG, FINISHED_INSTRUMENTS_MSG):
+            summary["results"] += int(mapping["nr_updated_results"])
+            summary["instruments"] += int(
+                mapping.get("nr_updated_instruments", 0))
+            return False
+        if msg == IMPORTED_MSG:
+            summary["samples"].add(mapping["request_id"])
+        elif msg in REPEATED_MSGS:
+            key = (msg, tuple(sorted(mapping.items())))
+            if key in summary["logged"]:
+                return False
+            summary["logged"].add(key)
+        return True
+
+    def log(self, msg, numline=None, line=None, mapping={}):
+        if self.summarize(msg, mapping):
+            Logger.log(self, msg, numline, line, mapping)
+
+    def warn(self, msg, numline=None, line=None, mapping={}):
+        if self.summarize(msg, mapping):
+            Logger.warn(self, msg, numline, line, mapping)
+
+
+class ChunkedResultsImporter(CombinedSummary, AnalysisResultsImporter):
+    """Applies the results of a file in one transaction per chunk of Samples
+
+    The file is parsed once, the Samples are then imported in chunks of
+    chunk_size, in the order of their IDs. A savepoint is taken every
+    savepoint_size Samples so the changes of a chunk do not pile up in
+    memory, and the chunk is committed before the next one starts. A failure
+    only rolls back the current chunk, the IDs of the Samples committed so
+    far are kept in applied and skipped when the import is run again with
+    them. The import is logged as one, see CombinedSummary.
+
+    With a checkpoint key, the applied Samples are also stored in the portal
+    in the transaction of each chunk and read back when an import with the
+    same key starts. The checkpoint is removed with the last chunk.
+    """
+
+    def __init__(self, parser, context, chunk_size=100,
+                 savepoint_size=SAVEPOINT_SIZE, applied=None, checkpoint=None,
+                 **kwargs):
+        AnalysisResultsImporter.__init__(
+            self, parser=parser, context=context, **kwargs)
+        self.chunk_size = chunk_size
+        self.savepoint_size = savepoint_size
+        self.applied = set(applied or [])
+        self.checkpoint = checkpoint
+        if checkpoint:
+            self.applied.update(get_checkpoint(checkpoint))
+
+    def pending(self):
+        """Returns the IDs of the parsed Samples not committed yet
+        """
+        raw = self._parser.getRawResults()
+        return [sample_id for sample_id in sorted(raw)
+                if sample_id not in self.applied]
+
+    def committed(self, sample_ids):
+        """Called after the Samples of a chunk were committed
+        """
+        self.applied.update(sample_ids)
+
+    def save_checkpoint(self, sample_ids, finished=False):
+        """Records the Samples of the chunk in the transaction of the chunk
+        """
+        if not self.checkpoint:
+            return
+        if finished:
+            remove_checkpoint(self.checkpoint)
+        else:
+            update_checkpoint(self.checkpoint, sample_ids)
+
+    def process(self):
+        parser = self._parser
+        parser.parse()
+        pending = self.pending()
+        total = len(pending)
+        report_total(self, "applied", total)
+        skipped = len(parser.getRawResults()) - total
+        if skipped:
+            # the importer takes over the messages of the parser
+            parser.log("Skipped ${count} already applied Samples",
+                       mapping=dict(count=skipped))
+        if not total:
+            # nothing to import, the importer reports it as usual
+            self._parser = ChunkParser(parser, [])
+            try:
+                return AnalysisResultsImporter.process(self)
+            finally:
+                self._parser = parser
+
+        self.start_summary()
+        try:
+            for start in range(0, total, self.chunk_size):
+                chunk = pending[start:start + self.chunk_size]
+                for pos in range(0, len(chunk), self.savepoint_size):
+                    self._parser = ChunkParser(
+                        parser, chunk[pos:pos + self.savepoint_size])
+                    AnalysisResultsImporter.process(self)
+                    transaction.savepoint(optimistic=True)
+                self.save_checkpoint(
+                    chunk, finished=start + len(chunk) == total)
+                transaction.get().note(
+                    u"Instrument import: %s Samples" % len(chunk))
+                transaction.commit()
+                self.committed(chunk)
+                report(self, "applied", len(chunk))
+                self.log("Committed ${done} of ${total} Samples",
+                         mapping=dict(done=start + len(chunk), total=total))
+        except Exception:
+            # roll back the current chunk only, the committed ones stay
+            transaction.abort()
+            raise
+        finally:
+            self._parser = parser
+        self.log_summary()
+        return True
+
+
+class StreamingResultsImporter(CombinedSummary, AnalysisResultsImporter):
+    """Applies the results of each Sample as soon as its rows are parsed
+
+    The parser hands out its results with iter_records, the results of a
+    Sample are applied when the records of the next Sample start, so only
+    the results of one Sample are held at a time. A Sample whose rows are
+    not together in the file is applied once per group of rows, like the
+    default importer applies each of its rows in turn.
+
+    A savepoint is taken every savepoint_size Samples, the import is
+    committed with the request. The import is logged as one, see
+    CombinedSummary.
+    """
+
+    def __init__(self, parser, context, savepoint_size=SAVEPOINT_SIZE,
+                 **kwargs):
+        AnalysisResultsImporter.__init__(
+            self, parser=parser, context=context, **kwargs)
+        self.savepoint_size = savepoint_size
+        self.applied = 0
+
+    def apply(self, sample_id, results):
+        """Applies the results of a Sample with the default importer
+        """
+        parser = self._parser
+        self._parser = ChunkParser(parser, [sample_id], {sample_id: results})
+        try:
+            AnalysisResultsImporter.process(self)
+        finally:
+            self._parser = parser
+        self.applied += 1
+        report(self, "applied")
+        if self.applied % self.savepoint_size == 0:
+            transaction.savepoint(optimistic=True)
+
+    def process(self):
+        parser = self._parser
+        report_state(self, IMPORTING)
+        sample_id = None
+        results = []
+        self.start_summary()
+        for record_id, keyword, values in parser.iter_records():
+            if record_id != sample_id and results:
+                self.apply(sample_id, results)
+                results = []
+            sample_id = record_id
+            results.append({keyword: values})
+        if results:
+            self.apply(sample_id, results)
+        if self.applied:
+            self.log_summary()
+            return True
+        # nothing parsed, the importer reports it as usual
+        self._summary = None
+        self._parser = ChunkParser(parser, [])
+        try:
+            return AnalysisResultsImporter.process(self)
+        finally:
+            self._parser = parser
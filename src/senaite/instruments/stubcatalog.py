@@ -0,0 +1,393 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.INSTRUMENTS.
+#
+# SENAITE.CORE is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright 2018-2019 by it's authors.
+# Some rights reserved, see README and LICENSE.
+
+"""In-memory stand-in for the catalogs and objects the parsers touch
+
+A StubCatalog holds Samples, QC analysis groups, ReferenceSamples and
+Instruments as plain Python objects. Used as a context manager it takes over
+the bika.lims api lookups while the block runs, so any parser can be run and
+profiled without a Plone site::
+
+    catalog = StubCatalog()
+    catalog.add_sample("W-0001", [("Ca", "Calcium", ["Reading"])])
+    with catalog:
+        parser.parse()
+"""
+
+from bika.lims import api
+from Products.ZCatalog.interfaces import ICatalogBrain
+from senaite.core.catalog import ANALYSIS_CATALOG
+from senaite.core.catalog import SAMPLE_CATALOG
+from senaite.core.catalog import SENAITE_CATALOG
+from senaite.instruments.profiling import record_query
+from senaite.instruments.profiling import record_wakeup
+from senaite.instruments.resolver import DUPLICATE_ANALYSIS
+from senaite.instruments.resolver import REFERENCE_ANALYSIS
+from senaite.instruments.resolver import REFERENCE_SAMPLE
+from senaite.instruments.resolver import SAMPLE
+from zope.interface import implementer
+
+SETUP_CATALOG = "bika_setup_catalog"
+UID_CATALOG = "uid_catalog"
+
+# query keys that are not indexes
+SORT_KEYS = ("sort_on", "sort_order", "sort_limit")
+
+_marker = object()
+
+
+@implementer(ICatalogBrain)
+class Brain(object):
+    """Catalog brain of a stub object, the metadata are plain attributes
+    """
+
+    def __init__(self, obj, **metadata):
+        self._obj = obj
+        self.__dict__.update(metadata)
+
+    def getObject(self):
+        record_wakeup()
+        return self._obj
+
+
+class Analysis(object):
+    """Routine, Duplicate or Reference analysis
+    """
+
+    def __init__(self, uid, keyword, title=None, interims=(), precision=2,
+                 ldl=None, udl=None, portal_type="Analysis", group_id=None):
+        self.UID = uid
+        self.Keyword = keyword
+        self.title = title or keyword
+        self.InterimFields = [dict(keyword=interim, title=interim)
+                              for interim in interims]
+        self.Precision = precision
+        self.LowerDetectionLimit = ldl
+        self.UpperDetectionLimit = udl
+        self.portal_type = portal_type
+        self.ReferenceAnalysesGroupID = group_id
+        self.Uncertainty = None
+
+    def getKeyword(self):
+        return self.Keyword
+
+    def Title(self):
+        return self.title
+
+    def getInterimFields(self):
+        return self.InterimFields
+
+    def getPrecision(self):
+        return self.Precision
+
+    def getLowerDetectionLimit(self):
+        return self.LowerDetectionLimit
+
+    def getUpperDetectionLimit(self):
+        return self.UpperDetectionLimit
+
+    def getReferenceAnalysesGroupID(self):
+        return self.ReferenceAnalysesGroupID
+
+    def setUncertainty(self, value):
+        self.Uncertainty = value
+
+    def brain(self):
+        return Brain(self, UID=self.UID, portal_type=self.portal_type,
+                     getKeyword=self.Keyword, Title=self.title,
+                     getInterimFields=self.InterimFields,
+                     getReferenceAnalysesGroupID=self.ReferenceAnalysesGroupID)
+
+
+class Sample(object):
+    portal_type = SAMPLE
+
+    def __init__(self, uid, sample_id, analyses, client_sample_id=None):
+        self.UID = uid
+        self.id = sample_id
+        self.analyses = analyses
+        self.ClientSampleID = client_sample_id
+        self.Remarks = None
+
+    def getId(self):
+        return self.id
+
+    def getClientSampleID(self):
+        return self.ClientSampleID
+
+    def getAnalyses(self, full_objects=False):
+        if full_objects:
+            return list(self.analyses)
+        return [analysis.brain() for analysis in self.analyses]
+
+    def setRemarks(self, value):
+        self.Remarks = value
+
+    def brain(self):
+        return Brain(self, UID=self.UID, getId=self.id,
+                     getClientSampleID=self.ClientSampleID,
+                     portal_type=self.portal_type)
+
+
+class ReferenceSample(object):
+    portal_type = REFERENCE_SAMPLE
+
+    def __init__(self, uid, sample_id, analyses):
+        self.UID = uid
+        self.id = sample_id
+        self.analyses = analyses
+
+    def getId(self):
+        return self.id
+
+    def getReferenceAnalyses(self):
+        return list(self.analyses)
+
+    def brain(self):
+        return Brain(self, UID=self.UID, getId=self.id,
+                     portal_type=self.portal_type)
+
+
+class AnalysisService(object):
+    portal_type = "AnalysisService"
+
+    def __init__(self, uid, keyword, title=None):
+        self.UID = uid
+        self.Keyword = keyword
+        self.title = title or keyword
+
+    def getKeyword(self):
+        return self.Keyword
+
+    def Title(self):
+        return self.title
+
+    def brain(self):
+        return Brain(self, UID=self.UID, getKeyword=self.Keyword,
+                     Title=self.title, portal_type=self.portal_type)
+
+
+class Instrument(object):
+    portal_type = "Instrument"
+
+    def __init__(self, uid, title):
+        self.UID = uid
+        self.title = title
+
+    def Title(self):
+        return self.title
+
+    def brain(self):
+        return Brain(self, UID=self.UID, Title=self.title,
+                     portal_type=self.portal_type)
+
+
+class Tool(object):
+    """Catalog tool answering from the stub, as returned by api.get_tool
+    """
+
+    def __init__(self, catalog, name):
+        self.catalog = catalog
+        self.name = name
+
+    def __call__(self, query=None, **kwargs):
+        query = dict(query or {}, **kwargs)
+        return self.catalog.search(query, self.name)
+
+    searchResults = __call__
+
+    def getPhysicalPath(self):
+        return ("", "stub", self.name)
+
+    def getCounter(self):
+        return self.catalog.counter
+
+    def uniqueValuesFor(self, index):
+        indexes = self.catalog.get_indexes(self.name)
+        return tuple(indexes.get(index, {}))
+
+
+def matches(value, criterion):
+    """Checks a metadata value against the criterion of a catalog query
+    """
+    if isinstance(criterion, dict):
+        if "range" in criterion:
+            low, high = criterion["query"]
+            return value is not None and low <= value <= high
+        criterion = criterion.get("query")
+    if isinstance(criterion, (list, tuple, set)):
+        return value in criterion
+    return value == criterion
+
+
+class StubCatalog(object):
+    """Samples, QC groups and ReferenceSamples kept in memory
+
+    Each catalog is a list of brains indexed by all their metadata, queries
+    on the indexes are answered with dict lookups so the stub stays cheap next
+    to the parsers it is used to measure. Used as a context manager, it takes
+    over api.search, api.get_object, api.get_object_by_uid and api.get_tool
+    while the block runs. Its searches and brain wake-ups are reported to the
+    QueryCounter like those of a ZCatalog.
+    """
+
+    def __init__(self):
+        self.objects = {}
+        self.counter = 0
+        self._brains = {}
+        self._indexes = {}
+        self._patched = None
+
+    def next_uid(self):
+        self.counter += 1
+        return "%032x" % self.counter
+
+    def catalog(self, obj, *catalogs):
+        """Adds the object and its brain to the catalogs
+        """
+        self.objects[obj.UID] = obj
+        brain = obj.brain()
+        for name in catalogs + (UID_CATALOG, ):
+            self._brains.setdefault(name, []).append(brain)
+            indexes = self._indexes.setdefault(name, {})
+            for index, value in brain.__dict__.items():
+                if index.startswith("_") or \
+                        isinstance(value, (list, dict)):
+                    continue
+                indexes.setdefault(index, {}).setdefault(
+                    value, []).append(brain)
+        return obj
+
+    def get_indexes(self, name):
+        return self._indexes.get(name, {})
+
+    def make_analyses(self, analyses, **kwargs):
+        """Returns Analysis objects for (keyword, title, interims) tuples or
+        dicts of the Analysis arguments
+
+        An AnalysisService is added to the setup catalog for new keywords.
+        """
+        objs = []
+        for analysis in analyses:
+            if not isinstance(analysis, dict):
+                analysis = dict(zip(("keyword", "title", "interims"),
+                                    analysis))
+            analysis = dict(analysis, **kwargs)
+            obj = Analysis(self.next_uid(), **analysis)
+            if obj.Keyword not in self.keywords:
+                service = AnalysisService(
+                    self.next_uid(), obj.Keyword, obj.title)
+                self.catalog(service, SETUP_CATALOG)
+            objs.append(obj)
+        return objs
+
+    def add_sample(self, sample_id, analyses, client_sample_id=None):
+        """Adds a Sample with its routine analyses
+        """
+        objs = self.make_analyses(analyses)
+        for obj in objs:
+            self.catalog(obj, ANALYSIS_CATALOG)
+        sample = Sample(self.next_uid(), sample_id, objs, client_sample_id)
+        return self.catalog(sample, SAMPLE_CATALOG)
+
+    def add_reference_group(self, group_id, analyses,
+                            portal_type=REFERENCE_ANALYSIS):
+        """Adds the Reference or Duplicate analyses of a worksheet QC group
+        """
+        if portal_type not in (REFERENCE_ANALYSIS, DUPLICATE_ANALYSIS):
+            raise ValueError("Not a QC analysis type: %s" % portal_type)
+        objs = self.make_analyses(
+            analyses, portal_type=portal_type, group_id=group_id)
+        for obj in objs:
+            self.catalog(obj, ANALYSIS_CATALOG)
+        return objs
+
+    def add_reference_sample(self, sample_id, analyses):
+        """Adds a ReferenceSample with its reference analyses
+        """
+        objs = self.make_analyses(analyses, portal_type=REFERENCE_ANALYSIS)
+        reference = ReferenceSample(self.next_uid(), sample_id, objs)
+        return self.catalog(reference, SENAITE_CATALOG)
+
+    def add_instrument(self, title):
+        return self.catalog(Instrument(self.next_uid(), title),
+                            SETUP_CATALOG)
+
+    @property
+    def keywords(self):
+        return self.get_indexes(SETUP_CATALOG).get("getKeyword", {})
+
+    def search(self, query, catalog=None):
+        """Returns the brains of the catalog matching all the query criteria
+
+        The first criterion on an exact value narrows the candidates through
+        its index, the others are checked on each candidate.
+        """
+        record_query(catalog, query)
+        criteria = dict([(key, value) for key, value in query.items()
+                         if key not in SORT_KEYS])
+        indexes = self.get_indexes(catalog)
+        candidates = None
+        for index, wanted in sorted(criteria.items()):
+            if index == "portal_type" or isinstance(wanted, dict):
+                continue
+            if not isinstance(wanted, (list, tuple, set)):
+                wanted = [wanted]
+            values = indexes.get(index, {})
+            candidates = []
+            for value in wanted:
+                candidates.extend(values.get(value, []))
+            del criteria[index]
+            break
+        if candidates is None:
+            candidates = self._brains.get(catalog, [])
+        return [brain for brain in candidates
+                if all([matches(getattr(brain, index, None), criterion)
+                        for index, criterion in criteria.items()])]
+
+    @staticmethod
+    def get_object(brain_or_object, *args):
+        if isinstance(brain_or_object, Brain):
+            return brain_or_object.getObject()
+        return brain_or_object
+
+    def get_object_by_uid(self, uid, default=_marker):
+        obj = self.objects.get(uid)
+        if obj is None:
+            if default is not _marker:
+                return default
+            raise ValueError("No object found for UID %s" % uid)
+        return obj
+
+    def get_tool(self, name, *args, **kwargs):
+        return Tool(self, name)
+
+    def __enter__(self):
+        self._patched = (api.search, api.get_object, api.get_object_by_uid,
+                         api.get_tool)
+        api.search = self.search
+        api.get_object = self.get_object
+        api.get_object_by_uid = self.get_object_by_uid
+        api.get_tool = self.get_tool
+        return self
+
+    def __exit__(self, *exc_info):
+        (api.search, api.get_object, api.get_object_by_uid,
+         api.get_tool) = self._patched
@@ -2,7 +2,9 @@ from plone.app.testing import FunctionalTesting
 from plone.app.testing import PLONE_FIXTURE
 from plone.app.testing import PloneSandboxLayer
 from plone.app.testing import applyProfile
+from plone.testing import Layer
 from plone.testing import zope
+from senaite.instruments.stubcatalog import StubCatalog
 
 import transaction
 
@@ -52,3 +54,23 @@ class BaseLayer(PloneSandboxLayer):
 BASE_LAYER_FIXTURE = BaseLayer()
 BASE_TESTING = FunctionalTesting(
     bases=(BASE_LAYER_FIXTURE,), name="SENAITE.INSTRUMENTS:BaseTesting")
+
+
+class StubCatalogLayer(Layer):
+    """Gives each test a StubCatalog in place of the site catalogs
+
+    No Plone site is set up, parsers and the resolver only see the objects
+    the test adds to layer["catalog"].
+    """
+
+    def testSetUp(self):
+        self["catalog"] = StubCatalog()
+        self["catalog"].__enter__()
+
+    def testTearDown(self):
+        self["catalog"].__exit__(None, None, None)
+        del self["catalog"]
+
+
+STUB_CATALOG_TESTING = StubCatalogLayer(
+    name="SENAITE.INSTRUMENTS:StubCatalogTesting")
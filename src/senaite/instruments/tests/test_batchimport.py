@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+
+import shutil
+import tempfile
+from datetime import datetime
+from os.path import abspath
+from os.path import dirname
+from os.path import join
+
+from plone.app.testing import TEST_USER_ID
+from plone.app.testing import TEST_USER_NAME
+from plone.app.testing import login
+from plone.app.testing import setRoles
+
+from bika.lims import api
+from senaite.instruments.batchimport import BatchImport
+from senaite.instruments.batchimport import list_files
+from senaite.instruments.instruments.perkinelmer.avio.avio import importer
+from senaite.instruments.tests.base import BaseTestCase
+
+IFACE = "senaite.instruments.instruments.perkinelmer.avio.avio.importer"
+here = abspath(dirname(__file__))
+test_file = join(
+    here, "files", "instruments", "perkinelmer", "avio",
+    "Lotus Avio Environmental 22-07 XLS.xlsx")
+
+
+class TestBatchImport(BaseTestCase):
+
+    def setUp(self):
+        super(TestBatchImport, self).setUp()
+        setRoles(self.portal, TEST_USER_ID, ["Member", "LabManager"])
+        login(self.portal, TEST_USER_NAME)
+        client = self.add_client(title="Happy Hills", ClientID="HH")
+        contact = api.create(
+            client, "Contact", Firstname="Rita", Surname="Mohale")
+        self.instrument = self.add_instrument(
+            title="Perkin Elmer Syngistix Uranium",
+            InstrumentType=self.add_instrumenttype(title="Avio ICP"),
+            Manufacturer=self.add_manufacturer(title="Perkin Elmer"),
+            Supplier=self.add_supplier(title="Instruments Inc"),
+            ImportDataInterface=IFACE,
+        )
+        category = self.add_analysiscategory(title="ICP")
+        service = self.add_analysisservice(
+            title="Uranium 424.167", Keyword="U424167",
+            PointOfCapture="lab", Category=category)
+        sampletype = self.add_sampletype(title="Environmental")
+        self.ar = self.add_analysisrequest(
+            client,
+            dict(Client=client.UID(),
+                 Contact=contact.UID(),
+                 DateSampled=datetime.now().date().isoformat(),
+                 SampleType=sampletype.UID()),
+            [service.UID()])
+        self.ar.setId("SW07 22.07.26")
+        api.do_transition_for(self.ar, "receive")
+
+        self.folder = tempfile.mkdtemp()
+        shutil.copy(test_file, self.folder)
+        with open(join(self.folder, "broken.xlsx"), "wb") as f:
+            f.write("not a workbook")
+        with open(join(self.folder, ".partial.xlsx"), "wb") as f:
+            f.write("still copying")
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+        super(TestBatchImport, self).tearDown()
+
+    def run_batch(self):
+        batch = BatchImport(
+            self.portal, importer(self.portal).get_automatic_parser,
+            instrument_uid=api.get_uid(self.instrument),
+            override="override")
+        return list(batch.run(self.folder))
+
+    def test_list_files(self):
+        names = [path.split("/")[-1] for path in list_files(self.folder)]
+        self.assertEqual(
+            names, ["Lotus Avio Environmental 22-07 XLS.xlsx", "broken.xlsx"])
+
+    def test_batch_import(self):
+        reports = self.run_batch()
+        self.assertEqual(len(reports), 2)
+        self.assertEqual(reports[0]["errors"], [])
+        self.assertTrue(reports[1]["errors"])
+        uranium = self.ar.getAnalyses(full_objects=True)[0]
+        self.assertEqual(uranium.getResult(), "0.687963357571")
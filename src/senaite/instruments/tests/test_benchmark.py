@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+
+import unittest2 as unittest
+from senaite.instruments.benchmark.files import INSTRUMENTS
+from senaite.instruments.benchmark.runner import COLUMNS
+from senaite.instruments.benchmark.runner import format_header
+from senaite.instruments.benchmark.runner import format_row
+from senaite.instruments.benchmark.runner import run
+
+
+class TestBenchmark(unittest.TestCase):
+
+    def test_run_every_instrument(self):
+        for instrument in INSTRUMENTS:
+            stats = run(instrument, 10)
+            self.assertEqual(stats["instrument"], instrument)
+            self.assertEqual(stats["samples"], 10)
+            self.assertEqual(stats["errors"], 0, instrument)
+            self.assertEqual(stats["warns"], 0, instrument)
+            self.assertTrue(stats["results"] >= 10, instrument)
+            self.assertEqual(len(format_row(stats)), len(format_header()))
+
+    def test_columns_are_reported(self):
+        stats = run("syngistix", 10)
+        for key, title, width, decimals in COLUMNS:
+            self.assertIn(key, stats)
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+
+import cStringIO
+import csv
+import re
+import zipfile
+from os.path import abspath
+from os.path import dirname
+from os.path import join
+
+from openpyxl import Workbook
+from openpyxl.cell.read_only import ReadOnlyCell
+from senaite.instruments.instrument import CSV
+from senaite.instruments.instrument import SheetNotFound
+from senaite.instruments.instrument import UTF16_CSV
+from senaite.instruments.instrument import XLS
+from senaite.instruments.instrument import XLSX
+from senaite.instruments.instrument import detect_format
+from senaite.instruments.instrument import iter_ascii_rows
+from senaite.instruments.instrument import iter_dict_rows
+from senaite.instruments.instrument import iter_rows
+from senaite.instruments.instrument import iter_text_lines
+from senaite.instruments.instrument import iter_xlsx_rows
+from senaite.instruments.instrument import load_xls_workbook
+from senaite.instruments.instrument import workbook_cache
+from senaite.instruments.instrument import xls_to_csv
+from senaite.instruments.tests import TestFile
+from senaite.instruments.tests.base import BaseTestCase
+from zope.publisher.browser import FileUpload
+
+here = abspath(dirname(__file__))
+path = join(here, 'files', 'instruments')
+
+
+def upload(data, filename):
+    return FileUpload(TestFile(cStringIO.StringIO(data), filename))
+
+
+def xlsx_upload(rows, dimension):
+    """Returns a xlsx upload of the rows whose sheet declares the dimension
+    """
+    wb = Workbook()
+    for row in rows:
+        wb.active.append(row)
+    saved = cStringIO.StringIO()
+    wb.save(saved)
+    source = zipfile.ZipFile(saved)
+    data = cStringIO.StringIO()
+    target = zipfile.ZipFile(data, 'w')
+    for item in source.infolist():
+        content = source.read(item.filename)
+        if item.filename == 'xl/worksheets/sheet1.xml':
+            content = re.sub(r'<dimension ref="[^"]*" ?/>',
+                             '<dimension ref="%s"/>' % dimension, content)
+        target.writestr(item, content)
+    target.close()
+    return upload(data.getvalue(), 'results.xlsx')
+
+
+class TestRows(BaseTestCase):
+
+    def test_csv_rows(self):
+        data = 'Sample ID,Analyte\n\nH2O-0001,"Ca\nFe",1\nH2O-0002\n'
+        rows = list(iter_dict_rows(iter_rows(upload(data, 'results.csv'))))
+
+        self.assertEqual(rows, [
+            (4, {'Sample ID': 'H2O-0001', 'Analyte': 'Ca\nFe', None: ['1']}),
+            (5, {'Sample ID': 'H2O-0002', 'Analyte': None}),
+        ])
+        # numbered like csv.DictReader numbers them
+        reader = csv.DictReader(cStringIO.StringIO(data))
+        self.assertEqual([(line_num, row) for line_num, row in rows],
+                         [(reader.line_num, row) for row in reader])
+
+    def test_xlsx_keeps_multiline_cells(self):
+        fn = join(path, 'perkinelmer', 'nexion350x', 'nexion350x.xlsx')
+        with open(fn, 'rb') as f:
+            rows = iter_rows(upload(f.read(), 'nexion350x.xlsx'))
+            headers = next(rows)
+
+        self.assertIn('K 39\n(cps)', headers)
+
+    def test_xlsx_rows_are_read_only(self):
+        # exports often declare the sheet to span all 1048576 rows
+        infile = xlsx_upload(
+            [['Sample', 'Ca', 'Fe'], ['W-1', 1], ['W-2', 2, 3]],
+            'A1:C1048576')
+        rows = list(iter_xlsx_rows(infile))
+
+        self.assertIsInstance(rows[0][0], ReadOnlyCell)
+        self.assertEqual([[cell.value for cell in row] for row in rows], [
+            [u'Sample', u'Ca', u'Fe'], [u'W-1', 1, None], [u'W-2', 2, 3]])
+        infile.seek(0)
+        self.assertEqual(list(iter_rows(infile)), [
+            ['Sample', 'Ca', 'Fe'], ['W-1', '1', ''], ['W-2', '2', '3']])
+
+    def test_xlsx_missing_sheet(self):
+        infile = xlsx_upload([['Sample']], 'A1')
+        for worksheet in ['Comments', 1]:
+            infile.seek(0)
+            rows = iter_xlsx_rows(infile, worksheet)
+            self.assertRaises(SheetNotFound, list, rows)
+
+    def test_unknown_format(self):
+        infile = upload('\x00\x01\x02', 'results.xlsx')
+        self.assertRaises(ValueError, iter_rows, infile)
+
+    def test_text_lines(self):
+        text = u'"Sample",M\xe9thode\r\nH2O-0001,12.5\n\r\nlast'
+        for data in [text.encode('utf-16'), text.encode('utf-8')]:
+            lines = iter_text_lines(cStringIO.StringIO(data), chunk_size=3)
+            self.assertEqual(list(lines), [
+                u'"Sample",M\xe9thode', u'H2O-0001,12.5', u'', u'last'])
+
+        rows = iter_ascii_rows(cStringIO.StringIO(text.encode('utf-16')))
+        self.assertEqual(next(rows), ['Sample', 'Mthode'])
+
+    def test_detect_format(self):
+        for name, expected in [
+                ('bika/software/software_single_sample.xls', XLS),
+                ('perkinelmer/nexion350x/nexion350x.xlsx', XLSX),
+                ('perkinelmer/winlab32/winlab32.csv', CSV),
+                ('hach/dr3900/dr3900_general_utf16.csv', UTF16_CSV)]:
+            with open(join(path, name), 'rb') as f:
+                # the extension is not looked at
+                infile = upload(f.read(), 'results.xlsx')
+            self.assertEqual(detect_format(infile), expected)
+            self.assertEqual(infile.tell(), 0)
+
+    def test_workbook_cache(self):
+        fn = join(path, 'bika', 'software', 'software_single_sample.xls')
+        with open(fn, 'rb') as f:
+            infile = upload(f.read(), 'software_single_sample.xls')
+
+        with workbook_cache(infile):
+            wb = load_xls_workbook(infile)
+            results = xls_to_csv(infile, worksheet=0).getvalue()
+            comments = xls_to_csv(infile, worksheet=1).getvalue()
+            self.assertIs(load_xls_workbook(infile), wb)
+
+        infile.seek(0)
+        self.assertIsNot(load_xls_workbook(infile), wb)
+        infile.seek(0)
+        self.assertEqual(xls_to_csv(infile, worksheet=0).getvalue(), results)
+        infile.seek(0)
+        self.assertEqual(xls_to_csv(infile, worksheet=1).getvalue(), comments)
+
+    def test_xls_missing_sheet(self):
+        fn = join(path, 'bika', 'software', 'software_single_sample.xls')
+        with open(fn, 'rb') as f:
+            infile = upload(f.read(), 'software_single_sample.xls')
+        for worksheet in ['Missing', 2]:
+            infile.seek(0)
+            self.assertRaises(SheetNotFound, xls_to_csv, infile, worksheet)
+            infile.seek(0)
+            self.assertRaises(SheetNotFound, iter_rows, infile, worksheet)
+        infile.seek(0)
+        comments = xls_to_csv(infile, 'Comments').getvalue()
+        infile.seek(0)
+        self.assertEqual(xls_to_csv(infile, 1).getvalue(), comments)
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+
+import unittest2 as unittest
+from senaite.instruments.numeric import BELOW
+from senaite.instruments.numeric import EMPTY
+from senaite.instruments.numeric import INVALID
+from senaite.instruments.numeric import NOT_DETECTED
+from senaite.instruments.numeric import NO_VALUE
+from senaite.instruments.numeric import OVER_RANGE
+from senaite.instruments.numeric import clean_numbers
+from senaite.instruments.numeric import parse_number
+
+
+class TestNumeric(unittest.TestCase):
+
+    def test_parse_number(self):
+        self.assertEqual(parse_number("1.5"), (1.5, None))
+        self.assertEqual(parse_number(2), (2.0, None))
+        self.assertEqual(parse_number("<0.01"), (0.01, BELOW))
+        self.assertEqual(parse_number(""), (None, EMPTY))
+        self.assertEqual(parse_number(None), (None, EMPTY))
+        self.assertEqual(parse_number("ND"), (None, NOT_DETECTED))
+        self.assertEqual(parse_number("----"), (None, NO_VALUE))
+        self.assertEqual(parse_number("over"), (None, OVER_RANGE))
+        self.assertEqual(parse_number("1,5"), (None, INVALID))
+        self.assertEqual(parse_number("12.5 ppm", strip=True), (12.5, None))
+
+    def test_clean_numbers(self):
+        values = clean_numbers(["22300", "16000", "x", "<5"], divisor=10000,
+                               precision=[2, 3, 2, 2])
+        self.assertEqual(values.values, [2.23, 1.6, None, 0.0])
+        self.assertEqual(values.flags, [None, None, INVALID, BELOW])
+        self.assertEqual(values.invalid, [2])
+        self.assertEqual(list(clean_numbers([4], factor=0.5)), [(2.0, None)])
+
+    def test_same_as_cell_by_cell(self):
+        cells = [str(i * 1.37) for i in range(200)] + ["ND", "7"]
+        expected = [round(float(cell) / 10000, 4) for cell in cells[:200]]
+        expected += [None, 0.0007]
+        values = clean_numbers(cells, divisor=10000, precision=4)
+        self.assertEqual(values.values, expected)
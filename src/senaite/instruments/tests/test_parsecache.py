@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+
+import unittest2 as unittest
+from senaite.instruments import parsecache
+from senaite.instruments.parsecache import cache_key
+from senaite.instruments.parsecache import keep_fresh
+from senaite.instruments.parsecache import use_parse_cache
+from senaite.instruments.tests.layers import STUB_CATALOG_TESTING
+
+
+class Parser(object):
+    """Counts its parses and returns one result per Sample
+    """
+
+    def __init__(self, warn=False, worksheet=0):
+        self.parses = 0
+        self.worksheet = worksheet
+        self.warn = warn
+        self._rawresults = {}
+        self.errors = []
+        self.warns = []
+        self.logs = []
+
+    def getRawResults(self):
+        return self._rawresults
+
+    def parse(self):
+        self.parses += 1
+        self._rawresults = {"W-0001": [{"Ca": {"DefaultResult": "1.2"}}]}
+        self.logs.append("1 result parsed")
+        if self.warn:
+            self.warns.append("No Sample found with ID W-0002")
+        return True
+
+
+class WritingParser(Parser):
+    writes_on_parse = True
+
+
+class Importer(object):
+
+    def __init__(self, catalog):
+        self.catalog = catalog
+
+    def process(self):
+        # the results are reindexed
+        self.catalog.counter += 1
+        return True
+
+
+class TestParseCache(unittest.TestCase):
+    layer = STUB_CATALOG_TESTING
+
+    def setUp(self):
+        self.catalog = self.layer["catalog"]
+        parsecache.clear()
+
+    def tearDown(self):
+        parsecache.clear()
+
+    def test_repeated_upload(self):
+        first = Parser()
+        key = cache_key("0123", first, "received", "override")
+        self.assertFalse(use_parse_cache(first, key))
+        self.assertTrue(first.parse())
+
+        second = Parser()
+        self.assertTrue(use_parse_cache(second, key))
+        self.assertTrue(second.parse())
+        self.assertEqual(second.parses, 0)
+        self.assertEqual(second.getRawResults(), first.getRawResults())
+        self.assertEqual(second.logs, ["1 result parsed"])
+        # the importer may change the results, the cache keeps its copy
+        second.getRawResults()["W-0001"][0]["Ca"]["DefaultResult"] = "9"
+        third = Parser()
+        use_parse_cache(third, key)
+        self.assertEqual(
+            third.getRawResults()["W-0001"][0]["Ca"]["DefaultResult"], "1.2")
+
+    def test_options_are_part_of_the_key(self):
+        parser = Parser()
+        use_parse_cache(parser, cache_key("0123", parser, "received"))
+        parser.parse()
+        self.assertTrue(use_parse_cache(
+            Parser(), cache_key("0123", Parser(), "received")))
+        for other, artoapply, override in [
+                (Parser(), "received", "override"),
+                (Parser(), "received_tobeverified", None),
+                (Parser(worksheet="Results"), "received", None)]:
+            self.assertFalse(use_parse_cache(
+                other, cache_key("0123", other, artoapply, override)))
+
+    def test_changed_catalogs_make_entries_stale(self):
+        parser = Parser()
+        key = cache_key("0123", parser)
+        use_parse_cache(parser, key)
+        parser.parse()
+        self.catalog.add_sample("W-0001", [("Ca", None, [])])
+        self.assertFalse(use_parse_cache(Parser(), key))
+        self.assertIsNone(parsecache.get_entry(key))
+
+    def test_applied_results_keep_the_entry(self):
+        parser = Parser()
+        key = cache_key("0123", parser)
+        use_parse_cache(parser, key)
+        importer = Importer(self.catalog)
+        keep_fresh(importer, key)
+        parser.parse()
+        self.assertTrue(importer.process())
+        self.assertTrue(use_parse_cache(Parser(), key))
+
+    def test_writing_parsers_are_not_cached(self):
+        parser = WritingParser()
+        key = cache_key("0123", parser)
+        self.assertFalse(use_parse_cache(parser, key))
+        parser.parse()
+        self.assertIsNone(parsecache.get_entry(key))
+        second = WritingParser()
+        self.assertFalse(use_parse_cache(second, key))
+        second.parse()
+        self.assertEqual(second.parses, 1)
+
+    def test_warnings_are_not_cached(self):
+        parser = Parser(warn=True)
+        key = cache_key("0123", parser)
+        use_parse_cache(parser, key)
+        parser.parse()
+        self.assertFalse(use_parse_cache(Parser(), key))
+
+    def test_expiry_and_size(self):
+        ttl, size = parsecache.CACHE_TTL, parsecache.CACHE_SIZE
+        try:
+            parsecache.CACHE_SIZE = 2
+            keys = []
+            for checksum in ["1", "2", "3"]:
+                parser = Parser()
+                keys.append(cache_key(checksum, parser))
+                use_parse_cache(parser, keys[-1])
+                parser.parse()
+            self.assertIsNone(parsecache.get_entry(keys[0]))
+            self.assertIsNotNone(parsecache.get_entry(keys[2]))
+
+            parsecache.CACHE_TTL = -1
+            parser = Parser()
+            use_parse_cache(parser, keys[0])
+            parser.parse()
+            self.assertIsNone(parsecache.get_entry(keys[0]))
+        finally:
+            parsecache.CACHE_TTL, parsecache.CACHE_SIZE = ttl, size
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+
+import json
+import threading
+
+from Products.ZCatalog.CatalogBrains import AbstractCatalogBrain
+from Products.ZCatalog.ZCatalog import ZCatalog
+from senaite.instruments.profiling import CATALOG_LOOKUPS
+from senaite.instruments.profiling import PROCESS
+from senaite.instruments.profiling import QueryCounter
+from senaite.instruments.profiling import get_timer
+from senaite.instruments.profiling import profiled_import
+from senaite.instruments.profiling import record_query
+from senaite.instruments.profiling import record_wakeup
+from senaite.instruments.profiling import timed
+from senaite.instruments.tests.base import BaseTestCase
+from zope.publisher.browser import TestRequest
+
+
+@timed(CATALOG_LOOKUPS)
+def search():
+    return []
+
+
+@profiled_import
+def Import(context, request):
+    with timed(PROCESS):
+        search()
+        search()
+    return json.dumps({"errors": [], "log": [], "warns": []})
+
+
+class TestImportTimer(BaseTestCase):
+
+    def test_timings_are_opt_in(self):
+        results = json.loads(Import(None, TestRequest(form={})))
+
+        self.assertEqual(sorted(results), ["errors", "log", "warns"])
+        self.assertEqual(search(), [])
+        self.assertIsNone(get_timer())
+
+    def test_timings_report(self):
+        request = TestRequest(form={"timings": "1"})
+        results = json.loads(Import(None, request))
+        timings = results["timings"]
+
+        self.assertEqual(timings[CATALOG_LOOKUPS]["calls"], 2)
+        self.assertEqual(timings[PROCESS]["calls"], 1)
+        self.assertEqual(timings["total"]["calls"], 1)
+        self.assertGreaterEqual(timings["total"]["seconds"],
+                                timings[PROCESS]["seconds"])
+        self.assertIsNone(get_timer())
+
+
+class TestQueryCounter(BaseTestCase):
+
+    def test_counts_and_duplicates(self):
+        with QueryCounter() as counter:
+            record_query("a_catalog", {"getId": "H2O-0001"})
+            record_query("a_catalog", {"getId": "H2O-0002"})
+            record_query("a_catalog", {"getId": "H2O-0001"})
+            record_query("b_catalog", {"getId": "H2O-0001"})
+            record_wakeup()
+        record_query("a_catalog", {"getId": "H2O-0003"})
+
+        self.assertEqual(len(counter), 4)
+        self.assertEqual(counter.counts, {"a_catalog": 3, "b_catalog": 1})
+        self.assertEqual(counter.count("c_catalog"), 0)
+        self.assertEqual(counter.wakeups, 1)
+        self.assertEqual(counter.duplicates.values(), [2])
+        (catalog, query), = counter.duplicates.keys()
+        self.assertEqual(catalog, "a_catalog")
+        self.assertEqual(json.loads(query), {"getId": "H2O-0001"})
+
+    def test_nested_counters(self):
+        with QueryCounter() as outer:
+            record_query("a_catalog", {"getId": "H2O-0001"})
+            with QueryCounter() as inner:
+                record_query("a_catalog", {"getId": "H2O-0002"})
+            record_wakeup()
+
+        self.assertEqual((len(outer), outer.wakeups), (2, 1))
+        self.assertEqual((len(inner), inner.wakeups), (1, 0))
+
+    def test_other_threads_are_not_counted(self):
+        def search():
+            record_query("a_catalog", {"getId": "H2O-0001"})
+            record_wakeup()
+
+        with QueryCounter() as counter:
+            thread = threading.Thread(target=search)
+            thread.start()
+            thread.join()
+            record_query("a_catalog", {"getId": "H2O-0002"})
+
+        self.assertEqual(len(counter), 1)
+        self.assertEqual(counter.wakeups, 0)
+
+    def test_hooks_are_removed_on_exit(self):
+        search_results = ZCatalog.__dict__["searchResults"]
+        get_object = AbstractCatalogBrain.__dict__["getObject"]
+        with QueryCounter():
+            with QueryCounter():
+                self.assertIsNot(
+                    ZCatalog.__dict__["searchResults"], search_results)
+            # the outer counter still counts
+            self.assertIsNot(
+                AbstractCatalogBrain.__dict__["getObject"], get_object)
+        self.assertIs(ZCatalog.__dict__["searchResults"], search_results)
+        self.assertIs(AbstractCatalogBrain.__dict__["getObject"], get_object)
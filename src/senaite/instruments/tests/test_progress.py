@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+
+import json
+
+import unittest2 as unittest
+from bika.lims import api
+from senaite.instruments import progress
+from senaite.instruments.progress import DONE
+from senaite.instruments.progress import FAILED
+from senaite.instruments.progress import IMPORTING
+from senaite.instruments.progress import ImportProgressView
+from senaite.instruments.progress import PARSING
+from senaite.instruments.progress import get_progress
+from senaite.instruments.progress import report
+from senaite.instruments.progress import start_progress
+from senaite.instruments.progress import track_progress
+from zope.publisher.browser import TestRequest
+
+
+class Parser(object):
+
+    def parse(self):
+        report(self, "rows", 10)
+        return 1
+
+
+class Importer(object):
+
+    def __init__(self, parser, fail=False):
+        self.parser = parser
+        self.fail = fail
+
+    def process(self):
+        self.parser.parse()
+        report(self, "applied", 5)
+        if self.fail:
+            raise ValueError("failed")
+        return True
+
+
+class User(object):
+
+    def __init__(self, userid):
+        self.userid = userid
+
+    def getId(self):
+        return self.userid
+
+
+class TestProgress(unittest.TestCase):
+
+    def tearDown(self):
+        progress.clear()
+
+    def test_eta(self):
+        tracked = start_progress("token")
+        self.assertEqual(tracked.state, PARSING)
+        self.assertIsNone(tracked.eta())
+        tracked.set_total("rows", 100)
+        tracked.add("rows", 25)
+        tracked.since -= 10
+        self.assertAlmostEqual(tracked.eta(), 30, places=0)
+
+        tracked.set_state(IMPORTING)
+        self.assertIsNone(tracked.eta())
+        tracked.set_total("samples", 40)
+        tracked.add("applied", 10)
+        tracked.since -= 4
+        self.assertAlmostEqual(tracked.eta(), 12, places=0)
+
+    def test_track_progress(self):
+        parser = Parser()
+        importer = track_progress(
+            Importer(parser), parser, start_progress("token"))
+        self.assertTrue(importer.process())
+        tracked = get_progress("token")
+        self.assertEqual(tracked.state, DONE)
+        self.assertEqual(tracked.counts["rows"], 10)
+        self.assertEqual(tracked.counts["applied"], 5)
+        self.assertEqual(tracked.as_dict()["eta"], 0)
+
+    def test_failed_import(self):
+        parser = Parser()
+        importer = track_progress(
+            Importer(parser, fail=True), parser, start_progress("token"))
+        self.assertRaises(ValueError, importer.process)
+        self.assertEqual(get_progress("token").state, FAILED)
+
+    def test_expired_imports(self):
+        start_progress("old").updated -= progress.PROGRESS_TTL + 1
+        start_progress("new")
+        self.assertIsNone(get_progress("old"))
+        self.assertIsNotNone(get_progress("new"))
+
+    def get_view_data(self, token, userid):
+        request = TestRequest(form=dict(import_token=token))
+        get_current_user = api.get_current_user
+        api.get_current_user = lambda: User(userid)
+        try:
+            return json.loads(ImportProgressView(None, request)())
+        finally:
+            api.get_current_user = get_current_user
+
+    def test_view_answers_the_importing_user_only(self):
+        start_progress("token", "analyst1")
+        self.assertEqual(self.get_view_data("token", "analyst1")["state"],
+                         PARSING)
+        self.assertIsNone(self.get_view_data("token", "analyst2")["state"])
+        self.assertIsNone(self.get_view_data("other", "analyst1")["state"])
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+
+from copy import deepcopy
+
+import unittest2 as unittest
+from senaite.instruments.rawresults import CompactResultsMixin
+from senaite.instruments.rawresults import Record
+from senaite.instruments.resultsimport import ChunkParser
+
+HEADER = {
+    "Lab": "Dairy Lab",
+    "ProductName": "Raw Milk",
+    "InstrumentSerialNumber": "H23061316",
+    "DateTimeofAnalysis": "2020-01-10 10:12",
+    "SampleID": "MILK-0001",
+}
+
+
+class Parser(CompactResultsMixin):
+
+    def __init__(self):
+        self._rawresults = {}
+
+    def getRawResults(self):
+        return self._rawresults
+
+
+class TestRawResults(unittest.TestCase):
+
+    def add_row(self, parser, readings):
+        for keyword, reading in readings:
+            values = dict(HEADER, DefaultResult=keyword)
+            values[keyword] = reading
+            parser._addRawResult("MILK-0001", {keyword: values})
+
+    def test_records_read_as_dicts(self):
+        parser = Parser()
+        self.add_row(parser, [("Fat", "3.91"), ("Protein", "3.32")])
+        results = parser._rawresults["MILK-0001"]
+        self.assertEqual(len(results), 2)
+        protein = results[1]["Protein"]
+        self.assertEqual(protein, dict(HEADER, DefaultResult="Protein",
+                                       Protein="3.32"))
+        self.assertEqual(protein.get("DefaultResult"), "Protein")
+        self.assertEqual(protein.get("Fat"), None)
+        self.assertIn("Lab", protein)
+        self.assertEqual(sorted(protein.keys()), sorted(
+            HEADER.keys() + ["DefaultResult", "Protein"]))
+
+    def test_header_fields_are_shared(self):
+        parser = Parser()
+        self.add_row(parser, [("Fat", "3.91"), ("Protein", "3.32"),
+                              ("Lactose", "4.71")])
+        fat, protein, lactose = [result.values()[0] for result in
+                                 parser._rawresults["MILK-0001"]]
+        self.assertIsNone(fat.shared)
+        self.assertIsNotNone(protein.shared)
+        self.assertIs(protein.shared, lactose.shared)
+        self.assertIs(fat.layout, Record(fat.items()).layout)
+
+    def test_changes_are_not_shared(self):
+        parser = Parser()
+        self.add_row(parser, [("Fat", "3.91"), ("Protein", "3.32"),
+                              ("Lactose", "4.71")])
+        results = parser._rawresults["MILK-0001"]
+        copied = deepcopy(results)
+        results[1]["Protein"]["Lab"] = "Other Lab"
+        del results[1]["Protein"]["ProductName"]
+        self.assertEqual(results[1]["Protein"]["Lab"], "Other Lab")
+        self.assertNotIn("ProductName", results[1]["Protein"])
+        self.assertEqual(results[2]["Lactose"]["Lab"], "Dairy Lab")
+        self.assertEqual(copied[1]["Protein"]["Lab"], "Dairy Lab")
+
+    def test_override(self):
+        parser = Parser()
+        self.add_row(parser, [("Fat", "3.91"), ("Protein", "3.32")])
+        parser._addRawResult("MILK-0001", {"Fat": {"Fat": "4.0"}},
+                             override=True)
+        self.assertEqual(parser._rawresults,
+                         {"MILK-0001": [{"Fat": {"Fat": "4.0"}}]})
+
+    def test_chunk_keywords_and_counts(self):
+        parser = Parser()
+        self.add_row(parser, [("Fat", "3.91"), ("Protein", "3.32")])
+        parser._addRawResult("MILK-0002", {"Lactose": dict(Lactose="4.71")})
+
+        chunk = ChunkParser(parser, ["MILK-0002"])
+        self.assertEqual(chunk.getAnalysisKeywords(), ["Lactose"])
+        self.assertEqual(chunk.getAnalysesTotalCount(), 1)
+        self.assertEqual(chunk.getResultsTotalCount(), 1)
+        self.assertEqual(chunk.getObjectsTotalCount(), 1)
+
+        # streamed records are not kept by the parser
+        chunk = ChunkParser(parser, ["MILK-0003"], {
+            "MILK-0003": [{"Fat": dict(Fat="4.1")},
+                          {"Protein": dict(Protein="3.2")}]})
+        self.assertEqual(sorted(chunk.getAnalysisKeywords()),
+                         ["Fat", "Protein"])
+        self.assertEqual(chunk.getResultsTotalCount(), 2)
@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+
+import unittest2 as unittest
+from bika.lims import api
+from senaite.core.catalog import ANALYSIS_CATALOG
+from senaite.core.catalog import SAMPLE_CATALOG
+from senaite.instruments.resolver import AnalysisIndex
+from senaite.instruments.resolver import ResolverMixin
+from senaite.instruments.resolver import SampleResolver
+
+
+class Brain(object):
+
+    def __init__(self, portal_type, keyword):
+        self.portal_type = portal_type
+        self.getKeyword = keyword
+
+
+class TestSampleResolver(unittest.TestCase):
+
+    def search(self, results):
+        searches = []
+
+        def search(query, catalog):
+            searches.append((query, catalog))
+            return results.get(catalog, [])
+
+        return searches, search
+
+    def test_lookups_are_memoized(self):
+        resolver = SampleResolver()
+        searches, search = self.search({})
+        original_search = api.search
+        api.search = search
+        try:
+            for i in range(3):
+                self.assertFalse(resolver.is_sample("H2O-0001"))
+                self.assertIsNone(resolver.get_sample("H2O-0001"))
+                self.assertFalse(resolver.is_analysis_group_id("QC10"))
+        finally:
+            api.search = original_search
+
+        catalogs = [catalog for query, catalog in searches]
+        self.assertEqual(catalogs, [SAMPLE_CATALOG, ANALYSIS_CATALOG])
+
+    def test_group_portal_type_filter(self):
+        resolver = SampleResolver()
+        brains = [Brain("DuplicateAnalysis", "Ca"),
+                  Brain("ReferenceAnalysis", "Fe")]
+        searches, search = self.search({ANALYSIS_CATALOG: brains})
+        original_search = api.search
+        api.search = search
+        try:
+            dups = resolver.get_group_analyses("QC10", "DuplicateAnalysis")
+            refs = resolver.get_group_analyses("QC10", "ReferenceAnalysis")
+            portal_type = resolver.get_portal_type("QC10")
+        finally:
+            api.search = original_search
+
+        self.assertEqual([b.getKeyword for b in dups], ["Ca"])
+        self.assertEqual([b.getKeyword for b in refs], ["Fe"])
+        self.assertEqual(portal_type, "DuplicateAnalysis")
+        group_searches = [s for s in searches if s[1] == ANALYSIS_CATALOG]
+        self.assertEqual(len(group_searches), 1)
+
+    def test_prefetch_batches_lookups(self):
+        resolver = SampleResolver()
+        sample = Brain("AnalysisRequest", None)
+        sample.getId = "H2O-0001"
+        duplicate = Brain("DuplicateAnalysis", "Ca")
+        duplicate.getReferenceAnalysesGroupID = "QC10"
+        searches, search = self.search({
+            SAMPLE_CATALOG: [sample],
+            ANALYSIS_CATALOG: [duplicate],
+        })
+        original_search = api.search
+        api.search = search
+        try:
+            resolver.prefetch(["H2O-0001", "QC10", "QC10", "RS-1", ""])
+            self.assertEqual(len(searches), 3)
+            self.assertTrue(resolver.is_sample("H2O-0001"))
+            self.assertFalse(resolver.is_sample("QC10"))
+            self.assertTrue(resolver.is_analysis_group_id("QC10"))
+            self.assertFalse(resolver.is_reference_sample("RS-1"))
+            resolver.prefetch(["H2O-0001", "QC10"])
+        finally:
+            api.search = original_search
+
+        self.assertEqual(len(searches), 3)
+        self.assertEqual(searches[0][0]["getId"], ["H2O-0001", "QC10", "RS-1"])
+        self.assertEqual(
+            searches[1][0]["getReferenceAnalysesGroupID"], ["QC10", "RS-1"])
+        self.assertEqual(searches[2][0]["getId"], ["RS-1"])
+
+    def test_prefetch_rows_in_batches(self):
+        read = []
+
+        def rows():
+            for sample_id in ["S-1", "S-2", "S-1", "S-3", "S-4"]:
+                read.append(sample_id)
+                yield sample_id
+
+        searches, search = self.search({})
+        original_search = api.search
+        api.search = search
+        try:
+            parser = ResolverMixin()
+            rows = parser.iter_prefetched(rows(), lambda row: row, size=2)
+            self.assertEqual(next(rows), "S-1")
+            # only the first batch was read and resolved
+            self.assertEqual(read, ["S-1", "S-2"])
+            self.assertEqual(searches[0][0]["getId"], ["S-1", "S-2"])
+            searched = len(searches)
+            self.assertEqual(list(rows), ["S-2", "S-1", "S-3", "S-4"])
+        finally:
+            api.search = original_search
+
+        # the IDs resolved before are not looked up again
+        self.assertEqual(searches[searched][0]["getId"], ["S-3"])
+        self.assertEqual(len(searches), 3 * searched)
+
+    def test_interims_map(self):
+        resolver = SampleResolver()
+        analyses = []
+        for uid, keyword, interims in [("1", "Ca", ["Reading", "Factor"]),
+                                       ("2", "Fe", ["Reading"]),
+                                       ("3", "Cu", [])]:
+            analysis = Brain("DuplicateAnalysis", keyword)
+            analysis.UID = uid
+            analysis.getInterimFields = [{"keyword": k} for k in interims]
+            analyses.append(analysis)
+        searches, search = self.search({ANALYSIS_CATALOG: analyses})
+        original_search = api.search
+        api.search = search
+        try:
+            interims = resolver.get_interims_map("QC10")
+            self.assertIs(resolver.get_interims_map("QC10"), interims)
+        finally:
+            api.search = original_search
+
+        self.assertEqual(interims, {"Reading": ["Ca", "Fe"],
+                                    "Factor": ["Ca"]})
+        self.assertEqual(resolver.get_interim_keywords(analyses[1]),
+                         ["Reading"])
+        group_searches = [s for s in searches if s[1] == ANALYSIS_CATALOG]
+        self.assertEqual(len(group_searches), 1)
+
+    def test_prefixed_group_analyses(self):
+        resolver = SampleResolver()
+        brains = []
+        for group_id in ["D-1", "D-10", "E-1"]:
+            brain = Brain("DuplicateAnalysis", "Ca")
+            brain.getReferenceAnalysesGroupID = group_id
+            brains.append(brain)
+        searches, search = self.search({ANALYSIS_CATALOG: brains})
+        original_search = api.search
+        api.search = search
+        try:
+            for i in range(2):
+                found = resolver.get_prefixed_group_analyses(
+                    "D-1", "DuplicateAnalysis")
+        finally:
+            api.search = original_search
+
+        self.assertEqual([b.getReferenceAnalysesGroupID for b in found],
+                         ["D-1", "D-10"])
+        self.assertEqual(len(searches), 1)
+        query = searches[0][0]["getReferenceAnalysesGroupID"]
+        self.assertEqual(query, {"query": ["D-1", "D-2"],
+                                 "range": "min:max"})
+        self.assertEqual(resolver.get_prefixed_group_analyses(""), [])
+
+    def test_metadata_wakes_up_batches(self):
+        resolver = SampleResolver()
+        brains = []
+        for uid, keyword in [("1", "Ca"), ("2", "Fe"), ("3", "Cu")]:
+            brain = Brain("DuplicateAnalysis", keyword)
+            brain.UID = uid
+            brain.getInterimFields = []
+            brains.append(brain)
+        searches, search = self.search({ANALYSIS_CATALOG: brains})
+        woken = []
+
+        def get_object(brain):
+            woken.append(brain.UID)
+            obj = Brain(brain.portal_type, brain.getKeyword)
+            obj.Precision = int(brain.UID)
+            return obj
+
+        original = api.search, api.is_brain, api.get_object
+        api.search = search
+        api.is_brain = lambda obj: isinstance(obj, Brain)
+        api.get_object = get_object
+        try:
+            analyses = resolver.get_group_analyses("QC10")
+            precisions = [resolver.get_metadata(a, "Precision")
+                          for a in analyses]
+            keyword = resolver.get_metadata(analyses[1], "getKeyword")
+        finally:
+            api.search, api.is_brain, api.get_object = original
+
+        self.assertEqual(precisions, [1, 2, 3])
+        self.assertEqual(keyword, "Fe")
+        self.assertEqual(woken, ["1", "2", "3"])
+        self.assertRaises(
+            ValueError, resolver.get_metadata, None, "getKeyword")
+
+    def test_precision_is_read_from_the_object(self):
+        resolver = SampleResolver()
+        brain = Brain("Analysis", "Ca")
+        brain.UID = "1"
+        brain.Precision = 2
+        obj = Brain("Analysis", "Ca")
+        obj.Precision = 4
+        # the precision computed from the uncertainty is not used
+        obj.getPrecision = lambda: 6
+
+        original = api.is_brain, api.get_object
+        api.is_brain = lambda obj: isinstance(obj, Brain) and obj is brain
+        api.get_object = lambda brain: obj
+        try:
+            precision = resolver.get_metadata(brain, "Precision")
+        finally:
+            api.is_brain, api.get_object = original
+
+        # the metadata holds the precision of the last reindex, the stored
+        # field of the object is used
+        self.assertEqual(precision, 4)
+
+
+class TestAnalysisIndex(unittest.TestCase):
+
+    def test_keyword_and_prefix_lookups(self):
+        analyses = [Brain("Analysis", kw) for kw in
+                    ["Ca", "Cd", "Cu", "Cu-1", "Fe", "Cu"]]
+        index = AnalysisIndex(analyses)
+
+        self.assertEqual(len(index), 6)
+        self.assertIn("Cu", index)
+        self.assertNotIn("Zn", index)
+        self.assertIs(index["Cu"], analyses[-1])
+        self.assertEqual(len(index.filter("Cu")), 2)
+        self.assertEqual(
+            [a.getKeyword for a in index.startswith("Cu")], ["Cu", "Cu-1"])
+        self.assertEqual(index.startswith("Zn"), [])
+
+    def test_objects_are_indexed_by_getters(self):
+        analysis = Brain("ReferenceAnalysis", None)
+        analysis.getKeyword = lambda: "Fe"
+        analysis.Title = lambda: "Iron"
+        index = AnalysisIndex([analysis])
+
+        self.assertIs(index.get("Fe"), analysis)
+        self.assertIs(index.get_by_title("Iron"), analysis)
+        self.assertEqual(index.title_startswith("Ir"), [analysis])
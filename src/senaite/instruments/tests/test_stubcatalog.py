@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+
+from cStringIO import StringIO
+
+import unittest2 as unittest
+from bika.lims import api
+from openpyxl import load_workbook
+from senaite.core.catalog import ANALYSIS_CATALOG
+from senaite.core.catalog import SAMPLE_CATALOG
+from senaite.instruments.benchmark.files import to_xlsx
+from senaite.instruments.benchmark.runner import make_case
+from senaite.instruments.instrument import FileStub
+from senaite.instruments.instruments.bika.software.software import \
+    AnalysisNotFound
+from senaite.instruments.instruments.bika.software.software import \
+    SoftwareParser
+from senaite.instruments.instruments.perkinelmer.lactoscope.\
+    lactoscopeh23061316 import LactoscopeH23061316COMPParser
+from senaite.instruments.profiling import QueryCounter
+from senaite.instruments.resolver import DUPLICATE_ANALYSIS
+from senaite.instruments.resolver import REFERENCE_ANALYSIS
+from senaite.instruments.resolver import REFERENCE_SAMPLE
+from senaite.instruments.resolver import SAMPLE
+from senaite.instruments.resolver import SampleResolver
+from senaite.instruments.stubcatalog import StubCatalog
+from senaite.instruments.tests.layers import STUB_CATALOG_TESTING
+from zope.publisher.browser import FileUpload
+
+
+class TestStubCatalog(unittest.TestCase):
+    layer = STUB_CATALOG_TESTING
+
+    def setUp(self):
+        self.catalog = self.layer["catalog"]
+
+    def test_sample_lookups(self):
+        for i in range(1, 4):
+            self.catalog.add_sample(
+                "W-000%s" % i, [("Ca", "Calcium", ["Reading"]),
+                                ("Fe", "Iron", [])],
+                client_sample_id="C%s" % i)
+        resolver = SampleResolver()
+        with QueryCounter() as counter:
+            resolver.prefetch(["W-0001", "W-0002", "W-0003"])
+            index = resolver.get_analysis_index("W-0002")
+        self.assertEqual(counter.counts, {SAMPLE_CATALOG: 1})
+        self.assertEqual(counter.wakeups, 1)
+        self.assertEqual(sorted(index.by_keyword), ["Ca", "Fe"])
+        self.assertEqual(index.get_by_title("Iron").getKeyword, "Fe")
+        self.assertEqual(resolver.get_interims_map("W-0002"),
+                         {"Reading": ["Ca"]})
+        self.assertEqual(resolver.get_sample_id("C3"), "W-0003")
+        self.assertEqual(resolver.get_portal_type("W-0001"), SAMPLE)
+
+    def test_analysis_arguments(self):
+        sample = self.catalog.add_sample("W-0001", [
+            dict(keyword="Pb", precision=3, ldl="0.01", udl="100")])
+        analysis = sample.getAnalyses(full_objects=True)[0]
+        self.assertEqual(analysis.Title(), "Pb")
+        self.assertEqual(analysis.getPrecision(), 3)
+        self.assertEqual(analysis.getLowerDetectionLimit(), "0.01")
+        self.assertEqual(analysis.getUpperDetectionLimit(), "100")
+        self.assertIs(api.get_object_by_uid(analysis.UID), analysis)
+
+    def test_reference_groups(self):
+        self.catalog.add_reference_group(
+            "QC-10", [("Ca", "Calcium", [])], DUPLICATE_ANALYSIS)
+        self.catalog.add_reference_group("QC-10", [("Fe", "Iron", [])])
+        self.catalog.add_reference_group("QC-20", [("Fe", "Iron", [])])
+        resolver = SampleResolver()
+        self.assertEqual(resolver.get_portal_type("QC-10"),
+                         DUPLICATE_ANALYSIS)
+        self.assertEqual(resolver.get_portal_type("QC-20"),
+                         REFERENCE_ANALYSIS)
+        refs = resolver.get_group_analyses("QC-10", REFERENCE_ANALYSIS)
+        self.assertEqual([b.getKeyword for b in refs], ["Fe"])
+        self.assertEqual(
+            len(resolver.get_prefixed_group_analyses("QC-")), 3)
+        self.assertEqual(
+            api.search(dict(getKeyword="Fe"), ANALYSIS_CATALOG)[0].Title,
+            "Iron")
+
+    def test_reference_samples(self):
+        self.catalog.add_reference_sample("RS-1", [("Ca", "Calcium", [])])
+        resolver = SampleResolver()
+        self.assertEqual(resolver.get_portal_type("RS-1"), REFERENCE_SAMPLE)
+        index = resolver.get_analysis_index("RS-1")
+        self.assertEqual(index["Ca"].getKeyword(), "Ca")
+
+    def test_reference_sample_by_id(self):
+        self.catalog.add_reference_sample("RS-1", [("Ca", "Calcium", [])])
+        resolver = SampleResolver()
+        self.assertEqual(resolver.get_reference_sample("RS-1").getId, "RS-1")
+        self.assertIsNone(resolver.get_reference_sample("RS-2"))
+
+        infile = FileUpload(FileStub(file=StringIO(""), name="results.csv"))
+        parser = SoftwareParser(infile, None)
+        reference = parser.get_reference_sample("RS-1", "Calcium")
+        self.assertEqual(reference.getId, "RS-1")
+        analysis = parser.get_reference_sample_analysis(reference, "Calcium")
+        self.assertEqual(analysis.getKeyword(), "Ca")
+        self.assertRaises(AnalysisNotFound,
+                          parser.get_reference_sample, "RS-2", "Calcium")
+
+    def test_software_without_comments_sheet(self):
+        case, catalog = make_case("software", 2)
+        filename, data = case.files[0]
+        wb = load_workbook(StringIO(data))
+        wb.remove(wb["Comments"])
+        results = StringIO()
+        wb.save(results)
+        infile = FileUpload(FileStub(file=StringIO(results.getvalue()),
+                                     name=filename))
+        with catalog:
+            parser = case.parser(infile)
+            parser.parse()
+        self.assertEqual(parser.errors, [])
+        self.assertEqual(sorted(parser.getRawResults()),
+                         ["BM-00001", "BM-00002"])
+
+    def test_warning_line_numbers(self):
+        header = ["Product Name", "Sample ID", "Predicted Fat % m/m"]
+        rows = [header, ["Raw\nMilk", "W-9998", "3.91"], [],
+                ["Milk", "W-9999", "3.5"]]
+        csv_data = "%s\n\"Raw\nMilk\",W-9998,3.91\n\nMilk,W-9999,3.5\n" % (
+            ",".join(header))
+        # a csv file is numbered by its lines, a quoted cell spans two, and
+        # the empty rows of a workbook are not counted, as before
+        for filename, data, line_nums in [
+                ("lactoscope.csv", csv_data, (3, 5)),
+                ("lactoscope.xlsx", to_xlsx(("Report", rows)), (2, 3))]:
+            infile = FileUpload(FileStub(file=StringIO(data), name=filename))
+            parser = LactoscopeH23061316COMPParser(infile)
+            parser.parse()
+            self.assertEqual(parser.warns, [
+                "[%s] No results found for 'W-9998'" % line_nums[0],
+                "[%s] No results found for 'W-9999'" % line_nums[1]])
+
+    def test_software_large_workbook(self):
+        # the sheets of larger workbooks do not fit in one read of the file
+        case, catalog = make_case("software", 200)
+        filename, data = case.files[0]
+        infile = FileUpload(FileStub(file=StringIO(data), name=filename))
+        with catalog:
+            parser = case.parser(infile)
+            parser.parse()
+        self.assertEqual(parser.errors, [])
+        self.assertEqual(len(parser.getRawResults()), 200)
+
+    def test_setup_catalog(self):
+        self.catalog.add_sample("W-0001", [("Ca", None, []), ("Fe", None, [])])
+        instrument = self.catalog.add_instrument("ICP")
+        bsc = api.get_tool("bika_setup_catalog")
+        self.assertEqual(sorted(bsc.uniqueValuesFor("getKeyword")),
+                         ["Ca", "Fe"])
+        self.assertEqual(api.get_object_by_uid(instrument.UID).Title(), "ICP")
+        self.assertIsNone(api.get_object_by_uid("missing", None))
+
+    def test_tool_calls_and_wakeups_are_counted(self):
+        self.catalog.add_sample("W-0001", [("Ca", None, [])])
+        with QueryCounter() as counter:
+            brain, = api.get_tool(SAMPLE_CATALOG)(getId="W-0001")
+            brain.getObject()
+            api.get_object(brain)
+        self.assertEqual(counter.counts, {SAMPLE_CATALOG: 1})
+        self.assertEqual(counter.wakeups, 2)
+
+    def test_api_is_restored(self):
+        search = api.search
+        with StubCatalog() as catalog:
+            self.assertEqual(api.search, catalog.search)
+        self.assertIs(api.search, search)
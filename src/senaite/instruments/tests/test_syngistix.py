@@ -6,6 +6,7 @@
 
 
 import cStringIO
+import json
 from datetime import datetime
 from os.path import abspath
 from os.path import dirname
@@ -14,6 +15,7 @@ from os.path import join
 from plone.app.testing import TEST_USER_ID
 from plone.app.testing import TEST_USER_NAME
 from plone.app.testing import login
+from plone.app.testing import logout
 from plone.app.testing import setRoles
 
 from bika.lims import api
@@ -21,9 +23,26 @@ from senaite.instruments.instruments.perkinelmer.syngistix.syngistix import (
     importer,
 )
 from senaite.core.catalog import ANALYSIS_CATALOG
+from senaite.core.catalog import SAMPLE_CATALOG
+from senaite.core.catalog import SENAITE_CATALOG
 from senaite.instruments.instruments.perkinelmer.syngistix.syngistix import (
       MyExport,
   )
+from senaite.instruments.instruments.perkinelmer.syngistix.syngistix import (
+    SyngistixParser,
+)
+from senaite.instruments import queuedimport
+from senaite.instruments.instrument import file_checksum
+from senaite.instruments.parsecache import cache_key
+from senaite.instruments.profiling import QueryCounter
+from senaite.instruments.progress import get_progress
+from senaite.instruments.resultsimport import ChunkedResultsImporter
+from senaite.instruments.resultsimport import StreamingResultsImporter
+from senaite.instruments.resultsimport import checkpoint_key
+from senaite.instruments.resultsimport import get_checkpoint
+from senaite.instruments.resultsimport import get_checkpoints
+from senaite.instruments.resultsimport import make_importer
+from senaite.instruments.resultsimport import update_checkpoint
 
 from senaite.instruments.tests import TestFile
 from senaite.instruments.tests.base import BaseTestCase
@@ -172,6 +191,213 @@ class TestSyngistix(BaseTestCase):
         self.assertEqual(reading_value_3, "1.61")
         self.assertEqual(reading_value_4, "0.2")
 
+    def test_parse_queries(self):
+        for sample_id in ["RCK-0001", "RCK-0002", "RCK-0003", "RCK-0004"]:
+            ar = self.add_analysisrequest(
+                self.client,
+                dict(
+                    Client=self.client.UID(),
+                    Contact=self.contact.UID(),
+                    DateSampled=datetime.now().date().isoformat(),
+                    SampleType=self.sampletype.UID(),
+                ),
+                [srv.UID() for srv in self.services],
+            )
+            ar.setId(sample_id)
+            ar.reindexObject()
+        data = open(test_file, "r").read()
+        import_file = FileUpload(TestFile(cStringIO.StringIO(data), test_file))
+        parser = SyngistixParser(
+            import_file, worksheet="Conc. in Sample Units")
+
+        with QueryCounter() as counter:
+            parser.parse()
+
+        # the IDs of the file are resolved at once, not row by row
+        self.assertEqual(counter.counts, {
+            SAMPLE_CATALOG: 1,
+            ANALYSIS_CATALOG: 1,
+            SENAITE_CATALOG: 1,
+        })
+        self.assertEqual(counter.duplicates, {})
+        self.assertEqual(counter.wakeups, 4)
+
+    def make_received_samples(self):
+        ars = []
+        for sample_id in ["RCK-0001", "RCK-0002", "RCK-0003", "RCK-0004"]:
+            ar = self.add_analysisrequest(
+                self.client,
+                dict(
+                    Client=self.client.UID(),
+                    Contact=self.contact.UID(),
+                    DateSampled=datetime.now().date().isoformat(),
+                    SampleType=self.sampletype.UID(),
+                ),
+                [srv.UID() for srv in self.services],
+            )
+            ar.setId(sample_id)
+            api.do_transition_for(ar, "receive")
+            ars.append(ar)
+        return ars
+
+    def get_potassium_readings(self, ars):
+        readings = []
+        for ar in ars:
+            analysis = ar.getAnalyses(full_objects=True, getKeyword="K")[0]
+            readings.append(self.get_interim_result(analysis))
+        return readings
+
+    def test_chunked_import(self):
+        ars = self.make_received_samples()
+        data = open(test_file, "r").read()
+        import_file = FileUpload(TestFile(cStringIO.StringIO(data), test_file))
+        request = TestRequest(form=dict(chunk_size="3"))
+        results_importer = make_importer(
+            request,
+            parser=SyngistixParser(
+                import_file, worksheet="Conc. in Sample Units"),
+            context=self.portal,
+            allowed_sample_states=["sample_received"],
+            allowed_analysis_states=None,
+            override=[True, False],
+            instrument_uid=api.get_uid(self.instrument),
+            # resuming an import that already committed the first Sample
+            applied=["RCK-0001"],
+        )
+        self.assertTrue(isinstance(results_importer, ChunkedResultsImporter))
+        results_importer.process()
+
+        readings = self.get_potassium_readings(ars)
+        self.assertNotEqual(readings[0], "2.23")
+        self.assertEqual(readings[1:], ["1.6", "1.61", "0.2"])
+        self.assertEqual(results_importer.applied, set(
+            ["RCK-0001", "RCK-0002", "RCK-0003", "RCK-0004"]))
+        # reported as one import
+        finished = [log for log in results_importer.logs
+                    if log.startswith("Import finished successfully")]
+        self.assertEqual(len(finished), 1)
+        self.assertIn(": 3 Samples", finished[0])
+
+    def test_chunked_import_checkpoint(self):
+        ars = self.make_received_samples()
+        data = open(test_file, "r").read()
+        import_file = FileUpload(TestFile(cStringIO.StringIO(data), test_file))
+        parser = SyngistixParser(
+            import_file, worksheet="Conc. in Sample Units")
+        key = checkpoint_key(
+            cache_key(file_checksum(import_file), parser, "received",
+                      "override"),
+            api.get_uid(self.instrument))
+        # an earlier run of the import failed after the first two Samples
+        update_checkpoint(key, ["RCK-0001", "RCK-0002"])
+        # an import of another file that was never run again
+        stale = checkpoint_key(("0123", ), api.get_uid(self.instrument))
+        update_checkpoint(stale, ["RCK-0003"])
+        checkpoints = get_checkpoints()
+        checkpoints[stale] = (0, checkpoints[stale][1])
+
+        request = TestRequest(form=dict(
+            submitted=True,
+            artoapply="received",
+            results_override="override",
+            instrument_results_file=import_file,
+            instrument=api.get_uid(self.instrument),
+            chunk_size="1",
+        ))
+        results = importer.Import(self.portal, request)
+
+        readings = self.get_potassium_readings(ars)
+        self.assertNotEqual(readings[:2], ["2.23", "1.6"])
+        self.assertEqual(readings[2:], ["1.61", "0.2"])
+        self.assertEqual(get_checkpoint(key), [])
+        self.assertNotIn(stale, get_checkpoints())
+        logs = json.loads(results)["log"]
+        self.assertIn("Skipped 2 already applied Samples", logs)
+        # one chunk per Sample, reported as one import
+        finished = [log for log in logs
+                    if log.startswith("Import finished successfully")]
+        self.assertEqual(len(finished), 1)
+        self.assertIn(": 2 Samples", finished[0])
+        self.assertEqual(len([log for log in logs
+                              if log.startswith("Allowed Sample states")]), 1)
+
+    def test_streamed_import(self):
+        ars = self.make_received_samples()
+        data = open(test_file, "r").read()
+        import_file = FileUpload(TestFile(cStringIO.StringIO(data), test_file))
+        request = TestRequest(form=dict(stream="1", import_token="syngistix"))
+        parser = SyngistixParser(
+            import_file, worksheet="Conc. in Sample Units")
+        results_importer = make_importer(
+            request,
+            parser=parser,
+            context=self.portal,
+            allowed_sample_states=["sample_received"],
+            allowed_analysis_states=None,
+            override=[True, False],
+            instrument_uid=api.get_uid(self.instrument),
+            savepoint_size=2,
+        )
+        self.assertTrue(
+            isinstance(results_importer, StreamingResultsImporter))
+        results_importer.process()
+
+        readings = self.get_potassium_readings(ars)
+        self.assertEqual(readings, ["2.23", "1.6", "1.61", "0.2"])
+        self.assertEqual(results_importer.applied, 4)
+        # the results were applied, not kept
+        self.assertEqual(parser.getRawResults(), {})
+        finished = [log for log in results_importer.logs
+                    if log.startswith("Import finished successfully")]
+        self.assertEqual(len(finished), 1)
+        self.assertIn(": 4 Samples", finished[0])
+        progress = get_progress("syngistix")
+        self.assertEqual(progress.state, "done")
+        self.assertEqual(progress.counts["applied"], 4)
+        self.assertEqual(progress.counts["rows"], progress.totals["rows"])
+
+    def test_queued_import(self):
+        ars = self.make_received_samples()
+        data = open(test_file, "r").read()
+        import_file = FileUpload(TestFile(cStringIO.StringIO(data), test_file))
+        request = TestRequest(form=dict(
+            submitted=True,
+            artoapply="received",
+            results_override="override",
+            instrument_results_file=import_file,
+            instrument=api.get_uid(self.instrument),
+            queued="1",
+        ))
+        workers = queuedimport.WORKERS
+        # keep the job in the queue and run it in the test's connection
+        queuedimport.WORKERS = 0
+        self.addCleanup(queuedimport.clear)
+        try:
+            results = json.loads(importer.Import(self.portal, request))
+        finally:
+            queuedimport.WORKERS = workers
+
+        job = queuedimport.get_job(results["job_id"])
+        self.assertEqual(job.state, queuedimport.QUEUED)
+        self.assertEqual(self.get_job_state(job.id), queuedimport.QUEUED)
+        self.assertEqual(job.form["artoapply"], "received")
+        self.assertNotEqual(
+            self.get_potassium_readings(ars), ["2.23", "1.6", "1.61", "0.2"])
+
+        output = json.loads(queuedimport.process_job(job, self.portal))
+        self.assertEqual(output["errors"], [])
+        self.assertEqual(self.get_potassium_readings(ars),
+                         ["2.23", "1.6", "1.61", "0.2"])
+
+        # the job is not shown to other users
+        logout()
+        self.assertIsNone(self.get_job_state(job.id))
+
+    def get_job_state(self, job_id):
+        request = TestRequest(form=dict(job_id=job_id))
+        view = queuedimport.ImportJobView(self.portal, request)
+        return json.loads(view())["state"]
+
     def get_interim_result(self, service):
         interims = service.getInterimFields()
         for interim in interims:
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+
+import unittest2 as unittest
+from senaite.instruments.instruments.xcalibur import instrument
+from senaite.instruments.instruments.xcalibur.instrument import get_keywords
+from senaite.instruments.instruments.xcalibur.instrument import is_keyword
+from senaite.instruments.stubcatalog import Tool
+from senaite.instruments.tests.layers import STUB_CATALOG_TESTING
+
+
+class TestKeywords(unittest.TestCase):
+    layer = STUB_CATALOG_TESTING
+
+    def setUp(self):
+        self.catalog = self.layer["catalog"]
+        self.catalog.add_sample("W-0001", [("Ca", None, []), ("Fe", None, [])])
+        instrument._keywords_cache.clear()
+        self.lookups = []
+        self.unique_values = Tool.uniqueValuesFor
+
+        def uniqueValuesFor(tool, index):
+            self.lookups.append(index)
+            return self.unique_values(tool, index)
+
+        Tool.uniqueValuesFor = uniqueValuesFor
+
+    def tearDown(self):
+        Tool.uniqueValuesFor = self.unique_values
+        instrument._keywords_cache.clear()
+
+    def test_keywords_are_cached(self):
+        keywords = get_keywords()
+        self.assertEqual(sorted(keywords), ["Ca", "Fe"])
+        self.assertIs(get_keywords(), keywords)
+        self.assertTrue(is_keyword("Fe"))
+        self.assertFalse(is_keyword("Zn", keywords))
+        self.assertEqual(self.lookups, ["getKeyword"])
+
+    def test_new_service_invalidates_the_cache(self):
+        self.assertFalse(is_keyword("Zn"))
+        self.catalog.add_sample("W-0002", [("Zn", None, [])])
+        self.assertTrue(is_keyword("Zn"))
+        self.assertEqual(len(self.lookups), 2)
+        self.assertEqual(sorted(get_keywords()), ["Ca", "Fe", "Zn"])
+        self.assertEqual(len(self.lookups), 2)